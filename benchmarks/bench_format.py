@@ -0,0 +1,74 @@
+"""
+Benchmark for formatting roll results.
+
+Rolls equations of 1, 5 and 20 terms once with a seeded RNG, then times the render pass (render_equation) and both
+replies built from it (format_response, format_response_full). Run from the repository root:
+
+    python benchmarks/bench_format.py [--repeat N] [--terms 1 5 20]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+import _discord_stub  # noqa: E402
+
+_discord_stub.install()
+
+import main  # noqa: E402
+import rollengine  # noqa: E402
+
+# Cycled through to build an equation of any length: plain sums, keeps, explosions, counters and a constant
+TERMS = [
+    '4d6k3',
+    '2dGA',
+    '1d20',
+    '10d10>=8',
+    '3d6!6',
+    '1dGD',
+    '5',
+    '2dST',
+]
+
+
+def equation(num_terms):
+    return ' + '.join(TERMS[idx % len(TERMS)] for idx in range(num_terms))
+
+
+def best_of(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench(expr, repeat, rng):
+    results = rollengine.roll_command(expr, rng=rng)
+    return [
+        best_of(lambda: main.render_equation(results, main._embed_field_chars), repeat),
+        best_of(lambda: main.format_response(results), repeat),
+        best_of(lambda: main.format_response_full(results), repeat),
+    ]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--terms', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--dice', default=os.path.join(os.path.dirname(rollengine.__file__), 'dice.json'))
+    args = parser.parse_args()
+
+    rollengine.load_dice_types(args.dice)
+    rng = rollengine.make_rng(seed=args.seed)
+    columns = ['render', 'compact', 'full']
+    print(f'{"terms":<8}' + ''.join(f' {column:>12}' for column in columns) + '   (usec)')
+    for num_terms in args.terms:
+        times = bench(equation(num_terms), args.repeat, rng)
+        print(f'{num_terms:<8}' + ''.join(f' {best * 1e6:>12.2f}' for best in times))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,75 @@
+"""
+Microbenchmark for keep (k/kl) selection.
+
+Times select_kept against sorting the whole pool and slicing, which is what keep used to do, then a whole roll of the
+expression on each engine. Run from the repository root:
+
+    python benchmarks/bench_keep.py [--repeat N]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+import rollengine  # noqa: E402
+
+CASES = [
+    '4d6k3',
+    '20d20kl1',
+    '1000d6k10',
+    '1000d6kl10',
+    '1000d6k500',
+    '10000d6k10',
+    '10000d10k2000',
+    '50d1000k20',
+]
+
+
+def best_of(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def sort_keep(rolls, keep_num):
+    rolls = sorted(rolls)
+    return rolls[:keep_num] if keep_num > 0 else rolls[keep_num:]
+
+
+def bench(dice_str, repeat):
+    plan = rollengine.compile_dice(dice_str)
+    keep_num = plan.options['keep']
+    rolls = rollengine.roll_dice(plan.dice.sides, plan.num_dice)
+
+    times = [
+        best_of(lambda: sort_keep(rolls, keep_num), repeat),
+        best_of(lambda: rollengine.select_kept(rolls, keep_num, plan.dice.sides), repeat),
+        best_of(lambda: rollengine.DiceRoll(dice_str, plan), repeat),
+    ]
+    if rollengine.np is not None:
+        times.append(best_of(lambda: rollengine.VectorDiceRoll(dice_str, plan), repeat))
+    return times
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dice', default=os.path.join(os.path.dirname(rollengine.__file__), 'dice.json'))
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    rollengine.load_dice_types(args.dice)
+    columns = ['sort', 'select', 'python roll'] + (['numpy roll'] if rollengine.np is not None else [])
+    print(f'{"expression":<16}' + ''.join(f' {column:>12}' for column in columns) + '   (usec)')
+    for dice_str in CASES:
+        times = bench(dice_str, args.repeat)
+        print(f'{dice_str:<16}' + ''.join(f' {best * 1e6:>12.2f}' for best in times))
+
+
+if __name__ == '__main__':
+    main_()
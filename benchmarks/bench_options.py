@@ -0,0 +1,165 @@
+"""
+Microbenchmark for dice option parsing.
+
+Times parse_options on option strings of growing length, straight from decode_dice_string so the plan cache doesn't
+hide anything. The split-based parser it replaced is kept here and timed alongside it, so one run shows before and
+after. Run from the repository root:
+
+    python benchmarks/bench_options.py [--repeat N]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+import rollengine  # noqa: E402
+
+CASES = [
+    '1d20',
+    '4d6k3',
+    '2d20!r1',
+    '10d10r1r2!9!10>=8',
+    '5d6r1r2r3r4!6!5cs6cf1min10max25',
+    '12d12' + ''.join(f'r{x}' for x in range(1, 6)) + ''.join(f'!{x}' for x in range(8, 13)) + 'cs12cf1cb11cx2>=7~<=2',
+    '8d10' + ''.join(f'r{x}' for x in range(1, 10)) + ''.join(f'!{x}' for x in range(1, 10)) + 'k4cs10cf1min5max60',
+    '3dGP' + 'r"T"' * 8 + '!"SS"' * 8,
+]
+
+
+# The parser before the single-pass tokenizer: search for the next op, split the operand off what's left with a second
+# pattern, and run the op down an elif chain
+option_pattern = re.compile(
+    r'(?P<op>' +
+    rollengine._options +
+    r')'
+)
+
+operand_pattern = re.compile(
+    r'''^((?:(?:\d+|(?:['"])\w+(?:['"])),?)*)'''
+)
+
+
+def get_operand(option_string):
+    _, operand, option_string = operand_pattern.split(option_string, 1)
+    # Toss quotes
+    operand = operand.replace("'", '').replace('"', '')
+    return operand, option_string
+
+
+def split_parse_options(dice_str, roll_options_str, dice):
+    option_dict = defaultdict(set)
+    for key, value in dice.presets:
+        option_dict[key] = set(value) if isinstance(value, frozenset) else value
+
+    option_string = roll_options_str[:]
+    min_val = None
+    max_val = None
+    keep_option_found = False
+    threshold_option_found = False
+    fail_threshold_option_found = False
+    boon_threshold_found = False
+    complication_threshold_found = False
+
+    while option_string:
+        try:
+            _, op, option_string = option_pattern.split(option_string, 1)
+        except ValueError:
+            raise rollengine.UnknownOperationError(option_string)
+
+        if op == '!' or op == 'r':
+            operand, option_string = get_operand(option_string)
+            key = 'explode' if op == '!' else 'reroll'
+            try:
+                option_dict[key].add(str(int(operand)))
+            except ValueError:
+                option_dict[key] |= rollengine.form_face_roll_list(operand)
+        elif (op == 'k' or op == 'kl') and not keep_option_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['keep'] = -int(operand) if op == 'k' else int(operand)
+            keep_option_found = True
+        elif (op == '<' or op == '<=' or op == '>' or op == '>=') and not threshold_option_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['threshold'] = int(operand)
+            option_dict['compare'] = op
+            threshold_option_found = True
+        elif (op == '~<' or op == '~<=' or op == '~>' or op == '~>=') and not fail_threshold_option_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['fail_threshold'] = int(operand)
+            option_dict['fail_compare'] = op
+            fail_threshold_option_found = True
+        elif op == 'cs' or op == 'cf' or op == 'cb' or op == 'cx':
+            operand, option_string = get_operand(option_string)
+            key = {'cs': 'crit', 'cf': 'crit_fail', 'cb': 'b_crit', 'cx': 'c_crit'}[op]
+            try:
+                option_dict[key] = int(operand)
+            except ValueError:
+                option_dict[key] |= rollengine.form_roll_list(operand)
+        elif (op == 'x<' or op == 'x<=' or op == 'x>' or op == 'x>=') and not complication_threshold_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['c_threshold'] = int(operand)
+            option_dict['c_compare'] = op
+            complication_threshold_found = True
+        elif (op == 'b<' or op == 'b<=' or op == 'b>' or op == 'b>=') and not boon_threshold_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['b_threshold'] = int(operand)
+            option_dict['b_compare'] = op
+            boon_threshold_found = True
+        elif op == '==' and not threshold_option_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['threshold'] |= rollengine.form_roll_list(operand)
+            option_dict['compare'] = op
+        elif op == '~=' and not fail_threshold_option_found:
+            operand, option_string = get_operand(option_string)
+            option_dict['fail_threshold'] |= rollengine.form_roll_list(operand)
+            option_dict['fail_compare'] = op
+        elif (op == 'b=' or op == 'x=') and not threshold_option_found:
+            operand, option_string = get_operand(option_string)
+            key = 'b_' if op == 'b=' else 'c_'
+            option_dict[key + 'threshold'] |= rollengine.form_roll_list(operand)
+            option_dict[key + 'compare'] = op
+        elif op == 'min':
+            operand, option_string = get_operand(option_string)
+            min_val = int(operand)
+        elif op == 'max':
+            operand, option_string = get_operand(option_string)
+            max_val = int(operand)
+
+    return option_dict, min_val, max_val
+
+
+def best_of(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def bench(dice_str, repeat):
+    num_dice, dice_type, options_str, dice = rollengine.decode_dice_string(dice_str)
+    times = [
+        best_of(lambda: split_parse_options(dice_str, options_str, dice), repeat),
+        best_of(lambda: rollengine.parse_options(dice_str, options_str, dice), repeat),
+    ]
+    return len(options_str), times
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dice', default=os.path.join(os.path.dirname(rollengine.__file__), 'dice.json'))
+    args = parser.parse_args()
+
+    rollengine.load_dice_types(args.dice)
+    columns = ['before', 'after']
+    print(f'{"expression":<60} {"chars":>5}' + ''.join(f' {column:>9}' for column in columns) + '   (usec)')
+    for dice_str in CASES:
+        length, times = bench(dice_str, args.repeat)
+        print(f'{dice_str[:60]:<60} {length:>5}' + ''.join(f' {seconds * 1e6:>9.2f}' for seconds in times))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,159 @@
+"""
+Benchmark suite for the roll pipeline.
+
+Times every stage a /r goes through for a corpus of representative expressions: compiling the plan (compile_roll,
+skipping the plan cache), rolling it (roll_command), and both formatters. Each stage reports its time per call,
+calls per second and the peak memory one call allocates. Rolls use a seeded RNG so runs see the same dice. Run from
+the repository root:
+
+    python benchmarks/bench_pipeline.py [--repeat N] [--save out.json] [--baseline base.json] [--threshold 0.15]
+
+With --baseline, any stage that got slower than the threshold allows is listed and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tests')]
+
+import _discord_stub  # noqa: E402
+
+_discord_stub.install()
+
+import main  # noqa: E402
+import rollengine  # noqa: E402
+
+CORPUS = [
+    '2dGA+1dGP+2dGD+1dGC',
+    '2dST',
+    '4d6k3',
+    '10d10>=8cs10',
+    '20d6!6r1',
+    '1000d6',
+    '1d20+5 >= 15',
+]
+
+STAGES = ['compile', 'roll', 'format', 'format_full']
+
+
+def stage_calls(expr, rng):
+    equation = rollengine.roll_command(expr, rng=rng)
+    return {
+        'compile': lambda: rollengine.compile_roll(expr),
+        'roll': lambda: rollengine.roll_command(expr, rng=rng),
+        'format': lambda: main.format_response(equation),
+        'format_full': lambda: main.format_response_full(equation),
+    }
+
+
+def peak_bytes(func):
+    # Peak memory traced while one call runs, above what was already held before it
+    func()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {
+        'usec': best * 1e6,
+        'ops_per_sec': 1 / best,
+        'peak_bytes': peak_bytes(func),
+    }
+
+
+def run(repeat, seed, engine):
+    rng = rollengine.make_rng(seed=seed)
+    results = {}
+    for expr in CORPUS:
+        calls = stage_calls(expr, rng)
+        if engine:
+            calls['roll'] = lambda expr=expr: rollengine.roll_command(expr, engine=engine, rng=rng)
+        results[expr] = {stage: measure(calls[stage], repeat) for stage in STAGES}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """(expr, stage, baseline usec, usec) for every stage that got slower by more than threshold"""
+    regressions = []
+    for expr, stages in results.items():
+        for stage, result in stages.items():
+            try:
+                base = baseline[expr][stage]['usec']
+            except KeyError:
+                continue
+            if result['usec'] > base * (1 + threshold):
+                regressions.append((expr, stage, base, result['usec']))
+    return regressions
+
+
+def report(results, baseline=None):
+    header = f'{"expression":<22} {"stage":<12} {"usec":>10} {"ops/sec":>11} {"peak KiB":>9}'
+    print(header + ('   vs base' if baseline else ''))
+    for expr, stages in results.items():
+        for stage, result in stages.items():
+            line = (
+                f'{expr[:22]:<22} {stage:<12} {result["usec"]:>10.2f} {result["ops_per_sec"]:>11.0f}'
+                f' {result["peak_bytes"] / 1024:>9.1f}'
+            )
+            if baseline and stage in baseline.get(expr, {}):
+                line += f'   {result["usec"] / baseline[expr][stage]["usec"] - 1:>+7.1%}'
+            print(line)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=['python', 'numpy', 'counts', 'auto'], default=None)
+    parser.add_argument('--dice', default=os.path.join(os.path.dirname(rollengine.__file__), 'dice.json'))
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file from an earlier --save to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='slowdown allowed before it counts, 0.15 = 15%%')
+    args = parser.parse_args()
+
+    rollengine.load_dice_types(args.dice)
+    results = run(args.repeat, args.seed, args.engine)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': rollengine.np.__version__ if rollengine.np is not None else None,
+                'engine': args.engine or rollengine._dice_engine,
+                'rng': rollengine._rng_backend,
+                'seed': args.seed,
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for expr, stage, base, now in regressions:
+            print(f'REGRESSION {expr} {stage}: {base:.2f} -> {now:.2f} usec')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_()
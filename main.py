@@ -1,1345 +1,672 @@
+import asyncio
 import discord
+import io
 import json
-import random
 import re
+import threading
+import time
 
-from os import environ
-from datetime import datetime
-from typing import Optional, Tuple, List, Dict, Union, Any
-from pprint import pformat, pprint
-from collections import defaultdict, Counter, namedtuple
-
-# FIXME:
-#           4: No support for "repeat"
-#           5: Parentheses? Do these affect only sums?
+from contextvars import ContextVar
 
-_debug = False
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from os import environ, stat
+from datetime import datetime
+from types import MappingProxyType
+from typing import Optional, Tuple, List
+from pprint import pformat
+from collections import namedtuple
+from bisect import bisect_left
+
+# The dice themselves are rolled by rollengine, which imports without discord. This is the bot around it.
+from rollengine import (
+    DiceFileError,
+    DiceRegistry,
+    Equation,
+    ExpressionError,
+    MissingOperandError,
+    ProbResult,
+    RollLimitError,
+    RollResult,
+    RolledExpression,
+    SimResult,
+    UnknownDiceTypeError,
+    UnknownDiceValueError,
+    UnknownOperationError,
+    batch_label,
+    collect_stages,
+    dice_registry,
+    distribution_stats,
+    engine_config,
+    format_rolls_text,
+    init_engine,
+    init_worker,
+    install_dice_registry,
+    join_within,
+    merge_simulation,
+    parse_sim_command,
+    prob_command,
+    program_text,
+    read_dice_registry,
+    record_stage,
+    roll_batch,
+    sim_batch_command,
+)
 
 _sep = '-' * 80
 
+# How often (seconds) the bot checks the dice file for changes, 0 turns reloading off
+_dice_reload_interval = float(environ.get('DICE_RELOAD_INTERVAL', 5.0))
+
+# Rolls are evaluated in a 'thread' or 'process' pool. At most _roll_queue_depth jobs wait or run at once and each one
+# gets _roll_timeout seconds.
+_roll_executor_kind = environ.get('ROLL_EXECUTOR', 'thread')
+_roll_workers = int(environ.get('ROLL_WORKERS', 4))
+_roll_queue_depth = int(environ.get('ROLL_QUEUE_DEPTH', 32))
+_roll_timeout = float(environ.get('ROLL_TIMEOUT', 10.0))
+_roll_executor: Optional[Executor] = None
+_pending_jobs = 0
+
+# Per-stage latency histograms, served as Prometheus text on http://_metrics_host:_metrics_port/metrics. Port 0 turns
+# them off, which leaves a single check of _metrics at each stage.
+_metrics_port = int(environ.get('METRICS_PORT', 0))
+_metrics_host = environ.get('METRICS_HOST', '127.0.0.1')
+
+# Discord's limits on an embed: characters in the title, in one field's value and in the whole embed
+_embed_title_chars = 256
+_embed_field_chars = 1024
+_embed_total_chars = 6000
+# Replies that couldn't show every die also attach them all as a text file, when it's no longer than this. 0 turns
+# attachments off.
+_max_attach_chars = int(environ.get('ROLL_MAX_ATTACH_CHARS', 200000))
+# Seconds between edits of a running /sim reply
+_sim_update_interval = 1.0
+
 client = discord.Client()
-_dice_types: Optional[dict]
+_dice_watcher: Optional[asyncio.Task] = None
+_metrics_server: Optional[asyncio.AbstractServer] = None
 
 comment_pattern = re.compile(
     r'#(?P<comment>.*$)'
 )
 
-simple_numeric_pattern = re.compile(
-    r'^\d+$'
+# A list of dice as a reply prints it, '[ a, b, +N more ]' or a count per face '{ a: 2, b: 1 }'
+dice_list_pattern = re.compile(
+    r'(?P<open>[\[{] )(?P<items>[^\[\]{}\n]*)(?P<close> [\]}])'
 )
 
-# base_roll_string = re.compile(
-#     r'(?P<num_dice>\d+)[dD](?P<dice_type>\d+|[A-Z]+)(?P<options>.*)'
-# )
-
-supported_comparisons = re.compile(
-    r' +(?P<compare><(?!=)|>(?!=)|<=|>=) *(?P<cmp_val>\d+) *$'
-)
+# -------------------------------------------------------------
+#  Actual Discord Bot
+# -------------------------------------------------------------
 
-supported_operators = re.compile(
-    r'([+-])'
-)
+# One term of an equation, as both layouts print it
+RenderedTerm = namedtuple('RenderedTerm', ['name', 'sign', 'history', 'faces', 'sum', 'limit_flag', 'limit_txt'])
 
-_options = r'|'.join(
+# Everything format_response and format_response_full print, worked out in one pass over an equation's rolls
+RenderedEquation = namedtuple(
+    'RenderedEquation',
     [
-        r'r',  # reroll
-        r'k(?!l)',  # keep
-        r'kl',  # keep low
-        r'cs',  # critical success
-        r'cf',  # critical failure
-        r'cb',  # critical boon
-        r'cx',  # critical complication
-        r'!',  # explode
-        r'(?<!~)<(?!=)',  # success-lt
-        r'(?<!~)>(?!=)',  # success-gt
-        r'(?<!~)<=',  # success-lte
-        r'(?<!~)>=',  # success-gte
-        r'(?<!~)==',  # success-eq
-        r'~<(?!=)',  # failure-lt
-        r'~>(?!=)',  # failure-gt
-        r'~<=',  # failure-lte
-        r'~>=',  # failure-gte
-        r'~=',  # failure-eq
-        r'b<(?!=)',  # boon-lt
-        r'b>(?!=)',  # boon-gt
-        r'b<=',  # boon-lte
-        r'b>=',  # boon-gte
-        r'b=',  # boon-eq
-        r'x<(?!=)',  # complication-lt
-        r'x>(?!=)',  # complication-gt
-        r'x<=',  # complication-lte
-        r'x>=',  # complication-gte
-        r'x=',  # complication-eq
-        r'x(?![=<>])',  # natural-complication
-        r'b(?![=<>])',  # natural
-        r'min', # minimum
-        r'max', # maximum
+        'terms',
+        'tally',
+        'sum_exists',
+        'stat_rows',
+        'stat_totals',
+        'max_face_len',
+        'final_compare',
+        'final_compare_val',
+        'shortened',
+        'program',
     ]
 )
 
-option_pattern = re.compile(
-    r'(?P<op>' +
-    _options +
-    r')'
-)
+# Singular and plural names for a net count above and below zero
+_net_names = {
+    'successes': ('Success', 'Successes', 'Failure', 'Failures'),
+    'boons': ('Boon', 'Boons', 'Complication', 'Complications'),
+}
+
+
+def share_chars(wants: List[int], room: int) -> List[int]:
+    """
+    Split room characters between parts that want wants characters each. The smaller parts get all they want and the
+    rest split what's left evenly.
+    """
+    room = max(room, 0)
+    shares = [0] * len(wants)
+    for placed, idx in enumerate(sorted(range(len(wants)), key=wants.__getitem__)):
+        shares[idx] = min(wants[idx], room // (len(wants) - placed))
+        room -= shares[idx]
+    return shares
+
+
+def adds_up(program: tuple) -> bool:
+    # Whether an equation's total is just its terms' sums added together
+    return not any(step in ('*', '/') for step in program)
+
+
+def sums_chars(results: Equation) -> int:
+    # What a reply of results takes besides the dice: the code block, each roll's '  =  -sum limit_txt\n', the total
+    # (with '(a + b) * c  =  ' in front when the terms don't just add up) and the comparison
+    tally = results.tally
+    chars = 8 + len(f'{tally.sum}\n')
+    if not adds_up(results.program):
+        chars += len(program_text(results.program, [f'{roll.sum}' for roll in results.rolls])) + 5
+    if results.final_compare is not None:
+        chars += len(f'{tally.sum} {results.final_compare} {results.final_compare_val} : SUCCESS\n')
+    return chars + sum(len(str(roll.sum)) + len(roll.limit_txt) + 9 for roll in results.rolls)
+
+
+def equation_chars(results: Equation, history: bool = True) -> int:
+    """
+    Characters a reply of results takes with every die shown, the dice as first rolled too with history.
+    """
+    return sums_chars(results) + sum(
+        roll.faces_chars() + (roll.history_chars() if history else 0) for roll in results.rolls
+    )
 
-operand_pattern = re.compile(
-     r'''^((?:(?:\d+|(?:['"])\w+(?:['"])),?)*)'''
-)
 
-# -------------------------------------------------------------
-#  Dice Roll Class
-# -------------------------------------------------------------
+def render_equation(results: Equation, limit: Optional[int] = None, history: bool = True) -> RenderedEquation:
+    """
+    Walk the rolls once and collect the text and counts either layout needs. With a limit, the dice of every roll
+    together with the sums fit in one field of that many characters, anything bigger is shortened. Without history
+    the dice as first rolled aren't shown, so they get no room and no text.
+    """
+    rolls = results.rolls
+    tally = results.tally
+    limits = [(None, None)] * len(rolls)
+    shortened = False
+    if limit is not None:
+        # What's left for the dice once the code block, the sums and the total are in
+        room = limit - sums_chars(results)
+
+        # Sizing a roll exactly takes a pass over its dice, so that only happens when the bound says it might not fit
+        if sum(roll.chars_bound() for roll in rolls) > room:
+            wants = [(roll.history_chars() if history else 0, roll.faces_chars()) for roll in rolls]
+            shares = share_chars([history_want + faces for history_want, faces in wants], room)
+            limits = [share_chars(want, share) for want, share in zip(wants, shares)]
+            shortened = any(sum(want) > share for want, share in zip(wants, shares))
+
+    terms = []
+    sum_exists = False
+    for op, roll, (history_limit, faces_limit) in zip(results.ops, rolls, limits):
+        roll_sum = roll.sum
+        sum_exists |= roll_sum is not None
+        terms.append(RenderedTerm(
+            roll.roll_name,
+            op.replace('+', ''),
+            roll.format_history(history_limit) if history else None,
+            roll.format_faces(faces_limit),
+            roll_sum,
+            roll.limit_flag,
+            roll.limit_txt,
+        ))
+
+    stat_rows = []
+    stat_totals = {}
+    for idx, counter in tally.counters or ():
+        face_names = rolls[idx].face_names
+        rollname = f'{rolls[idx].num_dice}d{rolls[idx].dice_type}'
+        for face, count in counter.items():
+            # Faces that only appear in the map (FATE's + and -) print as themselves
+            face_name = face_names.get(face) or str(face)
+            stat_rows.append((rollname, face_name, count))
+            stat_totals[face_name] = stat_totals.get(face_name, 0) + count
+            rollname = ''
+    name_len = max(map(len, stat_totals), default=0)
+
+    return RenderedEquation(
+        terms,
+        tally,
+        sum_exists,
+        stat_rows,
+        stat_totals,
+        max(name_len + 1, 10),
+        results.final_compare,
+        results.final_compare_val,
+        shortened,
+        results.program,
+    )
 
-RollResult = namedtuple('RollResult', ['total', 'map'])
-
-
-class Equation:
-    def __init__(self, original_eq_str=''):
-        self.original_equation_str = original_eq_str
-        self.rolls: List[DiceRoll] = []
-        self.ops = []
-        self.final_compare = None
-        self.final_compare_val = None
-
-    @property
-    def limit_flag(self):
-        flag = False
-        for roll in self.rolls:
-            # FIXME - Flag doesn't exist until sum is calculated at least once
-            if roll.sum is not None:
-                flag |= roll.limit_flag
-        return flag
-
-    @property
-    def counters(self):
-        counters = []
-        for idx, roll in enumerate(self.rolls):
-            if non_empty := roll.counter:
-                counters.append((idx, non_empty))
-
-        return counters if counters else None
-
-    @property
-    def sum(self):
-        total_sum = 0
-        sum_exists = False
-        for op, roll in zip(self.ops, self.rolls):
-            sum_exists |= roll.sum is not None
-            if op == '+':
-                total_sum += roll.sum if roll.sum else 0
-            elif op == '-':
-                total_sum -= roll.sum if roll.sum else 0
-            else:
-                raise UnknownOperationError(op, f'Used before {roll.dice_str}')
-
-        return total_sum
-
-    @property
-    def successes(self):
-        total_successes = 0
-        success_list = []
-        valid = False
-
-        for idx, roll in enumerate(self.rolls):
-            try:
-                total_successes += roll.successes
-                success_list.append((idx, roll.successes))
-                valid |= True
-            except TypeError:
-                pass
-
-        result = RollResult(
-            total=total_successes,
-            map=success_list,
-        )
 
-        return result if valid else None
-
-    @property
-    def failures(self):
-        total_failures = 0
-        failure_list = []
-        valid = False
-
-        for idx, roll in enumerate(self.rolls):
-            try:
-                total_failures += roll.failures
-                failure_list.append((idx, roll.failures))
-                valid |= True
-            except TypeError:
-                pass
-
-        result = RollResult(
-            total=total_failures,
-            map=failure_list,
-        )
+def net_count(gain: RollResult, loss: RollResult, kind: str):
+    """
+    Net of a counter pair and its name, '' when they cancel out.
+    """
+    net = (gain.total if gain else 0) - (loss.total if loss else 0)
+    if net == 0:
+        return net, ''
+    singular, plural, loss_singular, loss_plural = _net_names[kind]
+    if net > 0:
+        return net, singular if net == 1 else plural
+    return net, loss_singular if net == -1 else loss_plural
+
+
+def _compare_word(result: bool) -> str:
+    return 'SUCCESS' if result else 'FAIL'
+
+
+def _stats_rows(rendered: RenderedEquation, total_name: str, line: str) -> List[str]:
+    width = rendered.max_face_len
+    lines = ['```\n']
+    lines.extend(f'{rollname:<8} {face_name:<{width}} {count}\n' for rollname, face_name, count in rendered.stat_rows)
+    if len(rendered.terms) > 1:
+        rollname = total_name
+        for face_name, count in rendered.stat_totals.items():
+            lines.append(line.format(f'{rollname:<8} {face_name:<{width}} {count}'))
+            rollname = ''
+    lines.append('```')
+    return lines
+
+
+def total_text(rendered: RenderedEquation) -> str:
+    """
+    The total, worked out from the terms' sums when they don't simply add up to it, like '(5 + 2) * 3  =  21'.
+    """
+    total = f'{rendered.tally.sum}'
+    if adds_up(rendered.program):
+        return total
+    sums = [f'{term.sum}' if term.sum is not None else term.faces for term in rendered.terms]
+    return f'{program_text(rendered.program, sums)}  =  {total}'
+
+
+def compact_layout(rendered: RenderedEquation):
+    """
+    (embed dict, fields) for the short /r reply.
+    """
+    tally = rendered.tally
+    multi = len(rendered.terms) > 1
+    compare = tally.final_compare_result
+    fields = []
 
-        return result if valid else None
-
-    @property
-    def boons(self):
-        total_boons = 0
-        boon_list = []
-        valid = False
-
-        for idx, roll in enumerate(self.rolls):
-            try:
-                total_boons += roll.boons
-                boon_list.append((idx, roll.boons))
-                valid |= True
-            except TypeError:
-                pass
-
-        result = RollResult(
-            total=total_boons,
-            map=boon_list,
-        )
+    skip_sum = False
+    result_lines = []
+    for gain, loss, kind in ((tally.successes, tally.failures, 'successes'),
+                             (tally.boons, tally.complications, 'boons')):
+        if gain or loss:
+            skip_sum = True
+            net, net_name = net_count(gain, loss, kind)
+            if net_name:
+                result_lines.append(f'{abs(net)} {net_name}\n')
+
+    dice_lines = ['```\n']
+    roll_lines = ['```']
+    for term in rendered.terms:
+        sum_str = f'  =  {term.sign}{term.sum}' if (not skip_sum and term.sum is not None) else ''
+        if term.limit_flag:
+            sum_str += f' {term.limit_txt}'
+        dice_lines.append(f'{term.name}\n')
+        if term.history is not None:
+            dice_lines.append('\n')
+            roll_lines.append(f'{term.history}\n')
+        roll_lines.append(f'{term.faces}{sum_str}\n')
 
-        return result if valid else None
-
-    @property
-    def complications(self):
-        total_complications = 0
-        complication_list = []
-        valid = False
-
-        for idx, roll in enumerate(self.rolls):
-            try:
-                total_complications += roll.complications
-                complication_list.append((idx, roll.complications))
-                valid |= True
-            except TypeError:
-                pass
-
-        result = RollResult(
-            total=total_complications,
-            map=complication_list,
+    # Skip sums when there are no sums...
+    skip_sum = (skip_sum or not rendered.sum_exists) and compare is None
+    if multi and not skip_sum:
+        dice_lines.append('TOTAL\n')
+        roll_lines.append(f'{total_text(rendered)}\n')
+        if compare is not None:
+            dice_lines.append(f'{tally.sum} {rendered.final_compare} {rendered.final_compare_val}\n')
+            roll_lines.append(_compare_word(compare))
+    dice_lines.append('```')
+
+    if multi:
+        fields.append(('Dice', ''.join(dice_lines), True))
+    elif compare is not None:
+        roll_lines.append(
+            f'{tally.sum} {rendered.final_compare} {rendered.final_compare_val} : {_compare_word(compare)}\n'
         )
+    roll_lines.append('```')
+    fields.append(('Rolls', ''.join(roll_lines), True))
 
-        return result if valid else None
-
-    @property
-    def final_compare_result(self):
-        result = None
-        if self.final_compare is not None and self.final_compare_val is not None:
-            if self.final_compare == '<':
-                result = self.sum < self.final_compare_val
-            elif self.final_compare == '>':
-                result = self.sum > self.final_compare_val
-            elif self.final_compare == '<=':
-                result = self.sum <= self.final_compare_val
-            elif self.final_compare == '>=':
-                result = self.sum >= self.final_compare_val
-        return result
-
-    def get_print_dict(self):
-        print_dict = {
-            'Total Sum': self.sum,
-            'Rolls': [x.get_print_dict() for x in self.rolls],
-            'Successes': self.successes,
-            'Boons': self.boons,
-        }
-        return print_dict
-
-    def __repr__(self):
-        print_dict = self.get_print_dict()
-        return pformat(print_dict, indent=2)
-
-
-class DiceRoll:
-    def __init__(self, dice_str):
-        # Store Dice String
-        self.dice_str = dice_str
-
-        # Prep independent attributes we'll need
-        self.num_dice = 1
-        self.dice_type = '1'
-        self.roll_options_str = ''
-        self.default_cmp = '>='
-
-        # Setup dependent attributes
-        self.sides = 0
-        self.map = {}
-        self.face_names = {}
-        self.map_values = {}
-
-        self.successes = None
-        self.failures = None
-
-        self.complications = None
-        self.boons = None
-
-        self.natural_success = None
-        self.natural_success_compare = None
-
-        self.natural_fail = None
-        self.natural_fail_compare = None
-
-        self.natural_complication = None
-        self.natural_c_compare = None
-
-        self.natural_boon = None
-        self.natural_b_compare = None
-
-        self.natural_cs = None
-
-        self.natural_cf = None
-
-        self.min = None
-        self.max = None
-        self.limit_flag = False
-        self.limit_txt = ''
-
-        self._roll_history = []
-
-        # Do the initial property decode num_dice, dice_type, and roll_options
-        # It also applies the map and and values
-        self._decode_dice_string()
-
-        # Now roll
-        self.rolls = roll_dice(self.sides, self.num_dice)
-
-        if _debug:
-            print(self.rolls)
-            print(self.faces)
-            print(self.values)
-            print(self.sum)
-
-        # Do Options
-        self._parse_options()
-
-    @property
-    def roll_history(self):
-        return self._roll_history[0] if self._roll_history else None
-
-    def push_history(self):
-        self._roll_history.append(self.rolls[:])
-
-    @property
-    def roll_name(self):
-        return f'{self.num_dice}d{self.dice_type}' if self.dice_type != '1' else f'{self.map[0]}'
-
-    @property
-    def faces(self):
-        return [self.map[roll] for roll in self.rolls]
-
-    @property
-    def values(self):
-        values = []
-        for roll in self.rolls:
-            try:
-                values.append(self.map_values[self.map[roll]])
-            except KeyError:
-                try:
-                    values.append(int(self.map[roll]))
-                except ValueError:
-                    values = None
-                    break
-        return values
-
-    @property
-    def sum(self):
-        rsum = None
-        if self.values:
-            rsum = sum(self.values)
-            if self.min and (rsum < self.min):
-                rsum = self.min
-                self.limit_flag = True
-                self.limit_txt = '(min)'
-            elif self.max and (rsum > self.max):
-                rsum = self.max
-                self.limit_flag = True
-                self.limit_txt = '(max)'
-        return rsum
-
-    @property
-    def counter(self):
-        interesting_list = [r for r in self.faces if r in self.map_values.keys() or r in self.face_names.keys()]
-        return Counter(interesting_list) if interesting_list else None
-
-    def _decode_dice_string(self):
-        dice_info: Dict[str, Any]
-        if self.dice_str == '':
-            # If doing nothing, result will be zero anyways
-            dice_info = {
-                'map': [0],
-            }
-        elif num_match := simple_numeric_pattern.match(self.dice_str):
-            dice_info = {
-                'map': [int(num_match.group())],
-            }
-        else:
-            roll_match = base_roll_string.match(self.dice_str)
-            try:
-                self.num_dice = int(roll_match.group('num_dice'))
-                self.dice_type = roll_match.group('dice_type')
-                self.roll_options_str = roll_match.group('options')
-            except AttributeError:
-                raise UnknownDiceTypeError(self.dice_str)
-
-            if _debug:
-                print(f'Roll Options: {self.roll_options_str}')
-
-            try:
-                dice_info = _dice_types[self.dice_type.upper()]
-            except KeyError:
-                simple_dice_match = simple_numeric_pattern.match(self.dice_type)
-                # If it can, do it, otherwise try to load the dice info
-                if simple_dice_match:
-                    dice_info = {
-                        'sides': int(simple_dice_match.group()),
-                    }
-                    if dice_info['sides'] < 1:
-                        raise UnknownDiceTypeError(self.dice_type, "Illegal numeric dice!")
-                else:
-                    raise UnknownDiceTypeError(self.dice_type)
-
-        dice_map = dice_info['map'] if 'map' in dice_info else range(1, int(dice_info['sides']) + 1)
-        self.map = [str(entry) for entry in dice_map]
-        self.face_names = dice_info['names'] if 'names' in dice_info else {}
-        self.sides = dice_info['sides'] if 'sides' in dice_info else len(self.map)
-        self.map_values = dice_info['value'] if 'value' in dice_info else {}
-
-        self.natural_success = dice_info['success'] if 'success' in dice_info else None
-        self.natural_success_compare = '=' + dice_info['success_op'] if 'success_op' in dice_info else None
-
-        self.natural_fail = dice_info['fail'] if 'fail' in dice_info else None
-        self.natural_fail_compare = '~' + dice_info['fail_op'] if 'fail_op' in dice_info else None
-
-        self.natural_complication = dice_info['complication'] if 'complication' in dice_info else None
-        self.natural_c_compare = 'x' + dice_info['complication_op'] if 'complication_op' in dice_info else None
-
-        self.natural_boon = dice_info['boon'] if 'boon' in dice_info else None
-        self.natural_b_compare = 'b' + dice_info['boon_op'] if 'boon_op' in dice_info else None
-
-        self.natural_cs = dice_info['crit_success'] if 'crit_success' in dice_info else None
-        self.natural_cf = dice_info['crit_fail'] if 'crit_fail' in dice_info else None
-        self.natural_cb = dice_info['crit_boon'] if 'crit_boon' in dice_info else None
-        self.natural_cc = dice_info['crit_complication'] if 'crit_complication' in dice_info else None
-
-    def _parse_options(self):
-        option_dict: Dict[str, Union[str, int, set]]
-        option_dict = defaultdict(set)
-
-        option_string = self.roll_options_str[:]
-
-        keep_option_found = False
-        threshold_option_found = False
-        fail_threshold_option_found = False
-
-        boon_threshold_found = False
-        complication_threshold_found = False
-
-        # ------------------------------
-        #  Preset Natural Options
-        # ------------------------------
-        if self.natural_success:
-            self.successes = 0
-            option_dict['threshold'] = self.natural_success
-            option_dict['compare'] = self.natural_success_compare
-        if self.natural_cs:
-            option_dict['crit'] = self.natural_cs
-        if self.natural_fail:
-            self.failures = 0
-            option_dict['fail_threshold'] = self.natural_fail
-            option_dict['fail_compare'] = self.natural_fail_compare
-        if self.natural_cf:
-            option_dict['crit_fail'] = self.natural_cf
-        if self.natural_boon:
-            self.boons = 0
-            option_dict['b_threshold'] = self.natural_boon
-            option_dict['b_compare'] = self.natural_b_compare
-        if self.natural_cb:
-            option_dict['b_crit'] = self.natural_cb
-        if self.natural_complication:
-            self.complications = 0
-            option_dict['c_threshold'] = self.natural_complication
-            option_dict['c_compare'] = self.natural_c_compare
-        if self.natural_cc:
-            option_dict['c_crit'] = self.natural_cc
-
-        if _debug:
-            print(f'Parsing {option_string}')
-
-        while option_string:
-            # Note: _ had better be empty....
-            # print(option_string)
-            try:
-                _, op, option_string = option_pattern.split(option_string, 1)
-            except ValueError:
-                raise UnknownOperationError(option_string)
-
-            if _debug:
-                print(f'Option {op}')
-
-            # ------------------------------
-            #  First Parse Options
-            # ------------------------------
-            # Parsing first because the order of options may be important. Like for example, if I say 2d20!r1
-            # I'm saying roll 2d20, explode (on 20), re-roll 1's. But do the re-rolls explode? Do the explodes re-roll?
-            #
-            # Note: This would be best replaced with a match-pattern when 3.10 becomes available
-            if op == '!':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Explode', f'Used in {self.dice_str}')
-                try:
-                    option_dict['explode'].add(str(int(operand)))
-                except ValueError:
-                    option_dict['explode'] |= form_face_roll_list(operand)
-            elif op == 'r':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Reroll', f'Used in {self.dice_str}')
-                try:
-                    option_dict['reroll'].add(str(int(operand)))
-                except ValueError:
-                    option_dict['reroll'] |= form_face_roll_list(operand)
-            elif op == 'k' and not keep_option_found:
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Keep', f'Used in {self.dice_str}')
-                option_dict['keep'] = - int(operand)
-                keep_option_found = True
-            elif op == 'kl' and not keep_option_found:
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('KeepLowest', f'Used in {self.dice_str}')
-                option_dict['keep'] = int(operand)
-                keep_option_found = True
-            elif (op == '<' or op == '<=' or op == '>' or op == '>=') and not threshold_option_found:
-                operand, option_string = get_operand(option_string)
-                # Prep the success counter
-                self.successes = 0
-                if operand is None:
-                    raise MissingOperandError('Compare', f'Used in {self.dice_str}')
-                option_dict['threshold'] = int(operand)
-                option_dict['compare'] = op
-                threshold_option_found = True
-            elif (
-                    op == '~<' or op == '~<=' or op == '~>' or op == '~>=') \
-                    and not fail_threshold_option_found:
-                operand, option_string = get_operand(option_string)
-                # Prep the success counter
-                self.failures = 0
-                if operand is None:
-                    raise MissingOperandError('Compare', f'Used in {self.dice_str}')
-                option_dict['fail_threshold'] = int(operand)
-                option_dict['fail_compare'] = op
-                threshold_option_found = True
-            elif op == 'cs':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Critical Success', f'Used in {self.dice_str}')
-                try:
-                    option_dict['crit'] = int(operand)
-                except ValueError:
-                    option_dict['crit'] |= form_roll_list(operand)
-            elif op == 'cf':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('CriticalFailure', f'Used in {self.dice_str}')
-                try:
-                    option_dict['crit_fail'] = int(operand)
-                except ValueError:
-                    option_dict['crit_fail'] |= form_roll_list(operand)
-            elif op == 'cb':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('CriticalBoon', f'Used in {self.dice_str}')
-                try:
-                    option_dict['b_crit'] = int(operand)
-                except ValueError:
-                    option_dict['b_crit'] |= form_roll_list(operand)
-            elif op == 'cx':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('CriticalComplication', f'Used in {self.dice_str}')
-                try:
-                    option_dict['c_crit'] = int(operand)
-                except ValueError:
-                    option_dict['c_crit'] |= form_roll_list(operand)
-            elif (op == 'x<' or op == 'x<=' or op == 'x>' or op == 'x>=') and \
-                    not complication_threshold_found:
-                operand, option_string = get_operand(option_string)
-                # Prep the success counter
-                self.complications = 0
-                if operand is None:
-                    raise MissingOperandError('Compare', f'Used in {self.dice_str}')
-                option_dict['c_threshold'] = int(operand)
-                option_dict['c_compare'] = op
-                complication_threshold_found = True
-            elif (op == 'b<' or op == 'b<=' or op == 'b>' or op == 'b>=') and \
-                    not boon_threshold_found:
-                operand, option_string = get_operand(option_string)
-                # Prep the success counter
-                self.boons = 0
-                if operand is None:
-                    raise MissingOperandError('Compare', f'Used in {self.dice_str}')
-                option_dict['b_threshold'] = int(operand)
-                option_dict['b_compare'] = op
-                boon_threshold_found = True
-            elif op == 'x' and not complication_threshold_found:
-                self.complications = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Complication', f'Used in {self.dice_str}')
-                option_dict['c_threshold'] = int(operand)
-                option_dict['c_compare'] = self.natural_c_compare
-            elif op == 'b' and not boon_threshold_found:
-                self.boons = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Boon', f'Used in {self.dice_str}')
-                option_dict['b_threshold'] = int(operand)
-                option_dict['b_compare'] = self.natural_c_compare
-            elif op == '==' and not threshold_option_found:
-                self.successes = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Success', f'Used in {self.dice_str}')
-                option_dict['threshold'] |= form_roll_list(operand)
-                option_dict['compare'] = op
-            elif op == '~=' and not fail_threshold_option_found:
-                self.failures = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Failure', f'Used in {self.dice_str}')
-                option_dict['fail_threshold'] |= form_roll_list(operand)
-                option_dict['fail_compare'] = op
-            elif op == 'b=' and not threshold_option_found:
-                self.boons = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Boon', f'Used in {self.dice_str}')
-                option_dict['b_threshold'] |= form_roll_list(operand)
-                option_dict['b_compare'] = op
-            elif op == 'x=' and not threshold_option_found:
-                self.complications = 0
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Complication', f'Used in {self.dice_str}')
-                option_dict['c_threshold'] |= form_roll_list(operand)
-                option_dict['c_compare'] = op
-            elif op == 'min':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Complication', f'Used in {self.dice_str}')
-                self.min = int(operand)
-            elif op == 'max':
-                operand, option_string = get_operand(option_string)
-                if operand is None:
-                    raise MissingOperandError('Complication', f'Used in {self.dice_str}')
-                self.max = int(operand)
-
-        if _debug:
-            pprint(option_dict, indent=2)
-
-        self._resolve_options(option_dict)
-
-    def _resolve_options(self, option_dict: dict):
-
-        # Reroll any initial dice
-        for idx, face in enumerate(self.faces):
-            if face in option_dict['reroll']:
-                self.push_history()
-                self.reroll(idx)
-                if _debug:
-                    print(f'Rerolled #{idx}: {self.rolls[idx]}')
-
-        # Iteratively explode and reroll as necessary
-        _iter = 0
-        face_list = list(self.faces)
-        while face_list:
-            _iter += 1
-            assert _iter < 100, "ERROR: Iteration limit reached!"
-            c = Counter(face_list)
-            if _debug:
-                pprint(c)
-            new_rolls = []
-            # Explode dice
-            for exp_dice in option_dict['explode']:
-                if _debug:
-                    print(f'Trying to explode {exp_dice}: x{c[exp_dice]}')
-                new_rolls.extend(roll_dice(self.sides, c[exp_dice]))
-
-            new_face_list = [self.map[roll] for roll in new_rolls]
-
-            if _debug:
-                print(new_face_list)
-
-            if new_face_list:
-                self.push_history()
-
-            if _debug:
-                print(f'New Rolls: {new_rolls}')
-                print(f'New Faces: {new_face_list}')
-
-            # Reroll them if needed
-            for idx, face in enumerate(new_face_list):
-                if face in option_dict['reroll']:
-                    self.push_history()
-                    reroll_dice(new_rolls, idx, self.sides)
-                    if _debug:
-                        print(f'Rerolled #{idx}: {new_rolls[idx]}')
-
-            # Append the new rolls
-            self.rolls.extend(new_rolls)
-            face_list = [self.map[roll] for roll in new_rolls]
-
-        # Now do "final roll" operations like keep
-        if 'keep' in option_dict:
-            self.push_history()
-            keep_num = option_dict['keep']
-            self.rolls.sort()
-            if keep_num > 0:
-                self.rolls = self.rolls[:keep_num]
-            elif keep_num < 0:
-                self.rolls = self.rolls[keep_num:]
-            else:
-                self.rolls = []
-
-        # Now calculate results
-        if 'threshold' in option_dict:
-            thresh = option_dict['threshold']
-            op = option_dict['compare']
-            dub_val = option_dict['crit'] if 'crit' in option_dict else None
-            for face in self.faces:
-                if op == '==':
-                    mul = 1 + int(face in dub_val) if dub_val is not None else 1
-                    self.successes += int(face in thresh) * mul
-                else:
-                    try:
-                        val = self.map_values[face]
-                    except KeyError:
-                        val = int(face)
-                    if op == '<':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.successes += int(val < thresh) * mul
-                    elif op == '>':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.successes += int(val > thresh) * mul
-                    elif op == '<=':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.successes += int(val <= thresh) * mul
-                    elif op == '>=':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.successes += int(val >= thresh) * mul
-
-        # Now calculate results
-        if 'fail_threshold' in option_dict:
-            thresh = option_dict['fail_threshold']
-            op = option_dict['fail_compare']
-            dub_val = option_dict['crit_fail'] if 'crit_fail' in option_dict else None
-            for face in self.faces:
-                if op == '~=':
-                    mul = 1 + int(face in dub_val) if dub_val is not None else 1
-                    self.failures += int(face in thresh) * mul
-                else:
-                    try:
-                        val = self.map_values[face]
-                    except KeyError:
-                        val = int(face)
-                    if op == '~<':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.failures += int(val < thresh) * mul
-                    elif op == '~>':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.failures += int(val > thresh) * mul
-                    elif op == '~<=':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.failures += int(val <= thresh) * mul
-                    elif op == '~>=':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.failures += int(val >= thresh) * mul
-
-        # Now calculate complications
-        if 'c_threshold' in option_dict:
-            thresh = option_dict['c_threshold']
-            op = option_dict['c_compare']
-            dub_val = option_dict['c_crit'] if 'c_crit' in option_dict else None
-            for face in self.faces:
-                if op == 'x=':
-                    mul = 1 + int(face in dub_val) if dub_val is not None else 1
-                    self.complications += int(face in thresh) * mul
-                else:
-                    try:
-                        val = self.map_values[face]
-                    except KeyError:
-                        val = int(face)
-                    if op == 'x<':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.complications += int(val < thresh) * mul
-                    elif op == 'x>':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.complications += int(val > thresh) * mul
-                    elif op == 'x<=':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.complications += int(val <= thresh) * mul
-                    elif op == 'x>=':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.complications += int(val >= thresh) * mul
-
-        # Now calculate boons
-        if 'b_threshold' in option_dict:
-            thresh = option_dict['b_threshold']
-            op = option_dict['b_compare']
-            dub_val = option_dict['b_crit'] if 'b_crit' in option_dict else None
-            for face in self.faces:
-                if op == 'b=':
-                    mul = 1 + int(face in dub_val) if dub_val is not None else 1
-                    self.boons += int(face in thresh) * mul
-                else:
-                    try:
-                        val = self.map_values[face]
-                    except KeyError:
-                        val = int(face)
-                    if op == 'b<':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.boons += int(val < thresh) * mul
-                    elif op == 'b>':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.boons += int(val > thresh) * mul
-                    elif op == 'b<=':
-                        mul = 1 + int(val <= dub_val) if dub_val is not None else 1
-                        self.boons += int(val <= thresh) * mul
-                    elif op == 'b>=':
-                        mul = 1 + int(val >= dub_val) if dub_val is not None else 1
-                        self.boons += int(val >= thresh) * mul
-
-    def reroll(self, idx):
-        self.rolls[idx] = random.randint(0, self.sides - 1)
-
-    def get_print_dict(self):
-        face_list = list(self.faces)
-        print_dict = {
-            'Dice String': self.dice_str,
-            'Faces': face_list,
-            'Rolls': list(self.rolls),
-            'Counts': dict(Counter(face_list)),
-            'Sum': self.sum,
-        }
-
-        if self.successes is not None:
-            print_dict['Successes'] = self.successes
-
-        if self.failures is not None:
-            print_dict['Failures'] = self.failures
-
-        if self.complications is not None:
-            print_dict['Complications'] = self.complications
-
-        if self.boons is not None:
-            print_dict['Boons'] = self.boons
-
-        return print_dict
-
-    def __repr__(self):
-        print_dict = self.get_print_dict()
-
-        return pformat(print_dict, width=80, indent=2)
-
-
-# -------------------------------------------------------------
-#  Exceptions
-# -------------------------------------------------------------
-
-class UnknownDiceTypeError(Exception):
-    def __init__(self, dice_type: str, message: str = ''):
-        self.dice_type = dice_type
-        self.message = message
-        super().__init__(self.message)
-
-    def __str__(self):
-        return f'{self.dice_type} is undefined. {self.message}'
-
-
-class UnknownDiceValueError(UnknownDiceTypeError):
-    def __init__(self, dice_type: str, dice_roll: Union[int, str], message: str = ''):
-        self.dice_roll = dice_roll
-        super().__init__(dice_type, message)
-
-    def __str__(self):
-        return f'{self.dice_roll} has no value in {self.dice_type}. {self.message}'
-
-
-class UnknownOperationError(Exception):
-    def __init__(self, op: str, message: str = ''):
-        self.op = op
-        self.message = message
-        super().__init__(self.message)
-
-    def __str__(self):
-        return f'{self.op} is not a supported operation. {self.message}'
-
-
-class MissingOperandError(Exception):
-    def __init__(self, op: str, message: str = ''):
-        self.op = op
-        self.message = message
-        super().__init__(self.message)
-
-    def __str__(self):
-        return f'{self.op} requires an operand. {self.message}'
-
-
-# -------------------------------------------------------------
-#  Rolling Functions
-# -------------------------------------------------------------
-
-def form_roll_list(operand_str):
-    operand_set = set()
-    operand_str_list = operand_str.split(',')
-    for op in operand_str_list:
-        try:
-            operand_set.add(int(op))
-        except ValueError:
-            operand_set.add(op)
-
-    return operand_set
-
-
-def form_face_roll_list(operand_str):
-    operand_set = set(operand_str.split(','))
-    return operand_set
-
-
-def get_operand(option_string: str) -> Tuple[str, str]:
-    _, operand, option_string = operand_pattern.split(option_string, 1)
-    # Toss quotes
-    operand = operand.replace("'", '').replace('"', '')
-    return operand, option_string
-
-
-def roll_dice(sides: int, num_dice: int):
-    return [random.randint(0, sides - 1) for x in range(num_dice)]
-
-
-def reroll_dice(roll_list, idx, sides):
-    roll_list[idx] = random.randint(0, sides - 1)
-
-
-def roll_command(command_str: str):
-    cmp_op = None
-    cmp_val = None
-    # Find the one comparison operator supported
-    try:
-        command_str, cmp_op, cmp_val, _ = supported_comparisons.split(command_str, 1)
-    except ValueError:
-        pass
-
-    # Find the math parts
-    math_strings = [x.strip() for x in supported_operators.split(command_str)]
-    dice_strings = math_strings[::2]
-    operator_strings = math_strings[1::2]
-    # Fix the zero'th entry to be a sum, which aligns the entries
-    operator_strings.insert(0, '+')
-
-    # Create the Equation that will do the math
-    equation = Equation(command_str)
-    equation.ops = operator_strings
-    equation.final_compare = cmp_op
-    equation.final_compare_val = int(cmp_val) if cmp_val else None
-
-    equation.rolls = []
-
-    # Creating the roll objects actually rolls the dice
-    for dice_str in dice_strings:
-        dice_roll_obj = DiceRoll(dice_str)
-        equation.rolls.append(dice_roll_obj)
-
-    return equation
-
+    # COUNTER SECTION
+    if rendered.stat_rows:
+        msg = ''.join(_stats_rows(rendered, 'TOTAL', '{}\n'))
+        if engine_config().debug:
+            print(msg)
+        fields.append(('Roll Stats', msg, False))
 
-# -------------------------------------------------------------
-#  Actual Discord Bot
-# -------------------------------------------------------------
+    if result_lines:
+        fields.append(('Results', ''.join(['```\n', *result_lines, '```']), False))
 
-def format_response(results: Equation):
     embed_dict = {
         # 'title': 'Roll Result',
         'type': 'rich',
         'color': 3249376,
         # 'timestamp': str(datetime.now()),
     }
+    return embed_dict, fields
+
+
+def _tally_section(rendered: RenderedEquation, gain: RollResult, loss: RollResult, kind: str, close: str):
+    # Type / Roll / Value columns for a counter pair, listing each term that counted and the net
+    multi = len(rendered.terms) > 1
+    type_lines, roll_lines, value_lines = ['```\n'], ['```\n'], ['```\n']
+    for result, title in ((gain, _net_names[kind][1]), (loss, _net_names[kind][3])):
+        if not result:
+            continue
+        type_lines.append(title)
+        for idx, val in result.map:
+            type_lines.append('\n')
+            roll_lines.append(f'{rendered.terms[idx].name}\n')
+            value_lines.append(f'{val}\n')
+        if not result.map:
+            type_lines.append('\n')
+            roll_lines.append('\n')
+            value_lines.append('0\n')
+        if multi:
+            type_lines.append('\n\n')
+            roll_lines.append('Subtotal\n\n')
+            value_lines.append(f'{result.total}\n\n')
+
+    net, net_name = net_count(gain, loss, kind)
+    type_lines.append('TOTAL')
+    value_lines.append(f'{abs(net)} {net_name}')
+    return [
+        ('Type', ''.join(type_lines) + close, True),
+        ('Roll', ''.join(roll_lines) + close, True),
+        ('Value', ''.join(value_lines) + close, True),
+    ]
 
-    embed = discord.Embed.from_dict(embed_dict)
+
+def full_layout(rendered: RenderedEquation):
+    """
+    (embed dict, fields) for the /rf reply.
+    """
+    tally = rendered.tally
+    multi = len(rendered.terms) > 1
+    compare = tally.final_compare_result
 
     skip_sum = False
 
-    sfbc_str = ''
-    sf_flag = False
-    bc_flag = False
-    sf_net = 0
-    bc_net = 0
-
-    if successes := results.successes:
-        sf_flag = True
-        sf_net += successes.total
-
-    if failures := results.failures:
-        sf_flag = True
-        sf_net -= failures.total
-
-    if boons := results.boons:
-        bc_flag = True
-        bc_net += boons.total
-
-    if complications := results.complications:
-        bc_flag = True
-        bc_net -= complications.total
-
-    if sf_flag or bc_flag:
-        skip_sum = True
-        if sf_flag:
-            abs_result = abs(sf_net)
-            if sf_net == 0:
-                sf_type = ''
-            elif sf_net > 0:
-                sf_type = 'Success' if sf_net == 1 else 'Successes'
-            else:
-                sf_type = 'Failure' if sf_net == -1 else 'Failures'
-            if sf_type:
-                sfbc_str += f'{abs_result} {sf_type}\n'
-
-        if bc_flag:
-            abs_result = abs(bc_net)
-            if bc_net == 0:
-                bc_type = ''
-            elif bc_net > 0:
-                bc_type = 'Boon' if bc_net == 1 else 'Boons'
-            else:
-                bc_type = 'Complication' if bc_net == -1 else 'Complications'
-            if bc_type:
-                sfbc_str += f'{abs_result} {bc_type}\n'
-
-    rolls_str = '```\n'
-    msg2 = '```'
-
-    long_rolls_flag = False
-    sum_exists_flag = False
-    for idx, rolls in enumerate(results.rolls):
-        sign = results.ops[idx].replace('+', '')
-        sum_exists_flag |= rolls.sum is not None
-        sum_str = f'  =  {sign}{rolls.sum}' if (not skip_sum and rolls.sum is not None) else ''
-        if rolls.limit_flag:
-            sum_str += f' {rolls.limit_txt}'
-        rolls_str += f'{rolls.roll_name}\n'
-        long_rolls_flag = len(rolls.rolls) > 6
-        if history := rolls.roll_history:
-            rolls_str += '\n'
-            msg2 += (
-                    '[ '
-                    + ', '.join(map(str, [rolls.map[x] for x in history]))
-                    + ' ]\n'
-            )
-        msg2 += (
-                '[ '
-                + ', '.join(map(str, rolls.faces))
-                + f' ]{sum_str}\n'
-        )
-    # Skip sums when there are no sums...
-    # print(f'SKIP: {skip_sum}     Exists: {sum_exists_flag}')
-    total_str = f'{results.sum}\n'
-    skip_sum = (skip_sum | (not sum_exists_flag)) & (results.final_compare_result is None)
-    if len(results.rolls) > 1 and not skip_sum:
-        rolls_str += 'TOTAL\n'
-        msg2 += total_str
-        if results.final_compare_result is not None:
-            rolls_str += f'{results.sum} {results.final_compare} {results.final_compare_val}\n'
-            msg2 += "SUCCESS" if results.final_compare_result else "FAIL"
-    rolls_str += '```'
-
-    # embed.add_field(name='```Dice Rolls```', value=_sep, inline=False)
-    if len(results.rolls) > 1:
-        embed.add_field(name='Dice', value=rolls_str)
-    elif results.final_compare_result is not None:
-        result_str = "SUCCESS" if results.final_compare_result else "FAIL"
-        msg2 += f'{results.sum} {results.final_compare} {results.final_compare_val} : {result_str}\n'
-
-    msg2 += '```'
-    embed.add_field(name='Rolls', value=msg2)
+    # ROLLS SECTION
+    dice_lines = ['```\n']
+    roll_lines = ['```\n']
+    for term in rendered.terms:
+        dice_lines.append(f'{term.name}\n')
+        if term.history is not None:
+            dice_lines.append('\n')
+            roll_lines.append(f'{term.history}\n')
+        roll_lines.append(f'{term.faces}\n')
+    dice_lines.append('```\n')
+    roll_lines.append('```\n')
+
+    fields = [('Dice Rolls', _sep, False)]
+    if multi:
+        fields.append(('Dice', ''.join(dice_lines), True))
+    fields.append(('Rolls', ''.join(roll_lines), True))
 
     # COUNTER SECTION
-    msg = ''
-    if counters := results.counters:
-        face_lengths = []
-        for roll in results.rolls:
-            face_lengths.extend([len(name) for f, name in roll.face_names.items() if f in roll.faces])
-        max_face_len = max(max(face_lengths)+1, 10)
-        rolls = results.rolls
-        msg += '```\n'
-        total_counter = Counter()
-        for idx, counter in counters:
-            rollname = f'{rolls[idx].num_dice}d{rolls[idx].dice_type}'
-            for face, count in dict(counter).items():
-                face_name = rolls[idx].face_names[face]
-                msg += f'{rollname:<8} {face_name:<{max_face_len}} {count}\n'
-                rollname = ''
-                total_counter.update([face_name for x in range(count)])
-
-        rollname = 'TOTAL'
-        if len(results.rolls) > 1:
-            for face, count in dict(total_counter).items():
-                msg += f'{rollname:<8} {face:<{max_face_len}} {count}\n'
-                rollname = ''
-
-        msg += '```'
-        if _debug:
+    if rendered.stat_rows:
+        msg = ''.join(_stats_rows(rendered, 'Total', '\n{}'))
+        if engine_config().debug:
             print(msg)
-        embed.add_field(name='Roll Stats', value=msg, inline=False)
-
-    if sfbc_str:
-        sfbc_str = '```\n' + sfbc_str + '```'
-        embed.add_field(name='Results', value=sfbc_str, inline=False)
-
-    return embed
+        fields.append(('Roll Stats', _sep, False))
+        fields.append(('Roll Stats', msg, False))
+
+    # SUCCESS AND BOON SECTIONS
+    for gain, loss, kind, title, close in (
+        (tally.successes, tally.failures, 'successes', 'Successes and Failures', '```'),
+        (tally.boons, tally.complications, 'boons', 'Boons and Complications', '```\n'),
+    ):
+        if gain or loss:
+            skip_sum = True
+            fields.append((title, _sep, False))
+            fields.extend(_tally_section(rendered, gain, loss, kind, close))
 
+    # SUM SECTION
+    skip_sum = skip_sum and compare is None
+    if not skip_sum:
+        dice_lines = ['```\n']
+        roll_lines = ['```\n']
+        limit_txt = ' (min/max)'
+        if multi:
+            for term in rendered.terms:
+                if term.sum:
+                    dice_lines.append(f'{term.name}\n')
+                    roll_lines.append(f'{term.sign}{term.sum} {term.limit_txt}\n')
+        elif len(rendered.terms) == 1 and tally.limit_flag:
+            limit_txt = f' {rendered.terms[0].limit_txt}'
+
+        dice_lines.append('\nTotal\n')
+        roll_lines.append(f'\n{total_text(rendered)}{limit_txt if tally.limit_flag else ""}\n')
+
+        if compare is not None:
+            dice_lines.append(f'{tally.sum} {rendered.final_compare} {rendered.final_compare_val}\n')
+            roll_lines.append(_compare_word(compare))
+
+        dice_lines.append('```')
+        roll_lines.append('```')
+
+        fields.append(('Sum', _sep, False))
+        fields.append(('Dice', ''.join(dice_lines), True))
+        fields.append(('Rolls', ''.join(roll_lines), True))
 
-def format_response_full(results: Equation):
     embed_dict = {
         'title': 'Roll Result',
         'type': 'rich',
         'timestamp': str(datetime.now()),
         'color': 3249376,
     }
+    return embed_dict, fields
+
+
+def equation_line(rendered: RenderedEquation, full: bool = False) -> str:
+    """
+    A roll of a batch on one line: the expression with every term's dice in place, then the total, the net counters or
+    the comparison. full shows the dice as first rolled too.
+    """
+    tally = rendered.tally
+    parts = []
+    for term in rendered.terms:
+        dice = f'{term.history} -> {term.faces}' if full and term.history is not None else term.faces
+        if term.limit_flag:
+            dice += f' {term.limit_txt}'
+        parts.append(dice)
+
+    results = []
+    for gain, loss, kind in ((tally.successes, tally.failures, 'successes'),
+                             (tally.boons, tally.complications, 'boons')):
+        if gain or loss:
+            net, net_name = net_count(gain, loss, kind)
+            results.append(f'{abs(net)} {net_name or _net_names[kind][1]}')
+    if tally.final_compare_result is not None:
+        compare = _compare_word(tally.final_compare_result)
+        results.append(f'{tally.sum} {rendered.final_compare} {rendered.final_compare_val} : {compare}')
+    elif not results and rendered.sum_exists:
+        results.append(f'{tally.sum}')
+
+    return program_text(rendered.program, parts) + ('  =  ' + ', '.join(results) if results else '')
+
+
+def batch_name(item: RolledExpression) -> str:
+    return f'{item.repeat}x {item.expr}' if item.repeat > 1 else item.expr
+
+
+def batch_layout(batch: List[RolledExpression], rendered: List[List[RenderedEquation]], full: bool = False):
+    """
+    (embed dict, fields) for a command with several expressions or repeats: a field per expression and a line per roll
+    """
+    fields = []
+    for item, item_rendered in zip(batch, rendered):
+        width = len(str(item.repeat))
+        lines = ['```\n']
+        for number, rendered_equation in enumerate(item_rendered, 1):
+            number_str = f'{number:>{width}}  ' if item.repeat > 1 else ''
+            lines.append(f'{number_str}{equation_line(rendered_equation, full)}\n')
+        lines.append('```')
+        fields.append((fit_text(batch_name(item), _embed_title_chars), ''.join(lines), False))
 
+    embed_dict = {
+        'type': 'rich',
+        'color': 3249376,
+    }
+    return embed_dict, fields
+
+
+def fit_text(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+
+def fit_line(line: str, limit: int) -> str:
+    """
+    line with its lists of dice cut down, longest first, to as many dice as fit in limit characters followed by
+    '+N more'. The rest of the line (the sums and the total) is always kept, so it can come out longer than limit.
+    """
+    excess = len(line) - limit
+    if excess <= 0:
+        return line
+
+    cuts = []
+    for match in sorted(dice_list_pattern.finditer(line), key=lambda match: match.start() - match.end()):
+        if excess <= 0:
+            break
+        dice_list = match.group()
+        items = match.group('items').split(', ') if match.group('items') else []
+        total = len(items)
+        # A list that was already cut counts the dice it left out too
+        if items and items[-1].startswith('+') and items[-1].endswith(' more') and items[-1][1:-5].isdigit():
+            total += int(items.pop()[1:-5]) - 1
+        cut = join_within(items, match.group('open'), match.group('close'), len(dice_list) - excess, total)
+        if len(cut) < len(dice_list):
+            cuts.append((match.start(), match.end(), cut))
+            excess -= len(dice_list) - len(cut)
+
+    parts = []
+    pos = 0
+    for start, end, cut in sorted(cuts):
+        parts.append(line[pos:start])
+        parts.append(cut)
+        pos = end
+    parts.append(line[pos:])
+    return ''.join(parts)
+
+
+def fit_field(value: str, limit: int = _embed_field_chars) -> str:
+    """
+    value cut down to fit in limit characters. Every line keeps its sums and totals and the lists of dice on the lines
+    share what room is left, see fit_line. Only when even that doesn't fit are lines dropped from the end for '+N more
+    lines', before the code block's closing fence if it had one.
+    """
+    if len(value) <= limit:
+        return value
+    body, fence, tail = value.rpartition('```')
+    if not body:
+        body, fence, tail = value, '', ''
+    lines = body.split('\n')
+
+    room = limit - len(fence) - len(tail) - (len(lines) - 1)
+    shortest = [fit_line(line, 0) for line in lines]
+    spare = room - sum(map(len, shortest))
+    if spare >= 0:
+        extra = share_chars([len(line) - len(short) for line, short in zip(lines, shortest)], spare)
+        fitted = '\n'.join(fit_line(line, len(short) + more) for line, short, more in zip(lines, shortest, extra))
+        return fitted + fence + tail
+
+    lines = shortest
+    used = len(fence) + len(tail) + len(f'+{len(lines)} more lines\n')
+    kept = 0
+    for line in lines:
+        used += len(line) + 1
+        if used > limit:
+            break
+        kept += 1
+    return '\n'.join(lines[:kept]) + f'\n+{len(lines) - kept} more lines\n' + fence + tail
+
+
+def fit_fields(fields: list, limit: int = _embed_total_chars) -> list:
+    """
+    Fields with every value fitted to Discord's field limit, and all of them together to limit characters. The values
+    share the room like share_chars shares it, so the shorter ones are left whole.
+    """
+    fields = [(name, fit_field(value), inline) for name, value, inline in fields]
+    room = limit - sum(len(name) for name, _, _ in fields)
+    shares = share_chars([len(value) for _, value, _ in fields], room)
+    return [(name, fit_field(value, share), inline) for (name, value, inline), share in zip(fields, shares)]
+
+
+def build_embed(embed_dict: dict, fields: list):
     embed = discord.Embed.from_dict(embed_dict)
+    for name, value, inline in fields:
+        embed.add_field(name=name, value=value, inline=inline)
+    return embed
 
-    skip_sum = False
 
-    # ROLLS SECTION
-    rolls_str = '```\n'
-    msg2 = '```\n'
-    for rolls in results.rolls:
-        rolls_str += f'{rolls.roll_name}\n'
-        if history := rolls.roll_history:
-            rolls_str += '\n'
-            msg2 += (
-                    '[ '
-                    + ', '.join(map(str, [rolls.map[x] for x in history]))
-                    + ' ]\n'
-            )
-        msg2 += (
-                '[ '
-                + ', '.join(map(str, rolls.faces))
-                + ' ]\n'
-        )
+def layout_embed(embed_dict: dict, fields: list, limit: int = _embed_total_chars):
+    return build_embed(embed_dict, fit_fields(fields, limit - len(embed_dict.get('title', ''))))
 
-    rolls_str += '```\n'
-    msg2 += '```\n'
 
-    embed.add_field(name='Dice Rolls', value=_sep, inline=False)
-    if len(results.rolls) > 1:
-        embed.add_field(name='Dice', value=rolls_str)
-    embed.add_field(name='Rolls', value=msg2)
+def format_response(results: Equation, limit: int = _embed_total_chars):
+    return layout_embed(*compact_layout(render_equation(results, _embed_field_chars)), limit)
 
-    # COUNTER SECTION
-    msg = ''
-    if counters := results.counters:
-        face_lengths = []
-        for roll in results.rolls:
-            face_lengths.extend([len(name) for f, name in roll.face_names.items() if f in roll.faces])
-        max_face_len = max(max(face_lengths)+1, 10)
-        embed.add_field(name='Roll Stats', value=_sep, inline=False)
-        rolls = results.rolls
-        msg += '```\n'
-        total_counter = Counter()
-        for idx, counter in counters:
-            rollname = f'{rolls[idx].num_dice}d{rolls[idx].dice_type}'
-            for face, count in dict(counter).items():
-                face_name = rolls[idx].face_names[face]
-                msg += f'{rollname:<8} {face_name:<{max_face_len}} {count}\n'
-                rollname = ''
-                total_counter.update([face_name for x in range(count)])
-
-        rollname = 'Total'
-        if len(results.rolls) > 1:
-            for face, count in dict(total_counter).items():
-                msg += f'\n{rollname:<8} {face:<{max_face_len}} {count}'
-                rollname = ''
-
-        msg += '```'
-        print(msg)
-        embed.add_field(name='Roll Stats', value=msg, inline=False)
-
-    # SUCCESS SECTION
-    msg1 = '```\n'
-    msg2 = '```\n'
-    msg3 = '```\n'
-    net = 0
-    sf_section_flag = False
-
-    if successes := results.successes:
-        sf_section_flag = True
-        net += successes.total
-        msg1 += 'Successes'
-        for idx, val in successes.map:
-            msg1 += '\n'
-            msg2 += f'{results.rolls[idx].roll_name}\n'
-            msg3 += f'{val}\n'
-        if not successes.map:
-            msg1 += '\n'
-            msg2 += '\n'
-            msg3 += '0\n'
-
-        if len(results.rolls) > 1:
-            msg1 += '\n\n'
-            msg2 += 'Subtotal\n\n'
-            msg3 += f'{successes.total}\n\n'
-
-    if failures := results.failures:
-        net -= failures.total
-        sf_section_flag = True
-        msg1 += 'Failures'
-        for idx, val in failures.map:
-            msg1 += '\n'
-            msg2 += f'{results.rolls[idx].roll_name}\n'
-            msg3 += f'{val}\n'
-        if not failures.map:
-            msg1 += '\n'
-            msg2 += '\n'
-            msg3 += '0\n'
-
-        if len(results.rolls) > 1:
-            msg1 += '\n\n'
-            msg2 += 'Subtotal\n\n'
-            msg3 += f'{failures.total}\n\n'
-
-    if sf_section_flag:
-        abs_result = abs(net)
-
-        if net == 0:
-            sf_type = ''
-        elif net > 0:
-            sf_type = 'Success' if net == 1 else 'Successes'
-        else:
-            sf_type = 'Failure' if net == -1 else 'Failures'
 
-        msg1 += 'TOTAL'
-        msg2 += ''
-        msg3 += f'{abs_result} {sf_type}'
+def format_response_full(results: Equation, limit: int = _embed_total_chars):
+    return layout_embed(*full_layout(render_equation(results, _embed_field_chars)), limit)
 
-        msg1 += '```'
-        msg2 += '```'
-        msg3 += '```'
 
-        skip_sum = True
+def format_probability(result: ProbResult):
+    embed_dict = {
+        'type': 'rich',
+        'color': 3249376,
+    }
+
+    embed = discord.Embed.from_dict(embed_dict)
 
-        embed.add_field(
-            name='Successes and Failures',
-            value=_sep,
-            inline=False,
+    stats_str = (
+        '```\n'
+        + f'Mean     {result.mean:.2f}\n'
+        + f'Std Dev  {result.stdev:.2f}\n'
+        + '```'
+    )
+    embed.add_field(name='Sum', value=stats_str)
+
+    percentile_str = '```\n'
+    for percentile, value in result.percentiles.items():
+        percentile_str += f'{percentile:>3}%  {value}\n'
+    percentile_str += '```'
+    embed.add_field(name='Percentiles', value=percentile_str)
+
+    if result.compare_chance is not None:
+        plan = result.plan
+        chance_str = (
+            '```\n'
+            + f'TOTAL {plan.final_compare} {plan.final_compare_val} : {100 * result.compare_chance:.2f}%\n'
+            + '```'
         )
+        embed.add_field(name='Chance', value=chance_str, inline=False)
 
-        embed.add_field(name='Type', value=msg1, inline=True)
-        embed.add_field(name='Roll', value=msg2, inline=True)
-        embed.add_field(name='Value', value=msg3, inline=True)
-
-    # BOON SECTION
-    msg1 = '```\n'
-    msg2 = '```\n'
-    msg3 = '```\n'
-    net = 0
-    bc_section_flag = False
-
-    if boons := results.boons:
-        bc_section_flag = True
-        net += boons.total
-        msg1 += 'Boons'
-        for idx, val in boons.map:
-            msg1 += '\n'
-            msg2 += f'{results.rolls[idx].roll_name}\n'
-            msg3 += f'{val}\n'
-        if not boons.map:
-            msg1 += '\n'
-            msg2 += '\n'
-            msg3 += '0\n'
-
-        if len(results.rolls) > 1:
-            msg1 += '\n\n'
-            msg2 += 'Subtotal\n\n'
-            msg3 += f'{boons.total}\n\n'
-
-    if complications := results.complications:
-        net -= complications.total
-        bc_section_flag = True
-        msg1 += 'Complications'
-        for idx, val in complications.map:
-            msg1 += '\n'
-            msg2 += f'{results.rolls[idx].roll_name}\n'
-            msg3 += f'{val}\n'
-        if not complications.map:
-            msg1 += '\n'
-            msg2 += '\n'
-            msg3 += '0\n'
-
-        if len(results.rolls) > 1:
-            msg1 += '\n\n'
-            msg2 += 'Subtotal\n\n'
-            msg3 += f'{complications.total}\n\n'
-
-    if bc_section_flag:
-        abs_result = abs(net)
-
-        if net == 0:
-            bc_type = ''
-        elif net > 0:
-            bc_type = 'Boon' if net == 1 else 'Boons'
-        else:
-            bc_type = 'Complication' if net == -1 else 'Complications'
+    return embed
 
-        msg1 += 'TOTAL'
-        msg2 += ''
-        msg3 += f'{abs_result} {bc_type}'
 
-        msg1 += '```\n'
-        msg2 += '```\n'
-        msg3 += '```\n'
+def format_simulation(results: SimResult):
+    embed_dict = {
+        'type': 'rich',
+        'color': 3249376,
+    }
 
-        skip_sum = True
+    embed = discord.Embed.from_dict(embed_dict)
 
-        embed.add_field(
-            name='Boons and Complications',
-            value=_sep,
-            inline=False,
+    for name, histogram in results.histograms.items():
+        values = sorted(histogram)
+        probs = [histogram[val] / results.trials for val in values]
+        mean, stdev, percentiles = distribution_stats(values, probs)
+        stats_str = (
+            '```\n'
+            + f'Mean     {mean:.2f}\n'
+            + f'Std Dev  {stdev:.2f}\n'
+            + f'Range    {values[0]} to {values[-1]}\n'
         )
+        for percentile, value in percentiles.items():
+            stats_str += f'{percentile:>3}%     {value}\n'
+        stats_str += '```'
+        embed.add_field(name=name, value=stats_str)
 
-        embed.add_field(name='Type', value=msg1, inline=True)
-        embed.add_field(name='Roll', value=msg2, inline=True)
-        embed.add_field(name='Value', value=msg3, inline=True)
+    if results.compare_hits is not None:
+        chance = 100 * results.compare_hits / results.trials
+        chance_str = f'```\nTOTAL {results.final_compare} {results.final_compare_val} : {chance:.2f}%\n```'
+        embed.add_field(name='Chance', value=chance_str, inline=False)
 
-    # SUM SECTION
-    skip_sum = skip_sum & (results.final_compare_result is None)
-    if not skip_sum:
-        rolls_str_2 = '```\n'
-        msg2 = '```\n'
-        limit_txt = " (min/max)"
-        if len(results.rolls) > 1:
-            for idx, rolls in enumerate(results.rolls):
-                if rolls.sum:
-                    rolls_str_2 += f'{rolls.roll_name}\n'
-                    sign = results.ops[idx].replace('+', '')
-                    msg2 += f'{sign}{rolls.sum} {rolls.limit_txt}\n'
-        elif len(results.rolls) == 1 and results.limit_flag:
-            limit_txt = f' {results.rolls[0].limit_txt}'
-
-        rolls_str_2 += "\nTotal\n"
-        msg2 += f'\n{results.sum}{limit_txt if results.limit_flag else ""}\n'
-
-        if results.final_compare_result is not None:
-            rolls_str_2 += f'{results.sum} {results.final_compare} {results.final_compare_val}\n'
-            msg2 += "SUCCESS" if results.final_compare_result else "FAIL"
-
-        rolls_str_2 += "```"
-        msg2 += '```'
-
-        embed.add_field(name='Sum', value=_sep, inline=False)
-        embed.add_field(name='Dice', value=rolls_str_2)
-        embed.add_field(name='Rolls', value=msg2)
-
-    # pprint(embed.fields, indent=2)
+    trials_str = f'{results.trials} of {results.requested} in {results.elapsed:.2f}s'
+    embed.add_field(name='Trials', value=f'```\n{trials_str}\n```', inline=False)
 
     return embed
 
@@ -1349,6 +676,8 @@ def create_help():
         '''```
 r         Simple Roll
 rf        Verbose (Full) Roll
+prob      Odds of a roll's sum (no keep options)
+sim [N]   Simulate a roll N times (default 10000)
 h         Help
 dice [X]  List dice names | List info for dice X
 
@@ -1367,6 +696,9 @@ Roll Syntax:
     4d6 + 2d4      Roll multiple dice and sum the results
     1d20 + 2       Add a constant 2 to the result of a d20
     1d20 - 4 < 10  Compare the sum of all rolls and math
+    6x 4d6k3       Roll 4d6k3 six times
+    1d20+5; 2d6+3  Roll several expressions in one message
+    (1d6+2) * 3    Group with parentheses, * and / (/ rounds down)
     
     Math and dice roll options can be combined:
     
@@ -1457,7 +789,6 @@ cb#|cx# Critical boon/complication (2x) when the dice rolls:
         'title': 'Help',
         'type': 'rich',
         'description': cmd,
-        'timestamp': str(datetime.now()),
     }
 
     embed = discord.Embed.from_dict(embed_dict)
@@ -1469,23 +800,433 @@ cb#|cx# Critical boon/complication (2x) when the dice rolls:
     return embed
 
 
+# Replies that only change with the dice file, rendered once per registry
+StaticReplies = namedtuple('StaticReplies', ['registry', 'help', 'dice_list', 'dice_info'])
+
+_static_replies: Optional[StaticReplies] = None
+
+
+def format_dice_data(dice_data) -> str:
+    return '```\n' + pformat(dice_data, indent=2, width=120) + '\n```'
+
+
+def render_static_replies(registry: 'DiceRegistry') -> StaticReplies:
+    types = registry.types
+    return StaticReplies(
+        registry=registry,
+        help=create_help(),
+        dice_list=format_dice_data({key: dice.name for key, dice in types.items()}),
+        dice_info=MappingProxyType({key: format_dice_data(dict(dice.info)) for key, dice in types.items()}),
+    )
+
+
+def static_replies() -> StaticReplies:
+    """
+    The /h and /dice replies for the dice in use. They're rendered again the first time they're asked for after a new
+    registry is installed.
+    """
+    global _static_replies
+    registry = dice_registry()
+    if _static_replies is None or _static_replies.registry is not registry:
+        _static_replies = render_static_replies(registry)
+    return _static_replies
+
+
+# -------------------------------------------------------------
+#  Metrics
+# -------------------------------------------------------------
+# Stages run in the roll executor, possibly in another process, so they're logged per job (thread local) and handed
+# back with the job's result. The event loop adds the command and records them in _metrics. Only the send stage is
+# timed on the loop itself.
+
+# Upper bounds (seconds) of the histogram buckets
+_metric_buckets = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Upper bounds (bytes) of the reply size histogram buckets
+_metric_byte_buckets = (256, 512, 1024, 2048, 4096, 6144, 8192, 16384, 65536, 262144, 1048576)
+
+class StageMetrics:
+    """
+    Latency histograms for every (stage, command, dice) seen and size histograms of the replies sent for every
+    (command, dice), rendered in the Prometheus text format
+    """
+
+    def __init__(
+        self,
+        buckets: Tuple[float, ...] = _metric_buckets,
+        byte_buckets: Tuple[int, ...] = _metric_byte_buckets,
+    ):
+        self.buckets = buckets
+        self.byte_buckets = byte_buckets
+        self._series = {}
+        self._byte_series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, command: str, dice: str, seconds: float):
+        self._observe(self._series, self.buckets, (stage, command, dice), seconds)
+
+    def observe_bytes(self, command: str, dice: str, size: int):
+        self._observe(self._byte_series, self.byte_buckets, (command, dice), size)
+
+    def _observe(self, all_series: dict, buckets: tuple, key: tuple, value):
+        with self._lock:
+            series = all_series.get(key)
+            if series is None:
+                # Count per bucket (the last one past every bound), sum of the values
+                series = all_series[key] = [[0] * (len(buckets) + 1), 0]
+            series[0][bisect_left(buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> str:
+        lines = [
+            '# HELP rollbot_stage_seconds Time spent in each stage of answering a command',
+            '# TYPE rollbot_stage_seconds histogram',
+        ]
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+            byte_series = sorted((key, list(counts), total) for key, (counts, total) in self._byte_series.items())
+        for (stage, command, dice), counts, total in series:
+            labels = f'stage="{stage}",command="{_label_value(command)}",dice="{_label_value(dice)}"'
+            lines.extend(_histogram_lines('rollbot_stage_seconds', labels, self.buckets, counts, total))
+
+        lines.extend([
+            '# HELP rollbot_reply_bytes Size of the replies sent for each command, content, embed and attachment',
+            '# TYPE rollbot_reply_bytes histogram',
+        ])
+        for (command, dice), counts, total in byte_series:
+            labels = f'command="{_label_value(command)}",dice="{_label_value(dice)}"'
+            lines.extend(_histogram_lines('rollbot_reply_bytes', labels, self.byte_buckets, counts, total))
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name: str, labels: str, buckets: tuple, counts: List[int], total) -> List[str]:
+    lines = []
+    seen = 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {seen}')
+    seen += counts[-1]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {seen}')
+    lines.append(f'{name}_sum{{{labels}}} {total}')
+    lines.append(f'{name}_count{{{labels}}} {seen}')
+    return lines
+
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_metrics: Optional[StageMetrics] = StageMetrics() if _metrics_port else None
+
+# Command being answered and the dice it rolled, for the stages timed on the event loop
+_metric_command: ContextVar[Optional[str]] = ContextVar('metric_command', default=None)
+_metric_dice: ContextVar[str] = ContextVar('metric_dice', default='')
+
+
+def metric_command(content: str) -> Optional[str]:
+    for prefix, command in _metric_prefixes:
+        if content.startswith(prefix):
+            return command
+    return None
+
+
+# (message prefix, command label) in the order on_message checks them
+_metric_prefixes = (
+    ('/h', '/h'),
+    ('/r ', '/r'),
+    ('/rf ', '/rf'),
+    ('/prob ', '/prob'),
+    ('/sim ', '/sim'),
+    ('/dice', '/dice'),
+)
+
+
+def observe_stage(stage: str, start: float):
+    # For stages timed on the event loop, start is the time.perf_counter() they started at
+    if _metrics is not None and (command := _metric_command.get()) is not None:
+        _metrics.observe(stage, command, _metric_dice.get(), time.perf_counter() - start)
+
+
+def record_job_stages(stages: List[Tuple[str, str, float]]):
+    command = _metric_command.get()
+    for stage, dice, seconds in stages:
+        _metrics.observe(stage, command, dice, seconds)
+        if stage == 'parse':
+            _metric_dice.set(dice)
+
+
+def reply_bytes(content=None, embed=None, file=None, **kwargs) -> int:
+    """
+    UTF-8 bytes of a reply's content, its embed as JSON and its attachment
+    """
+    size = len(str(content).encode()) if content is not None else 0
+    if embed is not None:
+        size += len(json.dumps(embed.to_dict(), default=str).encode())
+    if file is not None:
+        size += len(file.fp.getbuffer())
+    return size
+
+
+async def send_reply(send, *args, **kwargs):
+    """
+    await send(*args, **kwargs), timed as the send stage of the current command. The reply's size is recorded too.
+    """
+    command = _metric_command.get() if _metrics is not None else None
+    if command is None:
+        return await send(*args, **kwargs)
+    _metrics.observe_bytes(command, _metric_dice.get(), reply_bytes(*args, **kwargs))
+    start = time.perf_counter()
+    try:
+        return await send(*args, **kwargs)
+    finally:
+        _metrics.observe('send', command, _metric_dice.get(), time.perf_counter() - start)
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Just enough HTTP for a scraper: GET /metrics, everything else is a 404
+    try:
+        request_line = await reader.readline()
+        while await reader.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = b'200 OK', _metrics.render().encode()
+        else:
+            status, body = b'404 Not Found', b'Not Found\n'
+        writer.write(
+            b'HTTP/1.1 ' + status + b'\r\n'
+            + b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            + b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            + b'Connection: close\r\n\r\n'
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server() -> asyncio.AbstractServer:
+    return await asyncio.start_server(serve_metrics, _metrics_host, _metrics_port)
+
+
+# -------------------------------------------------------------
+#  Evaluation Workers
+# -------------------------------------------------------------
+
+class RollTimeoutError(Exception):
+    def __init__(self, timeout: float, message: str = ''):
+        self.timeout = timeout
+        self.message = message
+        super().__init__(timeout, message)
+
+    def __str__(self):
+        return f'Took longer than {self.timeout:g}s, cancelled. {self.message}'
+
+
+class RollQueueFullError(Exception):
+    def __init__(self, depth: int, message: str = ''):
+        self.depth = depth
+        self.message = message
+        super().__init__(depth, message)
+
+    def __str__(self):
+        return f'{self.depth} rolls are already waiting, try again shortly. {self.message}'
+
+
+# These run in the roll executor. They hand back plain embed dicts, which (unlike discord.Embed) pickle cleanly out of
+# a worker process.
+
+# A roll's reply as it comes back from the executor: the embed's dict and the text to attach, if any
+RenderedReply = namedtuple('RenderedReply', ['embed', 'attachment'])
+
+
+def render_roll(user_cmd: str, full: bool = False, reserved: int = 0) -> RenderedReply:
+    """
+    Roll user_cmd, which can be a batch like '6x 4d6k3; 1d20+5', and lay out its reply to fit in one embed. reserved
+    characters are left for the title, description and author the caller adds.
+    """
+    batch = roll_batch(user_cmd)
+    start = time.perf_counter() if _metrics is not None else None
+    if len(batch) == 1 and batch[0].repeat == 1:
+        rendered = render_equation(batch[0].equations[0], _embed_field_chars)
+        layout = full_layout(rendered) if full else compact_layout(rendered)
+        shortened = rendered.shortened
+    else:
+        # The fields share the embed and every roll of an expression shares its field. Rolls that need less than their
+        # share leave the rest to the others, see share_chars.
+        wants = [[equation_chars(equation, full) for equation in item.equations] for item in batch]
+        names = sum(min(len(batch_name(item)), _embed_title_chars) for item in batch)
+        field_rooms = share_chars(
+            [min(sum(item_wants), _embed_field_chars) for item_wants in wants],
+            _embed_total_chars - reserved - names,
+        )
+        rendered = [
+            [render_equation(equation, limit, full)
+             for equation, limit in zip(item.equations, share_chars(item_wants, field_room))]
+            for item, item_wants, field_room in zip(batch, wants, field_rooms)
+        ]
+        layout = batch_layout(batch, rendered, full)
+        shortened = any(rendered_equation.shortened for item in rendered for rendered_equation in item)
+    embed_dict, fields = layout
+    fitted = fit_fields(fields, _embed_total_chars - reserved - len(embed_dict.get('title', '')))
+    # Anything cut to fit the embed comes attached in full
+    shortened |= fitted != fields
+    response = build_embed(embed_dict, fitted).to_dict()
+
+    attachment = None
+    if shortened and _max_attach_chars:
+        text = '\n'.join(format_rolls_text(equation) for item in batch for equation in item.equations)
+        attachment = text if len(text) <= _max_attach_chars else None
+
+    if start is not None:
+        record_stage('format', batch_label(batch), time.perf_counter() - start)
+    return RenderedReply(response, attachment)
+
+
+def render_probability(user_cmd: str) -> dict:
+    return format_probability(prob_command(user_cmd)).to_dict()
+
+
+def get_roll_executor() -> Executor:
+    global _roll_executor
+    if _roll_executor is None:
+        if _roll_executor_kind == 'process':
+            _roll_executor = ProcessPoolExecutor(
+                max_workers=_roll_workers,
+                initializer=init_worker,
+                initargs=(dice_registry().path, _metrics is not None),
+            )
+        else:
+            _roll_executor = ThreadPoolExecutor(max_workers=_roll_workers, thread_name_prefix='roll')
+    return _roll_executor
+
+
+def _job_done():
+    global _pending_jobs
+    _pending_jobs -= 1
+
+
+async def run_blocking(func, *args):
+    """
+    Run func(*args) in the roll executor so the event loop only does I/O. Jobs count against the queue depth until
+    they actually finish, so a timed out job that is still running keeps its slot.
+    """
+    global _pending_jobs
+    if _pending_jobs >= _roll_queue_depth:
+        raise RollQueueFullError(_pending_jobs)
+
+    loop = asyncio.get_running_loop()
+    timed = _metrics is not None and _metric_command.get() is not None
+    job = get_roll_executor().submit(collect_stages, func, *args) if timed else get_roll_executor().submit(func, *args)
+    _pending_jobs += 1
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(_job_done))
+
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(job), _roll_timeout)
+    except asyncio.TimeoutError:
+        raise RollTimeoutError(_roll_timeout)
+
+    if timed:
+        result, stages = result
+        record_job_stages(stages)
+    return result
+
+
+async def reload_dice_types(dice_path: Optional[str] = None) -> set:
+    """
+    Re-read the dice file off the event loop and swap it in. A worker process pool is replaced so new rolls go to
+    workers with the new dice, while the old workers finish what they already have.
+    """
+    global _roll_executor
+    loop = asyncio.get_running_loop()
+    registry = await loop.run_in_executor(None, read_dice_registry, dice_path or dice_registry().path)
+    stale = install_dice_registry(registry)
+    static_replies()
+
+    if _roll_executor_kind == 'process' and _roll_executor is not None:
+        old_executor, _roll_executor = _roll_executor, None
+        old_executor.shutdown(wait=False)
+
+    return stale
+
+
+async def watch_dice_file():
+    seen = dice_registry().mtime
+    while True:
+        await asyncio.sleep(_dice_reload_interval)
+        try:
+            mtime = stat(dice_registry().path).st_mtime
+        except OSError:
+            continue
+        if mtime == seen:
+            continue
+
+        # Only try each version of the file once, a broken file waits for the next save
+        seen = mtime
+        try:
+            stale = await reload_dice_types()
+            print(f'Reloaded {dice_registry().path}, changed dice: {", ".join(sorted(stale)) or "none"}')
+        except DiceFileError as excp:
+            print(f'Kept the old dice: {excp}')
+
+
 # -------------------------------------------------------------
 #  Actual Discord Bot
 # -------------------------------------------------------------
 
 @client.event
 async def on_ready():
+    global _dice_watcher, _metrics_server
     print('We have logged in as {0.user}'.format(client))
 
+    # on_ready comes again after every reconnect
+    if _dice_reload_interval > 0 and _dice_watcher is None:
+        _dice_watcher = asyncio.ensure_future(watch_dice_file())
+
+    if _metrics is not None and _metrics_server is None:
+        _metrics_server = await start_metrics_server()
+        print(f'Serving metrics on http://{_metrics_host}:{_metrics_port}/metrics')
+
+
+async def send_roll(message, user_cmd: str, comment: Optional[str], full: bool = False):
+    title = fit_text(f'{message.author.display_name} : {user_cmd}', _embed_title_chars)
+    reserved = len(title) + len(comment or '') + len(message.author.display_name)
+    reply = await run_blocking(render_roll, user_cmd, full, reserved)
+
+    response = discord.Embed.from_dict(reply.embed)
+    response.title = title
+    if comment:
+        response.description = comment
+    # response.set_thumbnail(url=message.author.avatar_url)
+    response.set_author(
+        name=message.author.display_name,
+        icon_url=message.author.avatar_url,
+    )
+
+    if reply.attachment is None:
+        await send_reply(message.channel.send, None, embed=response)
+    else:
+        attachment = discord.File(io.BytesIO(reply.attachment.encode()), filename='rolls.txt')
+        await send_reply(message.channel.send, None, embed=response, file=attachment)
+
 
 @client.event
 async def on_message(message):
     if message.author == client.user:
         return
 
+    if _metrics is not None:
+        _metric_command.set(metric_command(message.content))
+
     if message.content.startswith('/h'):
-        embed_msg = create_help()
-        await message.channel.send(None, embed=embed_msg)
+        start = time.perf_counter()
+        embed_msg = static_replies().help
+        observe_stage('format', start)
+        await send_reply(message.channel.send, None, embed=embed_msg)
 
     else:
         try:
@@ -1494,73 +1235,80 @@ async def on_message(message):
                 if comment := comment_pattern.search(user_cmd):
                     comment = '```\n#' + comment.group('comment') + '\n```'
                 user_cmd = comment_pattern.sub('', user_cmd, count=1)
-                results = roll_command(user_cmd)
-                response = format_response(results)
-                response.title = f'{message.author.display_name} : {user_cmd}'
-                if comment:
-                    response.description = comment
-                # response.set_thumbnail(url=message.author.avatar_url)
-                response.set_author(
-                    name=message.author.display_name,
-                    icon_url=message.author.avatar_url,
-                )
-                await message.channel.send(None, embed=response)
+                await send_roll(message, user_cmd, comment)
 
             elif message.content.startswith('/rf '):
                 user_cmd = message.content[3:]
                 if comment := comment_pattern.search(user_cmd):
                     comment = '```\n#' + comment.group('comment') + '\n```'
                 user_cmd = comment_pattern.sub('', user_cmd, count=1).strip()
-                results = roll_command(user_cmd)
-                response = format_response_full(results)
+                await send_roll(message, user_cmd, comment, full=True)
+
+            elif message.content.startswith('/prob '):
+                user_cmd = message.content[5:]
+                user_cmd = comment_pattern.sub('', user_cmd, count=1).strip()
+                response = discord.Embed.from_dict(await run_blocking(render_probability, user_cmd))
                 response.title = f'{message.author.display_name} : {user_cmd}'
-                if comment:
-                    response.description = comment
-                # response.set_thumbnail(url=message.author.avatar_url)
-                response.set_author(
-                    name=message.author.display_name,
-                    icon_url=message.author.avatar_url,
-                )
-                await message.channel.send(None, embed=response)
+                await send_reply(message.channel.send, None, embed=response)
+
+            elif message.content.startswith('/sim '):
+                user_cmd = message.content[4:]
+                user_cmd = comment_pattern.sub('', user_cmd, count=1).strip()
+                trials, sim_cmd = parse_sim_command(user_cmd)
+                reply = None
+                results = None
+                shown = None
+                last_update = 0.0
+                start = time.monotonic()
+                while results is None or results.trials < trials:
+                    batch = await run_blocking(sim_batch_command, sim_cmd, trials - (results.trials if results else 0))
+                    results = merge_simulation(results, batch, trials, time.monotonic() - start)
+
+                    # Post the first batch straight away, then refresh it as more trials come in
+                    if time.monotonic() - last_update >= _sim_update_interval:
+                        response = format_simulation(results)
+                        response.title = f'{message.author.display_name} : sim {user_cmd}'
+                        if reply is None:
+                            reply = await send_reply(message.channel.send, None, embed=response)
+                        else:
+                            await send_reply(reply.edit, embed=response)
+                        shown = results.trials
+                        last_update = time.monotonic()
+
+                    if results.elapsed > engine_config().sim_time_budget:
+                        break
+
+                if results.trials != shown:
+                    response = format_simulation(results)
+                    response.title = f'{message.author.display_name} : sim {user_cmd}'
+                    await send_reply(reply.edit, embed=response)
 
             elif message.content.startswith('/dice'):
-                dice_name = None
-                dice_data = {key: (val['dice_name'] if 'dice_name' in val else "N/A") for key, val in _dice_types.items()}
-                if len(message.content) > 5:
-                    dice_name = message.content[5:].strip().upper()
-                    dice_data = _dice_types[dice_name]
-
-                msg = pformat(dice_data, indent=2, width=120)
-                msg = '```\n' + msg + '\n```'
-                await message.channel.send(msg)
+                start = time.perf_counter()
+                replies = static_replies()
+                msg = replies.dice_list
+                if dice_name := message.content[5:].strip().upper():
+                    try:
+                        msg = replies.dice_info[dice_name]
+                    except KeyError:
+                        raise UnknownDiceTypeError(dice_name, 'Use /dice to list the dice.')
+                observe_stage('format', start)
+                await send_reply(message.channel.send, msg)
         except (UnknownDiceTypeError,
                 UnknownDiceValueError,
                 UnknownOperationError,
-                MissingOperandError) as excp:
+                MissingOperandError,
+                ExpressionError,
+                RollLimitError,
+                RollTimeoutError,
+                RollQueueFullError) as excp:
             msg = '```\nERROR:\n' + str(excp) + '\n```'
-            await message.channel.send(msg)
+            await send_reply(message.channel.send, msg)
 
 
 if __name__ == '__main__':
-    with open('dice.json', 'r') as dice_file:
-        _dice_types = json.load(dice_file)
-
-    supported_dice = (
-        r'|'.join(map(str, sorted(_dice_types, key=len, reverse=True)))
-    )
-
-    supported_lc_dice = (
-        r'|'.join(map(lambda x: x.lower(), sorted(_dice_types, key=len, reverse=True)))
-    )
-
-    base_roll_string = re.compile(
-        r'(?P<num_dice>\d+)[dD](?P<dice_type>\d+|'
-        + supported_dice
-        + r'|'
-        + supported_lc_dice
-        + r')(?P<options>.*)'
-    )
+    init_engine(engine_config().dice_path, time_stages=_metrics is not None)
+    static_replies()
 
     discord_token = environ['TOKEN']
-    random.seed()
     client.run(discord_token)
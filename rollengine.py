@@ -0,0 +1,3536 @@
+"""
+The dice engine behind rollbot: parsing, rolling, probabilities and simulations, without discord. Load a dice file
+with init_engine before rolling anything. It also runs on its own, from the repository root:
+
+    python rollengine.py roll '6x 4d6k3; 1d20+5' [--json] [--seed N]
+    python rollengine.py prob '3d6 >= 12' [--json]
+    python rollengine.py serve [--host 127.0.0.1] [--port 8088]
+    python rollengine.py serve --stdin
+
+The server answers GET /roll?expr=... and /prob?expr=..., or a POST of {"expr": ...} to either, with JSON. With
+--stdin it reads a JSON request per line, {"op": "roll" or "prob", "expr": ..., "id": ...}, and writes a JSON reply
+per line.
+"""
+import argparse
+import heapq
+import json
+import operator
+import random
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, getpid, stat
+from os.path import abspath, dirname, join
+from functools import lru_cache, wraps
+from math import ceil, inf, log, log2, sqrt
+from types import MappingProxyType
+from typing import Optional, Tuple, List, Dict, Union, Any
+from pprint import pformat, pprint
+from collections import defaultdict, Counter, namedtuple, OrderedDict
+from bisect import bisect
+from itertools import accumulate
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_debug = False
+
+# 'python' rolls into lists, 'numpy' into arrays, 'counts' into a count per face, 'auto' switches to numpy for pools
+# of at least _vector_min_dice
+_dice_engine = environ.get('DICE_ENGINE', 'auto')
+_vector_min_dice = int(environ.get('VECTOR_MIN_DICE', 500))
+# Pools of at least this many dice are only kept as a count per face, whatever the engine. 0 turns this off.
+_count_min_dice = int(environ.get('ROLL_COUNT_MIN_DICE', 2000))
+# 'geometric' draws the length of every explosion chain up front, 'rounds' rolls the exploding dice round by round
+_explode_mode = environ.get('EXPLODE_MODE', 'geometric')
+
+# Where the dice get their randomness: 'python' (random.Random), 'numpy' (PCG64) or 'buffered' (PCG64 read a block of
+# _rng_block words at a time). Every thread and worker process gets its own stream, ROLL_SEED makes them repeatable.
+_rng_backend = environ.get('ROLL_RNG', 'python')
+_rng_seed = int(environ['ROLL_SEED']) if environ.get('ROLL_SEED') else None
+_rng_block = int(environ.get('ROLL_RNG_BLOCK', 4096))
+
+# The dice file next to this module unless DICE_FILE says otherwise, so it's found from any working directory
+_dice_path = environ.get('DICE_FILE', join(dirname(abspath(__file__)), 'dice.json'))
+# Hard limits for a single expression. Everything but _max_rolled_dice is checked against the estimated cost of the
+# expression before anything is rolled, _max_rolled_dice stops a run of explosions that got unlucky.
+_max_sides = int(environ.get('ROLL_MAX_SIDES', 100000))
+_max_dice = int(environ.get('ROLL_MAX_DICE', 100000))
+_max_expected_dice = int(environ.get('ROLL_MAX_EXPECTED_DICE', 200000))
+_max_rolled_dice = int(environ.get('ROLL_MAX_ROLLED_DICE', 1000000))
+_max_keep_ops = int(environ.get('ROLL_MAX_KEEP_OPS', 10000000))
+_max_output_chars = int(environ.get('ROLL_MAX_OUTPUT_CHARS', 100000))
+# Most rolls one message can ask for, counting every repeat ('6x 4d6k3') and every expression ('1d20; 2d6')
+_max_batch_rolls = int(environ.get('ROLL_MAX_BATCH', 20))
+# Deepest nesting of parentheses an expression can use
+_max_expression_depth = int(environ.get('ROLL_MAX_DEPTH', 16))
+# Most pairs of outcomes /prob multiplies or divides out when two rolled groups meet in a '*' or '/'
+_max_prob_pairs = int(environ.get('PROB_MAX_PAIRS', 1000000))
+# Most outcomes a /prob sum can have, counting the explosion chains it follows out to _explode_epsilon
+_max_prob_outcomes = int(environ.get('PROB_MAX_OUTCOMES', 1000000))
+
+# Everything built from the dice file. Swapped as a whole on reload, so read it once and use that snapshot throughout.
+_dice_registry: Optional['DiceRegistry'] = None
+
+simple_numeric_pattern = re.compile(
+    r'^\d+$'
+)
+
+# base_roll_string = re.compile(
+#     r'(?P<num_dice>\d+)[dD](?P<dice_type>\d+|[A-Z]+)(?P<options>.*)'
+# )
+
+supported_comparisons = re.compile(
+    r' +(?P<compare><(?!=)|>(?!=)|<=|>=) *(?P<cmp_val>\d+) *$'
+)
+
+# Operators and parentheses, or a run of anything else, which is a dice term or a number. Options can be spaced out
+# from their dice (4d6 k3, 1d6 min3), so a run that doesn't start with a digit belongs to the term before it.
+expression_token_pattern = re.compile(
+    r'[-+*/()]|[^-+*/()\s]+(?:\s+[^-+*/()\s\d][^-+*/()\s]*)*'
+)
+
+batch_separator_pattern = re.compile(
+    r'\s*;\s*'
+)
+
+repeat_pattern = re.compile(
+    r'^(?P<repeat>[1-9]\d*)\s*[xX]\s*(?P<expr>\S.*)$'
+)
+
+sim_trials_pattern = re.compile(
+    r'^\s*(?P<trials>\d+)\s+(?P<expr>.*)$'
+)
+
+whitespace_pattern = re.compile(
+    r'\s+'
+)
+
+# Grouped by leading character so the scanner only tries the alternatives that can match at each position
+_options = r'|'.join(
+    [
+        r'r',  # reroll
+        r'kl?',  # keep, keep low
+        r'c[sfbx]',  # critical success, failure, boon, complication
+        r'!',  # explode
+        r'==|(?<!~)[<>]=?',  # success-eq, lt, gt, lte, gte
+        r'~(?:=|[<>]=?)',  # failure-eq, lt, gt, lte, gte
+        r'b(?:=|[<>]=?)?',  # boon-eq, lt, gt, lte, gte or natural
+        r'x(?:=|[<>]=?)?',  # complication-eq, lt, gt, lte, gte or natural
+        r'min|max',  # minimum, maximum
+    ]
+)
+
+# One option token: the operation and everything it takes as an operand. tokenize_options matches it where each token
+# should start, in a single pass over the option string.
+option_token_pattern = re.compile(
+    r'(?P<op>' +
+    _options +
+    r''')(?P<operand>(?:(?:\d+|(?:['"])\w+(?:['"])),?)*)'''
+)
+
+# -------------------------------------------------------------
+#  Random Numbers
+# -------------------------------------------------------------
+# Every backend has the same methods, so the engines never touch the random module or numpy's global state. generator
+# is a numpy Generator for the array engines (None without numpy).
+
+class PythonRNG:
+    """
+    Dice randomness from a random.Random, drawing the same numbers random.randint would for the same seed
+    """
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+        self._generator = None
+
+    def integers(self, sides: int, count: int) -> List[int]:
+        randrange = self._random.randrange
+        return [randrange(sides) for _ in range(count)]
+
+    def integer(self, sides: int) -> int:
+        return self._random.randrange(sides)
+
+    def chain_lengths(self, go_chance: float, count: int) -> List[int]:
+        """Lengths of count runs that each go on for another die with go_chance"""
+        log_chance = log(go_chance)
+        rand = self._random.random
+        return [1 + int(log(1.0 - rand()) / log_chance) for _ in range(count)]
+
+    def choices(self, population, weights, k: int) -> list:
+        return self._random.choices(population, weights, k=k)
+
+    @property
+    def generator(self):
+        # Seeded from this RNG, so a seeded PythonRNG seeds the array engines too
+        if self._generator is None and np is not None:
+            self._generator = np.random.Generator(np.random.PCG64(self._random.getrandbits(128)))
+        return self._generator
+
+
+class NumpyRNG:
+    """
+    Dice randomness from a numpy Generator
+    """
+
+    def __init__(self, generator):
+        self._generator = generator
+
+    def integers(self, sides: int, count: int) -> List[int]:
+        return self._generator.integers(0, sides, size=count).tolist()
+
+    def integer(self, sides: int) -> int:
+        return int(self._generator.integers(0, sides))
+
+    def chain_lengths(self, go_chance: float, count: int) -> List[int]:
+        return self._generator.geometric(1 - go_chance, size=count).tolist()
+
+    def choices(self, population, weights, k: int) -> list:
+        return self._generator.choice(population, size=k, p=weights).tolist()
+
+    @property
+    def generator(self):
+        return self._generator
+
+
+class BufferedRNG(NumpyRNG):
+    """
+    NumpyRNG that reads raw 64 bit words off the bit generator a block at a time, so a die costs a couple of list
+    operations rather than a call into numpy. Bounded integers reject the words past the last whole multiple of sides
+    instead of taking them modulo sides, which would make the low faces a little likelier. Draws of more than bulk
+    values go straight to numpy, which is quicker at that size, and the array engines use the generator directly.
+    """
+    bulk = 64
+
+    def __init__(self, generator, block: Optional[int] = None):
+        super().__init__(generator)
+        self._block = block or _rng_block
+        self._words = []
+        self._pos = 0
+
+    def _take(self, count: int) -> List[int]:
+        if self._pos + count > len(self._words):
+            fresh = self._generator.bit_generator.random_raw(max(self._block, count))
+            self._words = self._words[self._pos:] + fresh.tolist()
+            self._pos = 0
+        words = self._words[self._pos:self._pos + count]
+        self._pos += count
+        return words
+
+    def _floats(self, count: int) -> List[float]:
+        # The top 53 bits of each word, as a float in [0, 1)
+        return [(word >> 11) * _float_step for word in self._take(count)]
+
+    def integers(self, sides: int, count: int) -> List[int]:
+        reject_from = (1 << 64) - (1 << 64) % sides
+        if count > self.bulk:
+            return self._bulk_integers(sides, count, reject_from)
+        rolls = [word % sides for word in self._take(count) if word < reject_from]
+        while len(rolls) < count:
+            rolls.extend(word % sides for word in self._take(count - len(rolls)) if word < reject_from)
+        return rolls
+
+    def _bulk_integers(self, sides: int, count: int, reject_from: int) -> List[int]:
+        rolls = []
+        while len(rolls) < count:
+            words = self._generator.bit_generator.random_raw(count - len(rolls))
+            if reject_from < 1 << 64:
+                words = words[words < np.uint64(reject_from)]
+            rolls.extend((words % np.uint64(sides)).tolist())
+        return rolls
+
+    def integer(self, sides: int) -> int:
+        return self.integers(sides, 1)[0]
+
+    def chain_lengths(self, go_chance: float, count: int) -> List[int]:
+        if count > self.bulk:
+            return super().chain_lengths(go_chance, count)
+        log_chance = log(go_chance)
+        return [1 + int(log(1.0 - rand) / log_chance) for rand in self._floats(count)]
+
+    def choices(self, population, weights, k: int) -> list:
+        if k > self.bulk:
+            return super().choices(population, weights, k)
+        cumulative = list(accumulate(weights))
+        total = cumulative[-1]
+        last = len(population) - 1
+        return [population[bisect(cumulative, rand * total, 0, last)] for rand in self._floats(k)]
+
+
+_float_step = 1.0 / (1 << 53)
+_rng_backends = ('python', 'numpy', 'buffered')
+
+
+def make_rng(kind: Optional[str] = None, seed: Optional[int] = None, stream: Tuple[int, ...] = ()):
+    """
+    A new RNG of the given backend, _rng_backend by default. The same seed and stream always give the same numbers and
+    different streams of one seed are independent. No seed draws one from the OS. Without numpy every backend is
+    'python'.
+    """
+    kind = kind or _rng_backend
+    if kind not in _rng_backends:
+        raise ValueError(f'Unknown RNG backend {kind}, pick one of {", ".join(_rng_backends)}')
+
+    if kind == 'python' or np is None:
+        if seed is not None and stream:
+            seed = f'{seed}/{"/".join(map(str, stream))}'
+        return PythonRNG(seed)
+
+    generator = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=stream)))
+    return BufferedRNG(generator) if kind == 'buffered' else NumpyRNG(generator)
+
+
+# Streams are (process, thread). Worker processes set _rng_process to their pid, threads count up from 0 per process.
+_rng_process = 0
+_rng_local = threading.local()
+_rng_lock = threading.Lock()
+_rng_next_thread = 0
+
+
+def worker_rng():
+    """
+    The RNG of the calling thread, made on first use. Generators aren't safe to share, so every thread of every process
+    gets its own stream of _rng_seed.
+    """
+    global _rng_next_thread
+    try:
+        return _rng_local.rng
+    except AttributeError:
+        with _rng_lock:
+            thread_num = _rng_next_thread
+            _rng_next_thread += 1
+        rng = _rng_local.rng = make_rng(seed=_rng_seed, stream=(_rng_process, thread_num))
+        return rng
+
+
+# -------------------------------------------------------------
+#  Dice Roll Class
+# -------------------------------------------------------------
+
+RollResult = namedtuple('RollResult', ['total', 'map'])
+
+# Everything the formatters need from an Equation, worked out in one pass over its rolls
+EquationTally = namedtuple(
+    'EquationTally',
+    [
+        'sum',
+        'limit_flag',
+        'successes',
+        'failures',
+        'boons',
+        'complications',
+        'counters',
+        'final_compare_result',
+    ]
+)
+
+_counter_names = ('successes', 'failures', 'boons', 'complications')
+
+
+def derived_property(func):
+    """
+    Property computed from a roll's current dice and cached until DiceRoll._invalidate is called.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = func(self)
+            return value
+
+    return property(getter)
+
+
+def join_within(items, opener: str, closer: str, limit: Optional[int] = None, total: Optional[int] = None) -> str:
+    """
+    opener + ', '.join(items) + closer. With a limit, only as many items as fit in limit characters followed by
+    '+N more'. total is how many items there are, when items doesn't hold all of them.
+    """
+    if limit is None:
+        return opener + ', '.join(items) + closer
+
+    items = list(items)
+    total = len(items) if total is None else total
+    room = limit - len(opener) - len(closer)
+    more = len(f', +{total} more')
+    shown = []
+    used = -2
+    for item in items:
+        used += len(item) + 2
+        # The last item doesn't need room left for '+N more'
+        if used + (0 if len(shown) + 1 == total else more) > room:
+            break
+        shown.append(item)
+    if len(shown) < total:
+        shown.append(f'+{total - len(shown)} more')
+    return opener + ', '.join(shown) + closer
+
+
+class Equation:
+    def __init__(self, original_eq_str=''):
+        self.original_equation_str = original_eq_str
+        self.rolls: List[DiceRoll] = []
+        # The sign each roll is shown with, and the program that works out the total from the roll sums
+        self.ops = []
+        self.program = ()
+        self.final_compare = None
+        self.final_compare_val = None
+
+    @property
+    def rolls(self):
+        return self._rolls
+
+    @rolls.setter
+    def rolls(self, rolls):
+        # The tally is taken once the rolls are in, so hand over the finished list
+        self._rolls = rolls
+        self._tally = None
+
+    @property
+    def tally(self) -> 'EquationTally':
+        if self._tally is None:
+            self._tally = self._take_tally()
+        return self._tally
+
+    def _take_tally(self) -> 'EquationTally':
+        limit_flag = False
+        counters = []
+        totals = {counter_name: 0 for counter_name in _counter_names}
+        maps = {counter_name: [] for counter_name in _counter_names}
+
+        sums = []
+        for idx, roll in enumerate(self.rolls):
+            roll_sum = roll.sum
+            sums.append(roll_sum if roll_sum else 0)
+
+            limit_flag |= roll.limit_flag
+
+            for counter_name in _counter_names:
+                count = getattr(roll, counter_name)
+                if count is not None:
+                    totals[counter_name] += count
+                    maps[counter_name].append((idx, count))
+
+            if non_empty := roll.counter:
+                counters.append((idx, non_empty))
+
+        total_sum = run_program(self.program, sums) if self.program else 0
+
+        results = {
+            counter_name: RollResult(total=totals[counter_name], map=maps[counter_name]) if maps[counter_name] else None
+            for counter_name in _counter_names
+        }
+
+        final_compare_result = None
+        if self.final_compare is not None and self.final_compare_val is not None:
+            compare, _ = _threshold_compares[self.final_compare]
+            final_compare_result = compare(total_sum, self.final_compare_val)
+
+        return EquationTally(
+            sum=total_sum,
+            limit_flag=limit_flag,
+            counters=counters if counters else None,
+            final_compare_result=final_compare_result,
+            **results,
+        )
+
+    @property
+    def limit_flag(self):
+        return self.tally.limit_flag
+
+    @property
+    def counters(self):
+        return self.tally.counters
+
+    @property
+    def sum(self):
+        return self.tally.sum
+
+    @property
+    def successes(self):
+        return self.tally.successes
+
+    @property
+    def failures(self):
+        return self.tally.failures
+
+    @property
+    def boons(self):
+        return self.tally.boons
+
+    @property
+    def complications(self):
+        return self.tally.complications
+
+    @property
+    def final_compare_result(self):
+        return self.tally.final_compare_result
+
+    def get_print_dict(self):
+        print_dict = {
+            'Total Sum': self.sum,
+            'Rolls': [x.get_print_dict() for x in self.rolls],
+            'Successes': self.successes,
+            'Boons': self.boons,
+        }
+        return print_dict
+
+    def __repr__(self):
+        print_dict = self.get_print_dict()
+        return pformat(print_dict, indent=2)
+
+
+# One change to a roll. idx is the position the change happened at in the rolls as they were just before it, old and
+# new are face indices and None where a die was added (explode) or dropped (keep). reason is 'reroll', 'explode' or
+# 'keep'. A keep drops all of its dice in one entry, with lists for idx and old. The numpy engine logs every batch as
+# one entry, with arrays.
+HistoryEntry = namedtuple('HistoryEntry', ['idx', 'old', 'new', 'reason'])
+
+
+class RollHistory:
+    """
+    The dice a roll started with and a log of every change made to them since. Nothing is copied while rolling, any
+    step in between is rebuilt from the log when it's asked for.
+    """
+
+    def __init__(self, rolls):
+        self.initial = list(rolls)
+        self.changes = []
+
+    def log(self, idx, old, new, reason):
+        self.changes.append(HistoryEntry(idx, old, new, reason))
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def replay(self, steps: Optional[int] = None):
+        """The rolls after the first steps changes, or after all of them"""
+        rolls = self._start()
+        for entry in self.changes[:steps]:
+            rolls = self._apply(rolls, entry)
+        return rolls
+
+    def _start(self):
+        return list(self.initial)
+
+    @staticmethod
+    def _apply(rolls, entry):
+        if entry.reason == 'keep':
+            dropped = set(entry.idx)
+            return [roll for idx, roll in enumerate(rolls) if idx not in dropped]
+        if entry.reason == 'explode':
+            rolls.append(entry.new)
+        else:
+            rolls[entry.idx] = entry.new
+        return rolls
+
+
+class VectorRollHistory(RollHistory):
+    def __init__(self, rolls):
+        self.initial = rolls.copy()
+        self.changes = []
+
+    def _start(self):
+        return self.initial.copy()
+
+    @staticmethod
+    def _apply(rolls, entry):
+        if entry.reason == 'keep':
+            return np.delete(rolls, entry.idx)
+        if entry.reason == 'explode':
+            return np.concatenate((rolls, entry.new))
+        rolls[entry.idx] = entry.new
+        return rolls
+
+
+class DiceRoll:
+    history_class = RollHistory
+
+    def __init__(self, dice_str, plan: Optional['DicePlan'] = None, rng=None, initial=None):
+        # Store Dice String
+        self.dice_str = dice_str
+        self.rng = rng if rng is not None else worker_rng()
+
+        # Decoding and option parsing only depend on the dice string, so they are done once by compile_dice and
+        # shared through the plan cache
+        if plan is None:
+            plan = compile_dice(dice_str)
+        self.plan = plan
+
+        self.num_dice = plan.num_dice
+        self.dice_type = plan.dice_type
+        self.roll_options_str = plan.options_str
+        self.default_cmp = '>='
+
+        self.dice = plan.dice
+        self.sides = plan.dice.sides
+        self.map = plan.dice.map
+        self.face_names = plan.dice.names
+        self.map_values = plan.dice.map_values
+
+        # Prep the counters requested by the options
+        self.successes = 0 if 'threshold' in plan.options else None
+        self.failures = 0 if 'fail_threshold' in plan.options else None
+
+        self.complications = 0 if 'c_threshold' in plan.options else None
+        self.boons = 0 if 'b_threshold' in plan.options else None
+
+        self.min = plan.min
+        self.max = plan.max
+
+        self.history: Optional[RollHistory] = None
+
+        # Now roll, unless the dice were drawn already with draw_initial
+        self.rolls = self._roll(self.num_dice) if initial is None else initial
+
+        if _debug:
+            print(self.rolls)
+            print(self.faces)
+            print(self.values)
+            print(self.sum)
+
+        # Do Options
+        if not _time_stages:
+            self._resolve_options(plan.options)
+        else:
+            start = time.perf_counter()
+            self._resolve_options(plan.options)
+            record_stage('resolve', dice_label(plan), time.perf_counter() - start)
+
+    @property
+    def rolls(self):
+        return self._rolls
+
+    @rolls.setter
+    def rolls(self, rolls):
+        self._rolls = rolls
+        self._invalidate()
+
+    def _invalidate(self):
+        # Anything that changes self.rolls in place has to call this
+        self._derived = {}
+
+    @property
+    def roll_history(self):
+        # The dice as first rolled, if anything changed them since
+        return self.history.initial if self.history else None
+
+    def _history_log(self):
+        # Started on the first change, so rolls that nothing happens to never copy their dice
+        if self.history is None:
+            self.history = self.history_class(self.rolls)
+        return self.history
+
+    def format_faces(self, limit: Optional[int] = None) -> str:
+        """
+        The dice as '[ a, b, ... ]'. Past limit characters they're shown as a count per face instead, or when even
+        that's too long as many dice as fit followed by '+N more'.
+        """
+        return self._format_dice(self.rolls, limit)
+
+    def format_history(self, limit: Optional[int] = None) -> Optional[str]:
+        """The dice as first rolled, or None if nothing changed them. Shortened past limit like format_faces."""
+        if history := self.roll_history:
+            return self._format_dice(history, limit)
+        return None
+
+    def faces_chars(self) -> int:
+        """Length of format_faces() without a limit"""
+        return self._dice_chars(self.rolls)
+
+    def history_chars(self) -> int:
+        """Length of format_history() without a limit, 0 when there's no history"""
+        history = self.roll_history
+        return self._dice_chars(history) if history else 0
+
+    def chars_bound(self) -> int:
+        """At least faces_chars() + history_chars(), from how many dice there are alone"""
+        dice = len(self.rolls) + (len(self.history.initial) if self.history else 0)
+        return dice * (self.dice.face_chars + 2) + 8
+
+    def _dice_faces(self, rolls) -> list:
+        return [self.map[idx] for idx in rolls]
+
+    def _face_counts(self, rolls) -> Counter:
+        # Dice per face in face order, faces that print the same are counted together
+        index_counts = Counter(rolls)
+        face_counts = Counter()
+        for idx in sorted(index_counts):
+            face_counts[self.map[idx]] += index_counts[idx]
+        return face_counts
+
+    def _dice_chars(self, rolls) -> int:
+        # Worked out from the count of each face, so a pool too big to show is never joined
+        if not len(rolls):
+            return 4
+        return sum(len(str(face)) * count for face, count in self._face_counts(rolls).items()) + 2 * len(rolls) + 2
+
+    def _format_dice(self, rolls, limit: Optional[int] = None) -> str:
+        # Every die takes at least 3 characters, so a pool that can't fit is never joined in full
+        if limit is None or 3 * len(rolls) + 2 <= limit:
+            text = '[ ' + ', '.join(map(str, self._dice_faces(rolls))) + ' ]'
+            if limit is None or len(text) <= limit:
+                return text
+
+        counts = [f'{face}: {count}' for face, count in self._face_counts(rolls).items()]
+        text = join_within(counts, '{ ', ' }')
+        if len(text) <= limit:
+            return text
+
+        return join_within(map(str, self._dice_faces(rolls[:max(limit // 3, 0)])), '[ ', ' ]', limit, len(rolls))
+
+    @property
+    def roll_name(self):
+        return f'{self.num_dice}d{self.dice_type}' if self.dice_type != '1' else f'{self.map[0]}'
+
+    @derived_property
+    def faces(self):
+        return [self.map[roll] for roll in self.rolls]
+
+    @derived_property
+    def values(self):
+        value_table = self.dice.values
+        values = [value_table[roll] for roll in self.rolls]
+        return None if None in values else values
+
+    @property
+    def sum(self):
+        return self._limited_sum[0]
+
+    @property
+    def limit_flag(self):
+        return self._limited_sum[1]
+
+    @property
+    def limit_txt(self):
+        return self._limited_sum[2]
+
+    @derived_property
+    def _limited_sum(self):
+        if self.values:
+            return self._apply_limits(sum(self.values))
+        return None, False, ''
+
+    def _apply_limits(self, rsum):
+        if self.min and (rsum < self.min):
+            return self.min, True, '(min)'
+        elif self.max and (rsum > self.max):
+            return self.max, True, '(max)'
+        return rsum, False, ''
+
+    @derived_property
+    def counter(self):
+        named_faces = self.dice.named_faces
+        interesting_list = [r for r in self.faces if r in named_faces]
+        return Counter(interesting_list) if interesting_list else None
+
+    def _roll(self, num_dice):
+        return roll_dice(self.sides, num_dice, self.rng)
+
+    @classmethod
+    def draw_initial(cls, dice_plan: 'DicePlan', rng, repeats: int) -> list:
+        """
+        The dice first rolled for each of repeats rolls of dice_plan, drawn all at once. Handed to the rolls as initial.
+        """
+        num_dice = dice_plan.num_dice
+        rolls = roll_dice(dice_plan.dice.sides, num_dice * repeats, rng)
+        return [rolls[idx * num_dice:(idx + 1) * num_dice] for idx in range(repeats)]
+
+    def _resolve_options(self, option_dict: dict):
+
+        # Reroll any initial dice
+        for idx, face in enumerate(self.faces):
+            if face in option_dict['reroll']:
+                self.reroll(idx)
+                if _debug:
+                    print(f'Rerolled #{idx}: {self.rolls[idx]}')
+
+        # Explode, with any reroll on the new dice
+        if self.plan.chain is not None:
+            if _explode_mode == 'rounds':
+                self._explode_rounds(option_dict)
+            else:
+                self._explode_chains(option_dict)
+
+        # Now do "final roll" operations like keep. The kept dice stay in the order they were rolled
+        if 'keep' in option_dict:
+            kept = select_kept(self.rolls, option_dict['keep'], self.sides)
+            if len(kept) < len(self.rolls):
+                kept_set = set(kept)
+                dropped = [idx for idx in range(len(self.rolls)) if idx not in kept_set]
+                self._history_log().log(dropped, [self.rolls[idx] for idx in dropped], None, 'keep')
+                self.rolls = [self.rolls[idx] for idx in kept]
+
+        # Now calculate results
+        if self.plan.weights:
+            self._apply_weights(Counter(self.rolls).items())
+
+    def _apply_weights(self, face_counts):
+        # One weight table per counter dotted with the (face index, count) pairs
+        for counter_name, table in self.plan.weights.items():
+            total = 0
+            for idx, count in face_counts:
+                weight = table[idx]
+                if weight is None:
+                    raise UnknownDiceValueError(self.dice_type, self.map[idx])
+                total += weight * count
+            setattr(self, counter_name, total)
+
+    def _explode_rounds(self, option_dict: dict):
+        # Iteratively explode and reroll as necessary
+        face_list = list(self.faces)
+        while face_list:
+            self._check_rolled()
+            c = Counter(face_list)
+            if _debug:
+                pprint(c)
+            new_rolls = []
+            # Explode dice
+            for exp_dice in option_dict['explode']:
+                if _debug:
+                    print(f'Trying to explode {exp_dice}: x{c[exp_dice]}')
+                new_rolls.extend(roll_dice(self.sides, c[exp_dice], self.rng))
+
+            new_face_list = [self.map[roll] for roll in new_rolls]
+
+            if _debug:
+                print(new_face_list)
+
+            if _debug:
+                print(f'New Rolls: {new_rolls}')
+                print(f'New Faces: {new_face_list}')
+
+            # Log the new dice as they came up, then any reroll of them
+            if new_rolls:
+                history = self._history_log()
+                start = len(self.rolls)
+                for idx, roll in enumerate(new_rolls):
+                    history.log(start + idx, None, roll, 'explode')
+
+            # Reroll them if needed
+            for idx, face in enumerate(new_face_list):
+                if face in option_dict['reroll']:
+                    old = new_rolls[idx]
+                    reroll_dice(new_rolls, idx, self.sides, self.rng)
+                    history.log(start + idx, old, new_rolls[idx], 'reroll')
+                    if _debug:
+                        print(f'Rerolled #{idx}: {new_rolls[idx]}')
+
+            # Append the new rolls
+            self.rolls.extend(new_rolls)
+            self._invalidate()
+            face_list = [self.map[roll] for roll in new_rolls]
+
+    def _explode_chains(self, option_dict: dict):
+        """
+        Draw how many dice each exploding die adds, then roll just those dice in bulk. Chains are laid out round by
+        round like _explode_rounds does it: every chain still going adds one die per round.
+        """
+        chain = self.plan.chain
+        exploded = sum(face in option_dict['explode'] for face in self.faces)
+        if not exploded:
+            return
+        if chain.chance >= 1:
+            raise RollLimitError(self.dice_str, 'Every face explodes, so it would never stop.')
+
+        lengths = self.rng.chain_lengths(chain.chance, exploded)
+        total = sum(lengths)
+        self._check_rolled(total)
+
+        go_rolls = iter(self.rng.choices(chain.go_faces, chain.go_probs, total - exploded))
+        stop_rolls = iter(self.rng.choices(chain.stop_faces, chain.stop_probs, exploded))
+        history = self._history_log()
+        depth = 1
+        while lengths:
+            new_rolls = [next(go_rolls) if length > depth else next(stop_rolls) for length in lengths]
+            lengths = [length for length in lengths if length > depth]
+            depth += 1
+
+            # Logged like _explode_rounds logs a round: the dice as they came up, then their rerolls
+            start = len(self.rolls)
+            if not chain.reroll_faces:
+                for idx, roll in enumerate(new_rolls):
+                    history.log(start + idx, None, roll, 'explode')
+            else:
+                first_rolls = self._first_rolls(new_rolls, chain)
+                for idx, (first, roll) in enumerate(zip(first_rolls, new_rolls)):
+                    history.log(start + idx, None, roll if first is None else first, 'explode')
+                for idx, (first, roll) in enumerate(zip(first_rolls, new_rolls)):
+                    if first is not None:
+                        history.log(start + idx, first, roll, 'reroll')
+            self.rolls.extend(new_rolls)
+        self._invalidate()
+
+    def _first_rolls(self, new_rolls: List[int], chain: 'ExplodeChain') -> List[Optional[int]]:
+        # The face each new die came up as before it was rerolled, None for the dice that weren't
+        options = chain.reroll_faces + (None,)
+        by_face = defaultdict(list)
+        for idx, roll in enumerate(new_rolls):
+            by_face[roll].append(idx)
+        first_rolls = [None] * len(new_rolls)
+        for roll, positions in by_face.items():
+            for idx, first in zip(positions, self.rng.choices(options, chain.first_probs[roll], len(positions))):
+                first_rolls[idx] = first
+        return first_rolls
+
+    def reroll(self, idx):
+        history = self._history_log()
+        old = self.rolls[idx]
+        self.rolls[idx] = self.rng.integer(self.sides)
+        history.log(idx, old, self.rolls[idx], 'reroll')
+        self._invalidate()
+
+    def _check_rolled(self, adding: int = 0):
+        # Explosions are random, so a roll that was fine on average can still run away
+        if len(self.rolls) + adding > _max_rolled_dice:
+            raise RollLimitError(
+                f'{len(self.rolls) + adding} dice',
+                f'Explosions went past the limit of {_max_rolled_dice}.',
+            )
+
+    def get_print_dict(self):
+        face_list = list(self.faces)
+        print_dict = {
+            'Dice String': self.dice_str,
+            'Faces': face_list,
+            'Rolls': list(self.rolls),
+            'Counts': dict(Counter(face_list)),
+            'Sum': self.sum,
+        }
+
+        if self.successes is not None:
+            print_dict['Successes'] = self.successes
+
+        if self.failures is not None:
+            print_dict['Failures'] = self.failures
+
+        if self.complications is not None:
+            print_dict['Complications'] = self.complications
+
+        if self.boons is not None:
+            print_dict['Boons'] = self.boons
+
+        return print_dict
+
+    def __repr__(self):
+        print_dict = self.get_print_dict()
+
+        return pformat(print_dict, width=80, indent=2)
+
+
+class VectorDiceRoll(DiceRoll):
+    """
+    DiceRoll backed by NumPy. The rolls are an integer array of face indices and faces, values and the success style
+    counters are looked up through the plan's precomputed VectorTables, so large pools never loop in Python per die.
+    """
+    history_class = VectorRollHistory
+
+    @derived_property
+    def faces(self):
+        return self.plan.vector.faces[self.rolls].tolist()
+
+    def _dice_faces(self, rolls) -> list:
+        return self.plan.vector.faces[rolls].tolist()
+
+    def _face_counts(self, rolls) -> Counter:
+        indices, counts = np.unique(rolls, return_counts=True)
+        face_counts = Counter()
+        for idx, count in zip(indices.tolist(), counts.tolist()):
+            face_counts[self.map[idx]] += count
+        return face_counts
+
+    @derived_property
+    def values(self):
+        tables = self.plan.vector
+        if not tables.valued[self.rolls].all():
+            return None
+        return tables.values[self.rolls].tolist()
+
+    @derived_property
+    def _limited_sum(self):
+        tables = self.plan.vector
+        if self.rolls.size and tables.valued[self.rolls].all():
+            return self._apply_limits(int(tables.values[self.rolls].sum()))
+        return None, False, ''
+
+    @derived_property
+    def counter(self):
+        tables = self.plan.vector
+        indices, first_seen, counts = np.unique(self.rolls, return_index=True, return_counts=True)
+        # Keep the faces in the order they first showed up, like Counter does for the list engine
+        counter = Counter()
+        for order in np.argsort(first_seen):
+            face = tables.faces[indices[order]]
+            if face in self.dice.named_faces:
+                counter[face] += int(counts[order])
+        return counter if counter else None
+
+    def _roll(self, num_dice):
+        return self.rng.generator.integers(0, self.sides, size=num_dice)
+
+    @classmethod
+    def draw_initial(cls, dice_plan: 'DicePlan', rng, repeats: int) -> list:
+        return list(rng.generator.integers(0, dice_plan.dice.sides, size=(repeats, dice_plan.num_dice)))
+
+    def _resolve_options(self, option_dict: dict):
+        tables = self.plan.vector
+
+        # Reroll any initial dice
+        reroll_mask = tables.reroll[self.rolls]
+        if reroll_mask.any():
+            history = self._history_log()
+            rerolled = np.flatnonzero(reroll_mask)
+            old = self.rolls[rerolled]
+            self.rolls[rerolled] = self._roll(rerolled.size)
+            history.log(rerolled, old, self.rolls[rerolled], 'reroll')
+            self._invalidate()
+
+        # Explode, with any reroll on the new dice
+        if self.plan.chain is not None:
+            if _explode_mode == 'rounds':
+                self._explode_rounds(option_dict)
+            else:
+                self._explode_chains(option_dict)
+
+        # Now do "final roll" operations like keep, again in the order the dice were rolled
+        if 'keep' in option_dict:
+            kept = select_kept_array(self.rolls, option_dict['keep'], self.sides)
+            if not kept.all():
+                dropped = np.flatnonzero(~kept)
+                self._history_log().log(dropped, self.rolls[dropped], None, 'keep')
+                self.rolls = self.rolls[kept]
+
+        # Now calculate results
+        for counter_name, weights in tables.weights.items():
+            setattr(self, counter_name, int(weights[self.rolls].sum()))
+
+    def _explode_rounds(self, option_dict: dict):
+        tables = self.plan.vector
+        new_rolls = self.rolls
+        while new_rolls.size:
+            self._check_rolled()
+            new_rolls = self._roll(int(tables.explode[new_rolls].sum()))
+            if not new_rolls.size:
+                break
+
+            start = self.rolls.size
+            history = self._history_log()
+            history.log(np.arange(start, start + new_rolls.size), None, new_rolls.copy(), 'explode')
+
+            # Reroll them if needed
+            reroll_mask = tables.reroll[new_rolls]
+            if reroll_mask.any():
+                rerolled = np.flatnonzero(reroll_mask)
+                old = new_rolls[rerolled]
+                new_rolls[rerolled] = self._roll(rerolled.size)
+                history.log(start + rerolled, old, new_rolls[rerolled], 'reroll')
+
+            # Append the new rolls
+            self.rolls = np.concatenate((self.rolls, new_rolls))
+
+    def _explode_chains(self, option_dict: dict):
+        chain = self.plan.chain
+        exploded = int(self.plan.vector.explode[self.rolls].sum())
+        if not exploded:
+            return
+        if chain.chance >= 1:
+            raise RollLimitError(self.dice_str, 'Every face explodes, so it would never stop.')
+
+        generator = self.rng.generator
+        lengths = generator.geometric(1 - chain.chance, size=exploded)
+        total = int(lengths.sum())
+        self._check_rolled(total)
+
+        # Position of every new die in its chain, the last one is the stop face
+        depth = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        last = depth == np.repeat(lengths - 1, lengths)
+        new_rolls = np.empty(total, dtype=self.rolls.dtype)
+        new_rolls[~last] = generator.choice(chain.go_faces, size=total - exploded, p=chain.go_probs)
+        new_rolls[last] = generator.choice(chain.stop_faces, size=exploded, p=chain.stop_probs)
+
+        # Round by round, chains in order within a round
+        order = np.lexsort((np.repeat(np.arange(exploded), lengths), depth))
+        new_rolls = new_rolls[order]
+
+        # The face each die came up as first, for the ones that were rerolled to the face they show
+        first_rolls = new_rolls
+        rerolled = np.zeros(total, dtype=bool)
+        if chain.reroll_faces:
+            cumulative = np.cumsum(np.array(chain.first_probs), axis=1)[:, :-1]
+            first = (generator.random(total)[:, None] >= cumulative[new_rolls]).sum(axis=1)
+            rerolled = first < len(chain.reroll_faces)
+            first_rolls = new_rolls.copy()
+            first_rolls[rerolled] = np.array(chain.reroll_faces)[first[rerolled]]
+
+        # Logged like _explode_rounds logs each round: the dice as they came up, then their rerolls
+        history = self._history_log()
+        start = self.rolls.size
+        round_sizes = np.bincount(depth)
+        ends = np.cumsum(round_sizes)
+        for round_start, round_end in zip(ends - round_sizes, ends):
+            history.log(np.arange(start + round_start, start + round_end), None,
+                        first_rolls[round_start:round_end].copy(), 'explode')
+            round_rerolled = round_start + np.flatnonzero(rerolled[round_start:round_end])
+            if round_rerolled.size:
+                history.log(start + round_rerolled, first_rolls[round_rerolled], new_rolls[round_rerolled], 'reroll')
+        self.rolls = np.concatenate((self.rolls, new_rolls))
+
+    def reroll(self, idx):
+        history = self._history_log()
+        old = self.rolls[idx]
+        self.rolls[idx] = self.rng.generator.integers(0, self.sides)
+        history.log(idx, old, self.rolls[idx], 'reroll')
+        self._invalidate()
+
+    @property
+    def roll_history(self):
+        return self.history.initial.tolist() if self.history else None
+
+
+class HistogramDiceRoll(DiceRoll):
+    """
+    DiceRoll for huge pools. self.rolls is how many dice show each face index instead of a face index per die, so the
+    memory it takes is O(sides) however many dice are rolled. Sums, counters and keep all work from the counts and the
+    formatters print a count per face. Which die was which is never known, so there's no roll order and the history
+    is just the counts as first rolled.
+    """
+
+    def __init__(self, dice_str, plan: Optional['DicePlan'] = None, rng=None, initial=None):
+        self.initial_counts = None
+        super().__init__(dice_str, plan, rng, initial)
+
+    @derived_property
+    def faces(self):
+        # One entry per die, in face order. Only for debugging, this is exactly what the counts are there to avoid.
+        return [self.map[idx] for idx, count in enumerate(self.rolls) for _ in range(count)]
+
+    @derived_property
+    def values(self):
+        value_table = self.dice.values
+        if any(count and value_table[idx] is None for idx, count in enumerate(self.rolls)):
+            return None
+        return [value_table[idx] for idx, count in enumerate(self.rolls) for _ in range(count)]
+
+    @derived_property
+    def _limited_sum(self):
+        value_table = self.dice.values
+        if not any(self.rolls):
+            return None, False, ''
+        rsum = 0
+        for idx, count in enumerate(self.rolls):
+            if count:
+                if value_table[idx] is None:
+                    return None, False, ''
+                rsum += value_table[idx] * count
+        return self._apply_limits(rsum)
+
+    @derived_property
+    def counter(self):
+        named_faces = self.dice.named_faces
+        counter = Counter()
+        for idx, count in enumerate(self.rolls):
+            if count and self.map[idx] in named_faces:
+                counter[self.map[idx]] += count
+        return counter if counter else None
+
+    @property
+    def roll_history(self):
+        return None
+
+    def _roll(self, num_dice):
+        if np is not None:
+            return self.rng.generator.multinomial(num_dice, np.full(self.sides, 1 / self.sides)).tolist()
+        counts = [0] * self.sides
+        for start in range(0, num_dice, _count_batch_dice):
+            batch = self.rng.integers(self.sides, min(_count_batch_dice, num_dice - start))
+            for idx, count in Counter(batch).items():
+                counts[idx] += count
+        return counts
+
+    @classmethod
+    def draw_initial(cls, dice_plan: 'DicePlan', rng, repeats: int) -> list:
+        # Without numpy every roll counts its own dice, None leaves that to the roll
+        if np is None:
+            return [None] * repeats
+        sides = dice_plan.dice.sides
+        return rng.generator.multinomial(dice_plan.num_dice, np.full(sides, 1 / sides), size=repeats).tolist()
+
+    def _reroll_counts(self, counts, reroll_faces):
+        # Every die showing a reroll face is rolled again, once
+        rerolled = 0
+        for idx in reroll_faces:
+            rerolled += counts[idx]
+            counts[idx] = 0
+        if rerolled:
+            for idx, count in enumerate(self._roll(rerolled)):
+                counts[idx] += count
+        return rerolled
+
+    def _resolve_options(self, option_dict: dict):
+        counts = self.rolls
+        initial = list(counts)
+        changed = False
+        reroll_faces = [idx for idx in range(self.sides) if self.map[idx] in option_dict['reroll']]
+        explode_faces = [idx for idx in range(self.sides) if self.map[idx] in option_dict['explode']]
+
+        # Reroll any initial dice
+        changed |= bool(self._reroll_counts(counts, reroll_faces))
+
+        # Explode round by round, every round is one draw of counts
+        exploding = sum(counts[idx] for idx in explode_faces)
+        while exploding:
+            self._check_rolled(exploding)
+            new_counts = self._roll(exploding)
+            self._reroll_counts(new_counts, reroll_faces)
+            for idx, count in enumerate(new_counts):
+                counts[idx] += count
+            exploding = sum(new_counts[idx] for idx in explode_faces)
+            changed = True
+
+        # Keep by walking the faces from the kept end
+        if 'keep' in option_dict:
+            keep_num = option_dict['keep']
+            keep = abs(keep_num)
+            for idx in (range(self.sides) if keep_num > 0 else range(self.sides - 1, -1, -1)):
+                if counts[idx] > keep:
+                    counts[idx] = keep
+                    changed = True
+                keep -= counts[idx]
+
+        self._invalidate()
+        if changed:
+            self.initial_counts = initial
+
+        # Now calculate results
+        if self.plan.weights:
+            self._apply_weights([(idx, count) for idx, count in enumerate(counts) if count])
+
+    def _check_rolled(self, adding: int = 0):
+        rolled = sum(self.rolls) + adding
+        if rolled > _max_rolled_dice:
+            raise RollLimitError(f'{rolled} dice', f'Explosions went past the limit of {_max_rolled_dice}.')
+
+    def format_history(self, limit: Optional[int] = None) -> Optional[str]:
+        return self._format_dice(self.initial_counts, limit) if self.initial_counts is not None else None
+
+    def history_chars(self) -> int:
+        return self._dice_chars(self.initial_counts) if self.initial_counts is not None else 0
+
+    def chars_bound(self) -> int:
+        # Every face that came up once, with the biggest count there could be
+        face_chars = self.dice.face_chars + len(str(sum(self.rolls))) + 4
+        return self.sides * face_chars * (1 if self.initial_counts is None else 2) + 8
+
+    def _face_counts(self, counts) -> Counter:
+        # Faces that print the same are counted together
+        face_counts = Counter()
+        for idx, count in enumerate(counts):
+            if count:
+                face_counts[self.map[idx]] += count
+        return face_counts
+
+    def _dice_chars(self, counts) -> int:
+        face_counts = self._face_counts(counts)
+        return sum(len(f'{face}: {count}') + 2 for face, count in face_counts.items()) + (2 if face_counts else 4)
+
+    def _format_dice(self, counts, limit: Optional[int] = None) -> str:
+        # There's no roll order to show the first few dice in, so a cut list is cut by face instead
+        items = [f'{face}: {count}' for face, count in self._face_counts(counts).items()]
+        text = join_within(items, '{ ', ' }')
+        if limit is None or len(text) <= limit:
+            return text
+        return join_within(items, '{ ', ' }', limit)
+
+    def get_print_dict(self):
+        print_dict = {
+            'Dice String': self.dice_str,
+            'Counts': dict(self._face_counts(self.rolls)),
+            'Sum': self.sum,
+        }
+        for counter_name in _counter_names:
+            if getattr(self, counter_name) is not None:
+                print_dict[counter_name.capitalize()] = getattr(self, counter_name)
+        return print_dict
+
+
+# -------------------------------------------------------------
+#  Roll Plans
+# -------------------------------------------------------------
+
+class DiceType(namedtuple(
+    'DiceType',
+    [
+        'key',
+        'name',
+        'sides',
+        'map',
+        'names',
+        'map_values',
+        'values',
+        'named_faces',
+        'presets',
+        'compares',
+        'vector',
+        'info',
+        'face_chars',
+    ]
+)):
+    """
+    A dice type from dice.json (or a plain dN) compiled once: the faces, their values and the natural options the type
+    sets for itself. Shared by every plan and roll of the type, so nothing in it can be changed.
+    """
+    __slots__ = ()
+
+
+# Face and value arrays of a dice type for the numpy engine
+DiceVector = namedtuple('DiceVector', ['faces', 'values', 'valued'])
+
+# (option key, dice.json key, compare key, compare prefix, dice.json compare key) for the options a dice type sets
+# itself
+_natural_presets = (
+    ('threshold', 'success', 'compare', '=', 'success_op'),
+    ('crit', 'crit_success', None, None, None),
+    ('fail_threshold', 'fail', 'fail_compare', '~', 'fail_op'),
+    ('crit_fail', 'crit_fail', None, None, None),
+    ('b_threshold', 'boon', 'b_compare', 'b', 'boon_op'),
+    ('b_crit', 'crit_boon', None, None, None),
+    ('c_threshold', 'complication', 'c_compare', 'x', 'complication_op'),
+    ('c_crit', 'crit_complication', None, None, None),
+)
+
+
+def compile_dice_type(key: str, dice_info: Dict[str, Any]) -> DiceType:
+    dice_map = dice_faces(dice_info)
+    map_values = dice_info['value'] if 'value' in dice_info else {}
+    face_names = dice_info['names'] if 'names' in dice_info else {}
+    values = face_values(dice_map, map_values)
+
+    compares = {}
+    presets = []
+    for option_key, info_key, compare_key, prefix, info_op_key in _natural_presets:
+        if compare_key and info_op_key in dice_info:
+            compares[compare_key] = prefix + dice_info[info_op_key]
+        if info_key in dice_info and dice_info[info_key]:
+            natural = dice_info[info_key]
+            presets.append((option_key, frozenset(natural) if isinstance(natural, list) else natural))
+            if compare_key:
+                presets.append((compare_key, compares.get(compare_key)))
+
+    vector = None
+    if np is not None:
+        vector = DiceVector(
+            faces=np.array(dice_map, dtype=object),
+            values=np.array([0 if val is None else val for val in values], dtype=np.int64),
+            valued=np.array([val is not None for val in values], dtype=bool),
+        )
+
+    return DiceType(
+        key=key,
+        name=dice_info['dice_name'] if 'dice_name' in dice_info else 'N/A',
+        sides=int(dice_info['sides']) if 'sides' in dice_info else len(dice_map),
+        map=dice_map,
+        names=MappingProxyType(dict(face_names)),
+        map_values=MappingProxyType(dict(map_values)),
+        values=values,
+        named_faces=frozenset(map_values) | frozenset(face_names),
+        presets=tuple(presets),
+        compares=MappingProxyType(compares),
+        vector=vector,
+        info=MappingProxyType(dice_info),
+        face_chars=max(len(str(face)) for face in dice_map),
+    )
+
+
+@lru_cache(maxsize=256)
+def numeric_dice_type(sides: int) -> DiceType:
+    # Plain dN dice are compiled the first time they're rolled and shared from then on
+    return compile_dice_type(str(sides), {'sides': sides})
+
+
+@lru_cache(maxsize=256)
+def constant_dice_type(value: int) -> DiceType:
+    return compile_dice_type('1', {'map': [value]})
+
+
+# Everything about a dice string that doesn't depend on the dice actually rolled. Plans are shared between rolls, so
+# the options are frozen (sets -> frozensets) and wrapped in a read-only mapping.
+DicePlan = namedtuple(
+    'DicePlan',
+    [
+        'dice_str',
+        'num_dice',
+        'dice_type',
+        'options_str',
+        'dice',
+        'options',
+        'min',
+        'max',
+        'weights',
+        'chain',
+        'vector',
+    ]
+)
+
+# Per-face lookup arrays used by VectorDiceRoll. weights maps each counter attribute (successes, failures, ...) that
+# the options turn on to the amount a single face adds to it.
+VectorTables = namedtuple('VectorTables', ['faces', 'values', 'valued', 'reroll', 'explode', 'weights'])
+
+# How explosions play out for one die. A die gets at most one reroll before it's checked, so each face index ends up
+# with chance ((not rerolled) + reroll chance) / sides and a die explodes with the total chance of the exploding faces.
+# The dice added by one explosion are then a geometric run: go faces (exploding) until a stop face, with the face
+# chances of each side renormalized. first_probs has, for each face index a die ends on, the chances it first came up
+# as each of reroll_faces (and was rerolled) or as itself, in that order. It's empty when nothing rerolls.
+ExplodeChain = namedtuple(
+    'ExplodeChain',
+    ['chance', 'go_faces', 'go_probs', 'stop_faces', 'stop_probs', 'reroll_faces', 'first_probs'],
+)
+
+# (counter attribute, threshold key, compare key, crit key, compare prefix, equality compare)
+_tally_categories = (
+    ('successes', 'threshold', 'compare', 'crit', '', '=='),
+    ('failures', 'fail_threshold', 'fail_compare', 'crit_fail', '~', '~='),
+    ('complications', 'c_threshold', 'c_compare', 'c_crit', 'x', 'x='),
+    ('boons', 'b_threshold', 'b_compare', 'b_crit', 'b', 'b='),
+)
+
+_threshold_compares = {
+    '<': (operator.lt, operator.le),
+    '>': (operator.gt, operator.ge),
+    '<=': (operator.le, operator.le),
+    '>=': (operator.ge, operator.ge),
+}
+
+
+def face_weight(face: str, value: Optional[int], op: str, thresh, dub_val, prefix: str, eq_op: str) -> Optional[int]:
+    """
+    How much a single face counts towards a success style counter, with critical faces counting double. None when
+    the comparison needs a value and the face has none.
+    """
+    if op == eq_op:
+        mul = 1 + int(face in dub_val) if dub_val is not None else 1
+        return int(face in thresh) * mul
+
+    if value is None:
+        return None
+
+    if not op.startswith(prefix) or op[len(prefix):] not in _threshold_compares:
+        return 0
+    compare, crit_compare = _threshold_compares[op[len(prefix):]]
+    mul = 1 + int(crit_compare(value, dub_val)) if dub_val is not None else 1
+    return int(compare(value, thresh)) * mul
+
+
+@lru_cache(maxsize=1024)
+def face_weight_table(
+        dice_map: Tuple[str, ...],
+        values: Tuple[Optional[int], ...],
+        op: str,
+        thresh,
+        dub_val,
+        prefix: str,
+        eq_op: str,
+) -> Tuple[Optional[int], ...]:
+    try:
+        return tuple(
+            face_weight(face, value, op, thresh, dub_val, prefix, eq_op) for face, value in zip(dice_map, values)
+        )
+    except TypeError:
+        raise UnknownOperationError(op, "Can't mix face names and numbers in one comparison")
+
+
+def build_face_weights(
+        dice_map: Tuple[str, ...],
+        values: Tuple[Optional[int], ...],
+        options: MappingProxyType,
+        natural_weights: Optional[Dict[tuple, Tuple[Optional[int], ...]]] = None,
+) -> Dict[str, Tuple[Optional[int], ...]]:
+    """
+    Per face index weight tables for each counter the options turn on. Tallying a counter is then a dot product of
+    its table with the face histogram of the roll.
+    """
+    weights = {}
+    for counter_name, table_key in weight_table_keys(dice_map, values, options):
+        table = natural_weights.get(table_key) if natural_weights else None
+        if table is None:
+            table = face_weight_table(*table_key)
+        weights[counter_name] = table
+    return weights
+
+
+def weight_table_keys(dice_map: Tuple[str, ...], values: Tuple[Optional[int], ...], options: MappingProxyType):
+    for counter_name, thresh_key, compare_key, crit_key, prefix, eq_op in _tally_categories:
+        if thresh_key not in options:
+            continue
+        yield counter_name, (
+            dice_map,
+            values,
+            options[compare_key],
+            options[thresh_key],
+            options[crit_key] if crit_key in options else None,
+            prefix,
+            eq_op,
+        )
+
+
+def face_values(dice_map: Tuple[str, ...], map_values: dict) -> Tuple[Optional[int], ...]:
+    values = []
+    for face in dice_map:
+        try:
+            values.append(map_values[face])
+        except KeyError:
+            try:
+                values.append(int(face))
+            except ValueError:
+                values.append(None)
+    return tuple(values)
+
+
+def dice_faces(dice_info: Dict[str, Any]) -> Tuple[str, ...]:
+    dice_map = dice_info['map'] if 'map' in dice_info else range(1, int(dice_info['sides']) + 1)
+    return tuple(str(entry) for entry in dice_map)
+
+
+def build_vector_tables(dice: DiceType, options: MappingProxyType, weights: Dict[str, Tuple[Optional[int], ...]]):
+    if dice.vector is None:
+        return None
+
+    # Faces without a value need the list engine to report them when they're rolled
+    if any(None in table for table in weights.values()):
+        return None
+
+    return VectorTables(
+        faces=dice.vector.faces,
+        values=dice.vector.values,
+        valued=dice.vector.valued,
+        reroll=np.array([face in options['reroll'] for face in dice.map], dtype=bool),
+        explode=np.array([face in options['explode'] for face in dice.map], dtype=bool),
+        weights={counter_name: np.array(table, dtype=np.int64) for counter_name, table in weights.items()},
+    )
+
+
+def explode_chain(dice_map: Tuple[str, ...], options: MappingProxyType) -> Optional[ExplodeChain]:
+    go_faces = tuple(idx for idx, face in enumerate(dice_map) if face in options['explode'])
+    if not go_faces:
+        return None
+    stop_faces = tuple(idx for idx, face in enumerate(dice_map) if face not in options['explode'])
+
+    reroll = options['reroll']
+    reroll_chance = sum(face in reroll for face in dice_map) / len(dice_map)
+    face_chances = [((face not in reroll) + reroll_chance) / len(dice_map) for face in dice_map]
+
+    go_chance = sum(face_chances[idx] for idx in go_faces)
+    stop_chance = sum(face_chances[idx] for idx in stop_faces)
+
+    # A die ends on a face by coming up as any reroll face and then rolling it, 1/sides each, or by coming up as it
+    # when it isn't rerolled
+    reroll_faces = tuple(idx for idx, face in enumerate(dice_map) if face in reroll)
+    first_probs = ()
+    if reroll_faces:
+        first_probs = tuple(
+            tuple(weight / (len(reroll_faces) / len(dice_map) + (face not in reroll))
+                  for weight in [1 / len(dice_map)] * len(reroll_faces) + [float(face not in reroll)])
+            for face in dice_map
+        )
+
+    return ExplodeChain(
+        # Every face explodes, the chain never ends
+        chance=go_chance / (go_chance + stop_chance) if stop_faces else 1.0,
+        go_faces=go_faces,
+        go_probs=tuple(face_chances[idx] / go_chance for idx in go_faces),
+        stop_faces=stop_faces,
+        stop_probs=tuple(face_chances[idx] / stop_chance for idx in stop_faces),
+        reroll_faces=reroll_faces,
+        first_probs=first_probs,
+    )
+
+
+# ops holds the sign each term is shown with, program is the postfix program that works out the total (see Expressions)
+RollPlan = namedtuple(
+    'RollPlan',
+    ['equation_str', 'terms', 'ops', 'program', 'final_compare', 'final_compare_val', 'cost'],
+)
+
+# What rolling a plan is expected to take: the dice asked for, the dice rolled once explosions are counted, the
+# steps spent picking the dice to keep, the characters of the full response and the outcomes its /prob distribution
+# can have. endless is the first term that can never stop exploding, if any.
+RollCost = namedtuple('RollCost', ['dice', 'expected_dice', 'keep_ops', 'output_chars', 'outcomes', 'endless'])
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'size', 'maxsize'])
+
+# Options that only ever touch their own entry in the option dict, so their order relative to other options doesn't
+# change the plan. Everything else (keep, the thresholds and the crits, where a number replaces face names) keeps its
+# order.
+_commutative_options = frozenset(['r', '!', 'min', 'max'])
+
+
+def decode_dice_string(dice_str: str, registry: Optional['DiceRegistry'] = None):
+    registry = registry or dice_registry()
+    num_dice = 1
+    dice_type = '1'
+    roll_options_str = ''
+
+    dice: DiceType
+    if dice_str == '':
+        # If doing nothing, result will be zero anyways
+        dice = constant_dice_type(0)
+    elif num_match := simple_numeric_pattern.match(dice_str):
+        dice = constant_dice_type(int(num_match.group()))
+    else:
+        roll_match = registry.matcher.match(dice_str)
+        try:
+            num_dice = int(roll_match.group('num_dice'))
+            dice_type = roll_match.group('dice_type').upper()
+            roll_options_str = roll_match.group('options')
+        except AttributeError:
+            raise UnknownDiceTypeError(dice_str)
+
+        if _debug:
+            print(f'Roll Options: {roll_options_str}')
+
+        try:
+            dice = registry.types[dice_type]
+        except KeyError:
+            simple_dice_match = simple_numeric_pattern.match(dice_type)
+            # If it can, do it, otherwise try to load the dice info
+            if simple_dice_match:
+                sides = int(simple_dice_match.group())
+                if sides < 1:
+                    raise UnknownDiceTypeError(dice_type, "Illegal numeric dice!")
+                if sides > _max_sides:
+                    raise RollLimitError(f'd{sides}', f'Dice can have at most {_max_sides} sides.')
+                dice = numeric_dice_type(sides)
+            else:
+                raise UnknownDiceTypeError(dice_type)
+
+    return num_dice, dice_type, roll_options_str, dice
+
+
+def tokenize_options(roll_options_str: str) -> List[Tuple[str, str]]:
+    """
+    Split an option string like r1!6k3 into (op, operand) tokens in a single pass. Quotes around face names are tossed.
+    Each option has to start right where the last one ended, anything it can't recognise raises an
+    UnknownOperationError.
+    """
+    tokens = []
+    pos = 0
+    match_at = option_token_pattern.match
+    while pos < len(roll_options_str):
+        match = match_at(roll_options_str, pos)
+        if match is None:
+            raise UnknownOperationError(roll_options_str[pos:])
+        op, operand = match.groups()
+        if "'" in operand or '"' in operand:
+            operand = operand.replace("'", '').replace('"', '')
+        tokens.append((op, operand))
+        pos = match.end()
+
+    return tokens
+
+
+# ------------------------------
+#  Option Handlers
+# ------------------------------
+# Every handler gets (option_dict, op, operand, dice) and writes its option into option_dict. A ValueError out of a
+# handler means the operand needed to be a number.
+
+def _face_set_handler(key: str):
+    def handler(option_dict, op, operand, dice):
+        if not operand:
+            return
+        try:
+            option_dict[key].add(str(int(operand)))
+        except ValueError:
+            option_dict[key] |= form_face_roll_list(operand)
+    return handler
+
+
+def _crit_handler(key: str):
+    # A number is the value to crit on from, face names add to the faces that crit. The two don't mix.
+    def handler(option_dict, op, operand, dice):
+        try:
+            option_dict[key] = int(operand)
+        except ValueError:
+            if not isinstance(option_dict[key], set):
+                raise UnknownOperationError(op, "Can't mix face names and numbers in one critical option.")
+            option_dict[key] |= form_roll_list(operand)
+    return handler
+
+
+def _keep_handler(sign: int):
+    def handler(option_dict, op, operand, dice):
+        option_dict['keep'] = sign * int(operand)
+    return handler
+
+
+def _threshold_handler(key: str, compare_key: str):
+    def handler(option_dict, op, operand, dice):
+        option_dict[key] = int(operand)
+        option_dict[compare_key] = op
+    return handler
+
+
+def _face_threshold_handler(key: str, compare_key: str):
+    def handler(option_dict, op, operand, dice):
+        option_dict[key] |= form_roll_list(operand)
+        option_dict[compare_key] = op
+    return handler
+
+
+def _natural_threshold_handler(key: str, compare_key: str):
+    # Uses the comparison the dice type defines, like b18 on a dDD meaning boon on 18 or higher
+    def handler(option_dict, op, operand, dice):
+        option_dict[key] = int(operand)
+        option_dict[compare_key] = dice.compares.get(compare_key)
+    return handler
+
+
+def _limit_handler(key: str):
+    def handler(option_dict, op, operand, dice):
+        option_dict[key] = int(operand)
+    return handler
+
+
+# op -> (handler, name for MissingOperandError, exclusive group). Only the first option from a group is used, so 4d6k3k1
+# keeps three dice.
+_option_handlers = {
+    '!': (_face_set_handler('explode'), 'Explode', None),
+    'r': (_face_set_handler('reroll'), 'Reroll', None),
+    'k': (_keep_handler(-1), 'Keep', 'keep'),
+    'kl': (_keep_handler(1), 'KeepLowest', 'keep'),
+    'cs': (_crit_handler('crit'), 'Critical Success', None),
+    'cf': (_crit_handler('crit_fail'), 'CriticalFailure', None),
+    'cb': (_crit_handler('b_crit'), 'CriticalBoon', None),
+    'cx': (_crit_handler('c_crit'), 'CriticalComplication', None),
+    '==': (_face_threshold_handler('threshold', 'compare'), 'Success', 'threshold'),
+    '~=': (_face_threshold_handler('fail_threshold', 'fail_compare'), 'Failure', 'fail_threshold'),
+    'b=': (_face_threshold_handler('b_threshold', 'b_compare'), 'Boon', 'b_threshold'),
+    'x=': (_face_threshold_handler('c_threshold', 'c_compare'), 'Complication', 'c_threshold'),
+    'b': (_natural_threshold_handler('b_threshold', 'b_compare'), 'Boon', 'b_threshold'),
+    'x': (_natural_threshold_handler('c_threshold', 'c_compare'), 'Complication', 'c_threshold'),
+    'min': (_limit_handler('min'), 'Minimum', None),
+    'max': (_limit_handler('max'), 'Maximum', None),
+}
+for _prefix, _key, _compare_key in (
+        ('', 'threshold', 'compare'),
+        ('~', 'fail_threshold', 'fail_compare'),
+        ('b', 'b_threshold', 'b_compare'),
+        ('x', 'c_threshold', 'c_compare'),
+):
+    for _op in ('<', '<=', '>', '>='):
+        _option_handlers[_prefix + _op] = (_threshold_handler(_key, _compare_key), 'Compare', _key)
+
+
+def parse_options(dice_str: str, roll_options_str: str, dice: DiceType):
+    option_dict: Dict[str, Union[str, int, set]]
+    option_dict = defaultdict(set)
+
+    # ------------------------------
+    #  Preset Natural Options
+    # ------------------------------
+    # Face lists are copied into sets so options like cs"SS" can add to them
+    for key, value in dice.presets:
+        option_dict[key] = set(value) if isinstance(value, frozenset) else value
+
+    if _debug:
+        print(f'Parsing {roll_options_str}')
+
+    # ------------------------------
+    #  Parse Options
+    # ------------------------------
+    # Parsed in order because the order of options may be important. Like for example, if I say 2d20!r1
+    # I'm saying roll 2d20, explode (on 20), re-roll 1's. But do the re-rolls explode? Do the explodes re-roll?
+    found_groups = set()
+    for op, operand in tokenize_options(roll_options_str) if roll_options_str else ():
+        if _debug:
+            print(f'Option {op}')
+
+        handler, name, group = _option_handlers[op]
+        if group in found_groups:
+            continue
+        try:
+            handler(option_dict, op, operand, dice)
+        except ValueError:
+            if not operand:
+                raise MissingOperandError(name, f'Used in {dice_str}')
+            raise MissingOperandError(name, f'It needs a number, used in {dice_str}')
+        if group is not None:
+            found_groups.add(group)
+
+    min_val = option_dict.pop('min', None)
+    max_val = option_dict.pop('max', None)
+
+    if _debug:
+        pprint(option_dict, indent=2)
+
+    return option_dict, min_val, max_val
+
+
+def freeze_options(option_dict: dict):
+    frozen = {
+        'explode': frozenset(),
+        'reroll': frozenset(),
+    }
+    for key, val in option_dict.items():
+        frozen[key] = frozenset(val) if isinstance(val, (set, list)) else val
+    return MappingProxyType(frozen)
+
+
+def compile_dice(dice_str: str, registry: Optional['DiceRegistry'] = None) -> DicePlan:
+    registry = registry or dice_registry()
+    num_dice, dice_type, roll_options_str, dice = decode_dice_string(dice_str, registry)
+    option_dict, min_val, max_val = parse_options(dice_str, roll_options_str, dice)
+
+    options = freeze_options(option_dict)
+    weights = build_face_weights(dice.map, dice.values, options, registry.natural_weights)
+
+    return DicePlan(
+        dice_str=dice_str,
+        num_dice=num_dice,
+        dice_type=dice_type,
+        options_str=roll_options_str,
+        dice=dice,
+        options=options,
+        min=min_val,
+        max=max_val,
+        weights=weights,
+        chain=explode_chain(dice.map, options),
+        vector=build_vector_tables(dice, options, weights),
+    )
+
+
+# -------------------------------------------------------------
+#  Expressions
+# -------------------------------------------------------------
+# An expression parses into a tree of these, with numbers folded together wherever they meet. Compiling the tree
+# flattens it into a postfix program: an int pushes the value of that term, 'neg' negates the top of the stack and an
+# operator replaces the top two with the result. run_program runs the same program over plain sums (/r), arrays of
+# trials (/sim) or distributions (/prob), given the operators for them.
+
+ExprDice = namedtuple('ExprDice', ['dice_str'])
+ExprNumber = namedtuple('ExprNumber', ['value'])
+ExprNegate = namedtuple('ExprNegate', ['operand'])
+ExprBinary = namedtuple('ExprBinary', ['op', 'left', 'right'])
+
+
+def _divide(a, b):
+    # Rounds down, like halving does at the table
+    if not b:
+        raise UnknownOperationError('/', 'Dividing by zero has no result.')
+    return a // b
+
+
+_scalar_ops = {
+    'neg': operator.neg,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': _divide,
+}
+
+
+def expression_tokens(expr_str: str) -> List[str]:
+    # Spaced out options are joined back onto their dice
+    return [''.join(token.split()) for token in expression_token_pattern.findall(expr_str)]
+
+
+def run_program(program: Tuple[Union[int, str], ...], values, ops: Dict[str, Any] = _scalar_ops):
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for step in program:
+        if step.__class__ is int:
+            push(values[step])
+        elif step == 'neg':
+            push(ops['neg'](pop()))
+        else:
+            right = pop()
+            push(ops[step](pop(), right))
+    return stack[0]
+
+
+class ExpressionParser:
+    """
+    Recursive descent over the tokens of an expression (without its final comparison):
+
+        expr    := product (('+' | '-') product)*
+        product := signed (('*' | '/') signed)*
+        signed  := ('+' | '-')* primary
+        primary := '(' expr ')' | number | dice
+    """
+
+    def __init__(self, expr_str: str):
+        self.expr_str = expr_str
+        self.tokens = expression_tokens(expr_str)
+        self.pos = 0
+        self.depth = 0
+
+    def parse(self):
+        # Nothing at all rolls nothing, which sums to zero
+        if not self.tokens:
+            return ExprDice('')
+        node = self.expr()
+        if self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if token == ')':
+                raise ExpressionError(self.expr_str, "A ')' has no '(' to close.")
+            raise ExpressionError(self.expr_str, f'Expected an operator before {token}.')
+        return node
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def expr(self):
+        node = self.product()
+        while (op := self.peek()) in ('+', '-'):
+            self.pos += 1
+            node = fold(op, node, self.product())
+        return node
+
+    def product(self):
+        node = self.signed()
+        while (op := self.peek()) in ('*', '/'):
+            self.pos += 1
+            node = fold(op, node, self.signed())
+        return node
+
+    def signed(self):
+        negate = False
+        while (op := self.peek()) in ('+', '-'):
+            self.pos += 1
+            negate ^= op == '-'
+        node = self.primary()
+        if not negate:
+            return node
+        if isinstance(node, ExprNumber):
+            return ExprNumber(-node.value)
+        return ExprNegate(node)
+
+    def primary(self):
+        token = self.peek()
+        if token is None or token == ')':
+            op = self.tokens[self.pos - 1] if self.pos else ''
+            raise MissingOperandError(op, f'Used in {self.expr_str}')
+        if token in ('*', '/'):
+            raise MissingOperandError(token, f'Used in {self.expr_str}')
+
+        self.pos += 1
+        if token == '(':
+            self.depth += 1
+            if self.depth > _max_expression_depth:
+                raise RollLimitError(
+                    'Nesting that deep', f'Use at most {_max_expression_depth} levels of parentheses.'
+                )
+            node = self.expr()
+            if self.peek() != ')':
+                raise ExpressionError(self.expr_str, "A '(' is never closed.")
+            self.pos += 1
+            self.depth -= 1
+            return node
+        if simple_numeric_pattern.match(token):
+            return ExprNumber(int(token))
+        return ExprDice(token)
+
+
+def fold(op: str, left, right):
+    """
+    Join two expressions with op, working it out now if both are just numbers.
+    """
+    if isinstance(left, ExprNumber) and isinstance(right, ExprNumber):
+        return ExprNumber(_scalar_ops[op](left.value, right.value))
+    return ExprBinary(op, left, right)
+
+
+def parse_expression(expr_str: str):
+    return ExpressionParser(expr_str).parse()
+
+
+_precedence = {'+': 1, '-': 1, '*': 2, '/': 2, 'neg': 3}
+
+
+def program_text(program: Tuple[Union[int, str], ...], texts: List[str]) -> str:
+    """
+    Write a program back out as an expression, with the text for each term in its place and only the parentheses it
+    needs.
+    """
+    # (text, precedence of its outermost operator)
+    stack = []
+    for step in program:
+        if step.__class__ is int:
+            stack.append((texts[step], 4))
+        elif step == 'neg':
+            text, prec = stack.pop()
+            stack.append((f'-({text})' if prec < 3 else f'-{text}', 3))
+        else:
+            right, right_prec = stack.pop()
+            left, left_prec = stack.pop()
+            prec = _precedence[step]
+            if left_prec < prec:
+                left = f'({left})'
+            # Floor division keeps a*(b/c) apart from a*b/c, so only sums regroup freely
+            if right_prec < prec or (right_prec == prec and step != '+'):
+                right = f'({right})'
+            stack.append((f'{left} {step} {right}', prec))
+    return stack[0][0]
+
+
+def flatten_expression(node, sign: Optional[str], dice_strings: List[str], signs: List[str], program: list):
+    """
+    Append the terms of an expression tree, their signs and its postfix program. A term's sign is how it counts
+    towards the total, '-' after a minus. Terms that are multiplied or divided don't count towards it directly, and
+    are shown as they rolled.
+    """
+    if isinstance(node, ExprBinary):
+        if node.op in ('+', '-'):
+            flatten_expression(node.left, sign, dice_strings, signs, program)
+            flatten_expression(node.right, _flip_sign(sign) if node.op == '-' else sign, dice_strings, signs, program)
+        else:
+            flatten_expression(node.left, None, dice_strings, signs, program)
+            flatten_expression(node.right, None, dice_strings, signs, program)
+        program.append(node.op)
+    elif isinstance(node, ExprNegate) or (isinstance(node, ExprNumber) and node.value < 0):
+        operand = node.operand if isinstance(node, ExprNegate) else ExprNumber(-node.value)
+        flatten_expression(operand, _flip_sign(sign), dice_strings, signs, program)
+        program.append('neg')
+    else:
+        program.append(len(dice_strings))
+        dice_strings.append(node.dice_str if isinstance(node, ExprDice) else str(node.value))
+        signs.append(sign or '+')
+
+
+def _flip_sign(sign: Optional[str]) -> Optional[str]:
+    if sign is None:
+        return None
+    return '-' if sign == '+' else '+'
+
+
+def compile_roll(command_str: str, registry: Optional['DiceRegistry'] = None) -> RollPlan:
+    cmp_op = None
+    cmp_val = None
+    # Find the one comparison operator supported
+    try:
+        command_str, cmp_op, cmp_val, _ = supported_comparisons.split(command_str, 1)
+    except ValueError:
+        pass
+
+    dice_strings = []
+    signs = []
+    program = []
+    flatten_expression(parse_expression(command_str), '+', dice_strings, signs, program)
+
+    terms = tuple(compile_dice(dice_str, registry) for dice_str in dice_strings)
+    return RollPlan(
+        equation_str=command_str,
+        terms=terms,
+        ops=tuple(signs),
+        program=tuple(program),
+        final_compare=cmp_op,
+        final_compare_val=int(cmp_val) if cmp_val else None,
+        cost=estimate_cost(terms),
+    )
+
+
+def estimate_cost(terms: Tuple[DicePlan, ...]) -> RollCost:
+    dice = 0
+    expected_dice = 0.0
+    keep_ops = 0.0
+    output_chars = 0.0
+    outcomes = 1.0
+    endless = None
+
+    for dice_plan in terms:
+        dice += dice_plan.num_dice
+        chance = dice_plan.chain.chance if dice_plan.chain else 0.0
+        if chance >= 1 and dice_plan.num_dice:
+            endless = endless or dice_plan.dice_str
+            term_dice = inf
+        elif chance >= 1:
+            term_dice = 0.0
+        else:
+            # Every die sets off a geometric run of explosions
+            term_dice = dice_plan.num_dice / (1 - chance)
+        expected_dice += term_dice
+
+        options = dice_plan.options
+        if 'keep' in options and term_dice > 1:
+            # Counted pools walk their faces once. Otherwise the same choice select_kept makes: scan the dice once per
+            # face it expects to walk, a heap of the kept dice or a sort of them all
+            keep = abs(options['keep'])
+            sides = dice_plan.dice.sides
+            method = keep_method(term_dice, keep, sides)
+            if uses_face_counts(dice_plan):
+                keep_ops += sides
+            elif method == 'scan':
+                keep_ops += sides * keep + term_dice
+            elif method == 'heap':
+                keep_ops += term_dice * log2(keep + 1)
+            else:
+                keep_ops += term_dice * log2(term_dice)
+
+        # Each die is a face and a separator, and the full response repeats the rolls in the history. Pools held as
+        # counts print a face and its count for every face that came up instead.
+        dice_map = dice_plan.dice.map
+        face_chars = sum(map(len, dice_map)) / len(dice_map) + 2
+        has_history = options['reroll'] or options['explode'] or 'keep' in options
+        if uses_face_counts(dice_plan) and term_dice < inf:
+            shown = min(dice_plan.dice.sides, term_dice) * (face_chars + len(str(int(term_dice))) + 2)
+        else:
+            shown = term_dice * face_chars
+        output_chars += shown * (2 if has_history else 1)
+
+        # Each die spreads the sum over its range of values, once more for every explosion in the longest chain /prob
+        # follows (die_distribution doubles its chains until they're less likely than _explode_epsilon)
+        values = [val for val in dice_plan.dice.values if val is not None]
+        spread = max(values, default=0) - min(values, default=0)
+        if 0 < chance < 1:
+            spread *= 2 ** max(ceil(log2(log(_explode_epsilon) / log(chance))), 1)
+        outcomes += dice_plan.num_dice * spread
+
+    return RollCost(
+        dice=dice,
+        expected_dice=expected_dice,
+        keep_ops=keep_ops,
+        output_chars=output_chars,
+        outcomes=outcomes,
+        endless=endless,
+    )
+
+
+def check_roll_cost(cost: RollCost, check_output: bool = True, check_outcomes: bool = False):
+    """
+    Raise a RollLimitError if rolling something with this cost would go over any of the limits. The outcomes only
+    matter to /prob, which works the whole distribution out.
+    """
+    if cost.endless:
+        raise RollLimitError(cost.endless, 'Every face explodes, so it would never stop.')
+    if cost.dice > _max_dice:
+        raise RollLimitError(f'{cost.dice} dice', f'The limit is {_max_dice}.')
+    if cost.expected_dice > _max_expected_dice:
+        raise RollLimitError(
+            f'About {cost.expected_dice:.0f} dice with explosions',
+            f'The limit is {_max_expected_dice}.',
+        )
+    if cost.keep_ops > _max_keep_ops:
+        raise RollLimitError('Keeping from that many dice', 'Try fewer dice or fewer explosions.')
+    if check_output and cost.output_chars > _max_output_chars:
+        raise RollLimitError(
+            f'About {cost.output_chars:.0f} characters of results',
+            f'The limit is {_max_output_chars}.',
+        )
+    if check_outcomes and cost.outcomes > _max_prob_outcomes:
+        raise RollLimitError(
+            f'About {cost.outcomes:.0f} possible sums',
+            f'The limit for /prob is {_max_prob_outcomes}, try /sim instead.',
+        )
+
+
+def normalize_options(roll_options_str: str):
+    try:
+        tokens = tokenize_options(roll_options_str)
+    except UnknownOperationError:
+        # Not a valid option string, it'll fail to compile anyways
+        return roll_options_str
+
+    ordered = [token for token in tokens if token[0] not in _commutative_options]
+    ordered.extend(sorted((token for token in tokens if token[0] in _commutative_options), key=operator.itemgetter(0)))
+    return tuple(ordered)
+
+
+def normalize_expression(command_str: str, registry: Optional['DiceRegistry'] = None):
+    """
+    Build the plan cache key for a roll command. Expressions that only differ in spacing, dice name case or the order of
+    independent options (like r1!6 vs !6r1) map to the same key.
+    """
+    matcher = (registry or dice_registry()).matcher
+    command_str = whitespace_pattern.sub(' ', command_str).strip()
+
+    cmp_key = None
+    try:
+        command_str, cmp_op, cmp_val, _ = supported_comparisons.split(command_str, 1)
+        cmp_key = (cmp_op, int(cmp_val))
+    except ValueError:
+        pass
+
+    terms = []
+    for dice_str in expression_tokens(command_str):
+        if roll_match := matcher.match(dice_str):
+            terms.append((
+                int(roll_match.group('num_dice')),
+                roll_match.group('dice_type').upper(),
+                normalize_options(roll_match.group('options')),
+            ))
+        else:
+            terms.append(dice_str)
+
+    return tuple(terms), cmp_key
+
+
+class PlanCache:
+    """
+    Bounded LRU of compiled RollPlans, keyed by the normalized expression. The raw command strings are remembered as
+    aliases of their key, so an exact repeat skips the normalization too.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._plans: 'OrderedDict[Any, RollPlan]' = OrderedDict()
+        self._aliases: Dict[str, Any] = {}
+        # Rolls are evaluated on worker threads
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, command_str: str) -> RollPlan:
+        # Compile against one snapshot of the dice file, even if it's reloaded part way through
+        registry = dice_registry()
+        key = self._aliases.get(command_str)
+        if key is None:
+            key = normalize_expression(command_str, registry)
+
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                self._plans.move_to_end(key)
+            else:
+                self.misses += 1
+
+        if plan is None:
+            plan = compile_roll(command_str, registry)
+
+        with self._lock:
+            # A plan compiled against a dice file that has since been reloaded is used, but not kept
+            if registry is not _dice_registry:
+                return plan
+
+            if key not in self._plans:
+                self._plans[key] = plan
+                if len(self._plans) > self.maxsize:
+                    self._plans.popitem(last=False)
+                    self.evictions += 1
+
+            # Aliases of evicted plans just recompile, so only their count needs bounding
+            if len(self._aliases) >= 4 * self.maxsize:
+                self._aliases.clear()
+            self._aliases[command_str] = key
+
+        return plan
+
+    def discard_dice_types(self, dice_types) -> int:
+        """
+        Drop the plans, and the aliases of plans, that roll any of the given dice types. Returns the number of plans
+        dropped.
+        """
+        def stale(key):
+            terms, _ = key
+            return any(isinstance(term, tuple) and term[1] in dice_types for term in terms)
+
+        with self._lock:
+            stale_keys = [key for key in self._plans if stale(key)]
+            for key in stale_keys:
+                del self._plans[key]
+            for command_str in [command_str for command_str, key in self._aliases.items() if stale(key)]:
+                del self._aliases[command_str]
+        return len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self._aliases.clear()
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._plans),
+            maxsize=self.maxsize,
+        )
+
+
+plan_cache = PlanCache(int(environ.get('PLAN_CACHE_SIZE', 256)))
+
+
+# -------------------------------------------------------------
+#  Exceptions
+# -------------------------------------------------------------
+
+class UnknownDiceTypeError(Exception):
+    def __init__(self, dice_type: str, message: str = ''):
+        self.dice_type = dice_type
+        self.message = message
+        # All the arguments go to Exception so the error survives the trip back from a worker process
+        super().__init__(dice_type, message)
+
+    def __str__(self):
+        return f'{self.dice_type} is undefined. {self.message}'
+
+
+class UnknownDiceValueError(UnknownDiceTypeError):
+    def __init__(self, dice_type: str, dice_roll: Union[int, str], message: str = ''):
+        self.dice_roll = dice_roll
+        super().__init__(dice_type, message)
+        self.args = (dice_type, dice_roll, message)
+
+    def __str__(self):
+        return f'{self.dice_roll} has no value in {self.dice_type}. {self.message}'
+
+
+class UnknownOperationError(Exception):
+    def __init__(self, op: str, message: str = ''):
+        self.op = op
+        self.message = message
+        super().__init__(op, message)
+
+    def __str__(self):
+        return f'{self.op} is not a supported operation. {self.message}'
+
+
+class MissingOperandError(Exception):
+    def __init__(self, op: str, message: str = ''):
+        self.op = op
+        self.message = message
+        super().__init__(op, message)
+
+    def __str__(self):
+        return f'{self.op} requires an operand. {self.message}'
+
+
+class ExpressionError(Exception):
+    def __init__(self, expr_str: str, message: str = ''):
+        self.expr_str = expr_str
+        self.message = message
+        super().__init__(expr_str, message)
+
+    def __str__(self):
+        return f'{self.expr_str.strip()} is not a valid expression. {self.message}'
+
+
+class RollLimitError(Exception):
+    def __init__(self, what: str, message: str = ''):
+        self.what = what
+        self.message = message
+        super().__init__(what, message)
+
+    def __str__(self):
+        return f'{self.what} is too much to roll. {self.message}'
+
+
+class DiceFileError(Exception):
+    def __init__(self, dice_path: str, message: str = ''):
+        self.dice_path = dice_path
+        self.message = message
+        super().__init__(dice_path, message)
+
+    def __str__(self):
+        return f'{self.dice_path} is not a usable dice file. {self.message}'
+
+
+# -------------------------------------------------------------
+#  Rolling Functions
+# -------------------------------------------------------------
+
+# One complete build of a dice file: the compiled dice types, the dice string matcher for their names and the weight
+# tables for their natural options
+DiceRegistry = namedtuple('DiceRegistry', ['path', 'mtime', 'types', 'matcher', 'natural_weights'])
+
+dice_name_pattern = re.compile(
+    r'^[A-Z]+$'
+)
+
+_compare_ops = frozenset(['=', '<', '>', '<=', '>='])
+
+
+def validate_dice_info(dice_path: str, key: str, dice_info) -> None:
+    if not dice_name_pattern.match(key):
+        raise DiceFileError(dice_path, f'Dice names are upper case letters only, not {key!r}.')
+    if not isinstance(dice_info, dict):
+        raise DiceFileError(dice_path, f'{key} should be an object.')
+    if 'map' in dice_info:
+        if not isinstance(dice_info['map'], list) or not dice_info['map']:
+            raise DiceFileError(dice_path, f'The map of {key} should be a list of faces.')
+    elif not isinstance(dice_info.get('sides'), int) or dice_info['sides'] < 1:
+        raise DiceFileError(dice_path, f'{key} needs a map or a number of sides.')
+    for op_key in ('success_op', 'fail_op', 'boon_op', 'complication_op'):
+        if op_key in dice_info and dice_info[op_key] not in _compare_ops:
+            raise DiceFileError(dice_path, f'{op_key} of {key} should be one of {", ".join(sorted(_compare_ops))}.')
+
+
+def read_dice_registry(dice_path: str = _dice_path) -> DiceRegistry:
+    """
+    Read, check and compile a dice file. Doesn't touch the registry in use, so a bad file never replaces a good one.
+    """
+    try:
+        mtime = stat(dice_path).st_mtime
+        with open(dice_path, 'r') as dice_file:
+            dice_infos = json.load(dice_file)
+    except (OSError, ValueError) as excp:
+        raise DiceFileError(dice_path, str(excp))
+
+    if not isinstance(dice_infos, dict):
+        raise DiceFileError(dice_path, 'It should be an object of dice types.')
+
+    types = {}
+    for key, dice_info in dice_infos.items():
+        validate_dice_info(dice_path, key, dice_info)
+        try:
+            types[key] = compile_dice_type(key, dice_info)
+        except (KeyError, TypeError, ValueError) as excp:
+            raise DiceFileError(dice_path, f'{key} could not be compiled: {excp!r}')
+
+    supported_dice = (
+        r'|'.join(map(str, sorted(types, key=len, reverse=True)))
+    )
+
+    supported_lc_dice = (
+        r'|'.join(map(lambda x: x.lower(), sorted(types, key=len, reverse=True)))
+    )
+
+    matcher = re.compile(
+        r'(?P<num_dice>\d+)[dD](?P<dice_type>\d+|'
+        + supported_dice
+        + r'|'
+        + supported_lc_dice
+        + r')(?P<options>.*)'
+    )
+
+    # Weight tables for the natural options, so plans that don't set their own thresholds never build one
+    natural_weights = {}
+    for key, dice in types.items():
+        option_dict, _, _ = parse_options(key, '', dice)
+        for _, table_key in weight_table_keys(dice.map, dice.values, freeze_options(option_dict)):
+            natural_weights[table_key] = face_weight_table(*table_key)
+
+    return DiceRegistry(
+        path=dice_path,
+        mtime=mtime,
+        types=MappingProxyType(types),
+        matcher=matcher,
+        natural_weights=MappingProxyType(natural_weights),
+    )
+
+
+def changed_dice_types(old_types, new_types) -> set:
+    """
+    Names of the old dice types whose plans can't be trusted with the new ones. That's every type that was removed or
+    changed, plus any type whose name starts a new name, since the matcher now prefers the longer name.
+    """
+    added = [key for key in new_types if key not in old_types]
+    return {
+        key for key, dice in old_types.items()
+        if key not in new_types
+        or dice.info != new_types[key].info
+        or any(new_key.startswith(key) for new_key in added)
+    }
+
+
+def install_dice_registry(registry: DiceRegistry) -> set:
+    """
+    Swap in a new registry and drop the cached plans of the dice types it changed. Rolls already compiled keep the dice
+    types they were compiled with. Returns the names of the changed dice types.
+    """
+    global _dice_registry
+
+    old_registry, _dice_registry = _dice_registry, registry
+    if old_registry is None:
+        return set()
+
+    stale = changed_dice_types(old_registry.types, registry.types)
+    if stale:
+        plan_cache.discard_dice_types(stale)
+    return stale
+
+
+def load_dice_types(dice_path: str = _dice_path):
+    install_dice_registry(read_dice_registry(dice_path))
+
+
+def dice_registry() -> DiceRegistry:
+    """
+    The dice file rolls are made from, once init_engine (or load_dice_types) has loaded one.
+    """
+    if _dice_registry is None:
+        raise DiceFileError(_dice_path, 'No dice file is loaded, call init_engine first.')
+    return _dice_registry
+
+
+# The engine settings the bot reads, as they are when it asks
+EngineConfig = namedtuple('EngineConfig', ['dice_path', 'debug', 'sim_time_budget'])
+
+
+def engine_config() -> EngineConfig:
+    return EngineConfig(dice_path=_dice_path, debug=_debug, sim_time_budget=_sim_time_budget)
+
+
+def init_engine(dice_path: str = _dice_path, time_stages: bool = False) -> DiceRegistry:
+    """
+    Load the dice file and get ready to roll, nothing can be rolled before this. With time_stages, every roll logs how
+    long its stages took for collect_stages.
+    """
+    global _time_stages
+    _time_stages = time_stages
+    load_dice_types(dice_path)
+    return _dice_registry
+
+
+def init_worker(dice_path: str, time_stages: bool = False):
+    # Runs in each new worker process. The pid keeps its RNG streams apart from every other process's.
+    global _rng_process
+    _rng_process = getpid()
+    init_engine(dice_path, time_stages)
+
+
+def form_roll_list(operand_str):
+    operand_set = set()
+    operand_str_list = operand_str.split(',')
+    for op in operand_str_list:
+        try:
+            operand_set.add(int(op))
+        except ValueError:
+            operand_set.add(op)
+
+    return operand_set
+
+
+def form_face_roll_list(operand_str):
+    operand_set = set(operand_str.split(','))
+    return operand_set
+
+
+def roll_dice(sides: int, num_dice: int, rng=None):
+    return (rng or worker_rng()).integers(sides, num_dice)
+
+
+def reroll_dice(roll_list, idx, sides, rng=None):
+    roll_list[idx] = (rng or worker_rng()).integer(sides)
+
+
+# How select_kept picks the dice, tuned with benchmarks/bench_keep.py. The faces are walked from the kept end while
+# that's expected to scan at most _keep_scan_faces faces per die, a heap picks a few dice out of many and anything else
+# (small pools, or keeping half the dice or more) sorts them all.
+_keep_scan_faces = 4
+_keep_heap_dice = 32
+
+
+def keep_method(num_dice: float, keep: int, sides: int) -> str:
+    if 2 * keep >= num_dice:
+        return 'sort'
+    if sides * keep <= _keep_scan_faces * num_dice:
+        return 'scan'
+    if keep * _keep_heap_dice <= num_dice:
+        return 'heap'
+    return 'sort'
+
+
+def select_kept(rolls: List[int], keep_num: int, sides: int) -> List[int]:
+    """
+    Positions of the dice a keep holds on to, in the order they were rolled. keep_num > 0 keeps that many of the lowest
+    face indices and keep_num < 0 the highest, the same dice slicing the sorted rolls would keep. Among equal faces at
+    the cut the earliest dice are kept.
+
+    Scanning walks the faces from the kept end and list.index finds the dice showing each one, so the only loop in
+    Python is over the kept dice. The heap is O(n log k) and the sort O(n log n), both stable so ties go the same way.
+    """
+    keep = abs(keep_num)
+    if keep >= len(rolls):
+        return list(range(len(rolls)))
+    if not keep:
+        return []
+
+    method = keep_method(len(rolls), keep, sides)
+    if method == 'sort':
+        kept = sorted(range(len(rolls)), key=rolls.__getitem__, reverse=keep_num < 0)[:keep]
+        kept.sort()
+        return kept
+    if method == 'heap':
+        select = heapq.nsmallest if keep_num > 0 else heapq.nlargest
+        return sorted(select(keep, range(len(rolls)), key=rolls.__getitem__))
+
+    kept = []
+    for face in (range(sides) if keep_num > 0 else range(sides - 1, -1, -1)):
+        idx = -1
+        try:
+            while keep:
+                idx = rolls.index(face, idx + 1)
+                kept.append(idx)
+                keep -= 1
+        except ValueError:
+            # No more dice showing this face
+            pass
+        if not keep:
+            break
+    kept.sort()
+    return kept
+
+
+def select_kept_array(rolls, keep_num: int, sides: int):
+    """
+    select_kept for the numpy engine: a boolean mask of the kept dice, from a bincount of the faces
+    """
+    keep = abs(keep_num)
+    if keep >= rolls.size:
+        return np.ones(rolls.size, dtype=bool)
+    if not keep:
+        return np.zeros(rolls.size, dtype=bool)
+
+    counts = np.bincount(rolls, minlength=sides)
+    if keep_num < 0:
+        counts = counts[::-1]
+    reached = np.cumsum(counts)
+    cut = int(np.searchsorted(reached, keep))
+    ties = keep - (int(reached[cut - 1]) if cut else 0)
+    if keep_num > 0:
+        kept = rolls < cut
+    else:
+        cut = sides - 1 - cut
+        kept = rolls > cut
+    kept[np.flatnonzero(rolls == cut)[:ties]] = True
+    return kept
+
+
+# Dice drawn at a time when HistogramDiceRoll has no numpy to draw the counts with
+_count_batch_dice = 65536
+
+
+def uses_face_counts(dice_plan: DicePlan, engine: Optional[str] = None) -> bool:
+    """Whether a term is rolled as a count per face (HistogramDiceRoll) rather than a face per die"""
+    if (engine or _dice_engine) == 'counts':
+        return True
+    return bool(_count_min_dice) and dice_plan.num_dice >= _count_min_dice
+
+
+def select_roll_class(dice_plan: DicePlan, engine: Optional[str] = None):
+    engine = engine or _dice_engine
+    if uses_face_counts(dice_plan, engine):
+        return HistogramDiceRoll
+    if dice_plan.vector is None or engine == 'python':
+        return DiceRoll
+    if engine == 'numpy' or dice_plan.num_dice >= _vector_min_dice:
+        return VectorDiceRoll
+    return DiceRoll
+
+
+def roll_command(command_str: str, engine: Optional[str] = None, rng=None):
+    """
+    Roll an expression. rng is any of the backends from make_rng, the calling thread's own stream by default.
+    """
+    if not _time_stages:
+        plan = plan_cache.get(command_str)
+    else:
+        start = time.perf_counter()
+        plan = plan_cache.get(command_str)
+        record_stage('parse', expression_label(plan), time.perf_counter() - start)
+    check_roll_cost(plan.cost)
+    return roll_plan(plan, engine, rng if rng is not None else worker_rng())
+
+
+def roll_plan(plan: RollPlan, engine: Optional[str] = None, rng=None, initial=None) -> 'Equation':
+    """
+    Roll a compiled plan, after its cost was checked. initial holds the dice each term first rolled if they were drawn
+    already, see DiceRoll.draw_initial.
+    """
+    # Create the Equation that will do the math
+    equation = Equation(plan.equation_str)
+    equation.ops = list(plan.ops)
+    equation.program = plan.program
+    equation.final_compare = plan.final_compare
+    equation.final_compare_val = plan.final_compare_val
+
+    rolls = []
+
+    # Creating the roll objects actually rolls the dice
+    for idx, dice_plan in enumerate(plan.terms):
+        roll_class = select_roll_class(dice_plan, engine)
+        term_initial = initial[idx] if initial is not None else None
+        if not _time_stages:
+            dice_roll_obj = roll_class(dice_plan.dice_str, dice_plan, rng, term_initial)
+        else:
+            start = time.perf_counter()
+            dice_roll_obj = roll_class(dice_plan.dice_str, dice_plan, rng, term_initial)
+            record_stage('roll', dice_label(dice_plan), time.perf_counter() - start)
+        rolls.append(dice_roll_obj)
+
+    equation.rolls = rolls
+
+    return equation
+
+
+# One expression of a roll command, rolled repeat times
+RolledExpression = namedtuple('RolledExpression', ['expr', 'repeat', 'plan', 'equations'])
+
+
+def split_batch(command_str: str) -> List[Tuple[str, int]]:
+    """
+    The expressions of a roll command, separated by ';', with how many times to roll each ('6x 4d6k3' is 6).
+    """
+    items = []
+    for expr in batch_separator_pattern.split(command_str.strip()):
+        if not expr:
+            continue
+        repeat = 1
+        if repeat_match := repeat_pattern.match(expr):
+            repeat = int(repeat_match.group('repeat'))
+            expr = repeat_match.group('expr')
+        items.append((expr, repeat))
+    return items or [(command_str, 1)]
+
+
+def batch_cost(costs: List[Tuple[RollCost, int]]) -> RollCost:
+    """
+    Cost of rolling each (cost, repeat) repeat times
+    """
+    return RollCost(
+        dice=sum(cost.dice * repeat for cost, repeat in costs),
+        expected_dice=sum(cost.expected_dice * repeat for cost, repeat in costs),
+        keep_ops=sum(cost.keep_ops * repeat for cost, repeat in costs),
+        output_chars=sum(cost.output_chars * repeat for cost, repeat in costs),
+        outcomes=max((cost.outcomes for cost, _ in costs), default=1.0),
+        endless=next((cost.endless for cost, _ in costs if cost.endless), None),
+    )
+
+
+def batch_label(batch: List[RolledExpression]) -> str:
+    return '+'.join(sorted({dice_label(dice_plan) for item in batch for dice_plan in item.plan.terms}))
+
+
+def roll_batch(command_str: str, engine: Optional[str] = None, rng=None) -> List[RolledExpression]:
+    """
+    Roll every expression of a command like '6x 4d6k3; 1d20+5'. Each expression is compiled once however often it's
+    repeated, the limits apply to the whole batch, and each term's first dice for all the repeats are drawn at once.
+    """
+    start = time.perf_counter() if _time_stages else None
+    items = split_batch(command_str)
+    rolls = sum(repeat for _, repeat in items)
+    if rolls > _max_batch_rolls:
+        raise RollLimitError(f'{rolls} rolls', f'Ask for 1 to {_max_batch_rolls} in one message.')
+    plans = [plan_cache.get(expr) for expr, _ in items]
+    if start is not None:
+        record_stage('parse', '+'.join(sorted({expression_label(plan) for plan in plans})), time.perf_counter() - start)
+    check_roll_cost(batch_cost([(plan.cost, repeat) for plan, (_, repeat) in zip(plans, items)]))
+    rng = rng if rng is not None else worker_rng()
+
+    batch = []
+    for plan, (expr, repeat) in zip(plans, items):
+        if repeat == 1:
+            equations = [roll_plan(plan, engine, rng)]
+        else:
+            drawn = [
+                select_roll_class(dice_plan, engine).draw_initial(dice_plan, rng, repeat) for dice_plan in plan.terms
+            ]
+            equations = [
+                roll_plan(plan, engine, rng, [term_drawn[idx] for term_drawn in drawn]) for idx in range(repeat)
+            ]
+        batch.append(RolledExpression(expr, repeat, plan, equations))
+    return batch
+
+
+# -------------------------------------------------------------
+#  Probability Functions
+# -------------------------------------------------------------
+
+# probs[i] is the chance of offset + i. Distributions of a single die can be partial (sum < 1): the missing chance is
+# that of rolling a face without a value, which leaves the roll without a sum.
+Distribution = namedtuple('Distribution', ['offset', 'probs'])
+
+ProbResult = namedtuple('ProbResult', ['plan', 'distribution', 'mean', 'stdev', 'percentiles', 'compare_chance'])
+
+_percentiles = (5, 25, 50, 75, 95)
+
+# Explosion chains are summed until the chance of a longer chain drops below this
+_explode_epsilon = 1e-12
+
+# Below this length np.convolve beats the FFT
+_fft_min_size = 64
+
+
+def _convolve(a: Tuple[float, ...], b: Tuple[float, ...]) -> Tuple[float, ...]:
+    if np is not None:
+        if min(len(a), len(b)) >= _fft_min_size:
+            out_len = len(a) + len(b) - 1
+            fft_len = 1 << (out_len - 1).bit_length()
+            out = np.fft.irfft(np.fft.rfft(a, fft_len) * np.fft.rfft(b, fft_len), fft_len)[:out_len]
+            # FFT round off can leave tiny negative chances
+            return tuple(np.clip(out, 0, None).tolist())
+        return tuple(np.convolve(a, b).tolist())
+
+    out = [0.0] * (len(a) + len(b) - 1)
+    for i, pa in enumerate(a):
+        if pa:
+            for j, pb in enumerate(b):
+                out[i + j] += pa * pb
+    return tuple(out)
+
+
+def convolve_distributions(a: Distribution, b: Distribution) -> Distribution:
+    if not a.probs or not b.probs:
+        return Distribution(0, ())
+    return Distribution(a.offset + b.offset, _convolve(a.probs, b.probs))
+
+
+def add_distributions(a: Distribution, b: Distribution) -> Distribution:
+    offset = min(a.offset, b.offset)
+    probs = [0.0] * (max(a.offset + len(a.probs), b.offset + len(b.probs)) - offset)
+    for dist in (a, b):
+        for idx, prob in enumerate(dist.probs, dist.offset - offset):
+            probs[idx] += prob
+    return Distribution(offset, tuple(probs))
+
+
+def point_distribution(value: int, prob: float = 1.0) -> Distribution:
+    return Distribution(value, (prob,))
+
+
+def _face_distribution(values, chances, mask) -> Optional[Distribution]:
+    faces = [(val, chance) for val, chance, wanted in zip(values, chances, mask) if wanted and val is not None]
+    if not faces:
+        return None
+    offset = min(val for val, _ in faces)
+    probs = [0.0] * (max(val for val, _ in faces) - offset + 1)
+    for val, chance in faces:
+        probs[val - offset] += chance
+    return Distribution(offset, tuple(probs))
+
+
+@lru_cache(maxsize=256)
+def die_distribution(
+        dice_type: str,
+        values: Tuple[Optional[int], ...],
+        reroll: Tuple[bool, ...],
+        explode: Tuple[bool, ...],
+) -> Distribution:
+    """
+    Distribution of a single die (with any explosions it sets off) for the per-face values and reroll/explode flags.
+    """
+    sides = len(values)
+    reroll_chance = sum(reroll) / sides
+    # A die is rerolled once, so every face also gets its share of the rerolled chance
+    chances = [(not rerolled) / sides + reroll_chance / sides for rerolled in reroll]
+
+    stop = _face_distribution(values, chances, [not exploded for exploded in explode])
+    if not any(explode):
+        return stop or Distribution(0, ())
+
+    if all(explode):
+        raise RollLimitError(f'd{dice_type}', 'Every face explodes, so it would never stop.')
+    explode_chance = sum(chance for chance, exploded in zip(chances, explode) if exploded)
+
+    # Each exploding face adds its value and rolls again: stop * (1 + go + go^2 + ...). The series is summed by
+    # doubling, (1 + go)(1 + go^2)(1 + go^4)... takes in every chain shorter than the next power of two, so it takes
+    # a convolution per doubling rather than one per chain length.
+    go = _face_distribution(values, chances, explode)
+    if stop is None or go is None:
+        return Distribution(0, ())
+    total = stop
+    chain_chance = explode_chance
+    while True:
+        total = add_distributions(total, convolve_distributions(total, go))
+        chain_chance *= chain_chance
+        if chain_chance <= _explode_epsilon:
+            return total
+        go = convolve_distributions(go, go)
+
+
+@lru_cache(maxsize=256)
+def pool_distribution(
+        dice_type: str,
+        values: Tuple[Optional[int], ...],
+        reroll: Tuple[bool, ...],
+        explode: Tuple[bool, ...],
+        num_dice: int,
+) -> Distribution:
+    """
+    Distribution of the sum of num_dice identical dice, built by repeated squaring of the single die distribution.
+    """
+    die = die_distribution(dice_type, values, reroll, explode)
+    result = point_distribution(0)
+    while num_dice:
+        if num_dice & 1:
+            result = convolve_distributions(result, die)
+        num_dice >>= 1
+        if num_dice:
+            die = convolve_distributions(die, die)
+    return result
+
+
+def clamp_distribution(dist: Distribution, min_val: Optional[int], max_val: Optional[int]) -> Distribution:
+    # Same rules as DiceRoll._apply_limits, min wins over max
+    clamped = {}
+    for idx, prob in enumerate(dist.probs):
+        val = dist.offset + idx
+        if min_val and val < min_val:
+            val = min_val
+        elif max_val and val > max_val:
+            val = max_val
+        clamped[val] = clamped.get(val, 0.0) + prob
+
+    return dense_distribution(clamped)
+
+
+def dense_distribution(chances: Dict[int, float]) -> Distribution:
+    offset = min(chances)
+    probs = [0.0] * (max(chances) - offset + 1)
+    for val, prob in chances.items():
+        probs[val - offset] += prob
+    return Distribution(offset, tuple(probs))
+
+
+def term_distribution(dice_plan: DicePlan) -> Distribution:
+    if 'keep' in dice_plan.options:
+        raise UnknownOperationError(
+            'k',
+            f'Keeping dice has no exact distribution, try /sim. Used in {dice_plan.dice_str}',
+        )
+
+    if dice_plan.num_dice == 0:
+        return point_distribution(0)
+
+    dice = dice_plan.dice
+    dist = pool_distribution(
+        dice_plan.dice_type,
+        dice.values,
+        tuple(face in dice_plan.options['reroll'] for face in dice.map),
+        tuple(face in dice_plan.options['explode'] for face in dice.map),
+        dice_plan.num_dice,
+    )
+
+    valued_chance = sum(dist.probs)
+    if valued_chance:
+        dist = clamp_distribution(dist, dice_plan.min, dice_plan.max)
+    # Rolls without a sum count as zero towards the equation
+    if valued_chance < 1:
+        dist = add_distributions(dist, point_distribution(0, 1 - valued_chance))
+    return dist
+
+
+def negate_distribution(dist: Distribution) -> Distribution:
+    return Distribution(-(dist.offset + len(dist.probs) - 1), dist.probs[::-1])
+
+
+def subtract_distributions(a: Distribution, b: Distribution) -> Distribution:
+    return convolve_distributions(a, negate_distribution(b))
+
+
+def pair_distributions(a: Distribution, b: Distribution, op: str) -> Distribution:
+    """
+    Distribution of a op b for every pair of outcomes, for the operators that don't reduce to a convolution.
+    """
+    a_vals, a_probs = _outcomes(a)
+    b_vals, b_probs = _outcomes(b)
+    if not a_vals or not b_vals:
+        return Distribution(0, ())
+    if op == '/' and 0 in b_vals:
+        raise UnknownOperationError('/', 'Some rolls divide by zero, which has no result.')
+    if len(a_vals) * len(b_vals) > _max_prob_pairs:
+        raise RollLimitError(f'{op} of {len(a_vals)} by {len(b_vals)} outcomes', 'Try /sim instead.')
+
+    func = operator.floordiv if op == '/' else operator.mul
+    if np is not None:
+        values = func(np.array(a_vals)[:, None], np.array(b_vals)[None, :]).ravel()
+        offset = int(values.min())
+        probs = np.bincount(values - offset, weights=np.outer(a_probs, b_probs).ravel())
+        return Distribution(offset, tuple(probs.tolist()))
+
+    chances = {}
+    for a_val, a_prob in zip(a_vals, a_probs):
+        for b_val, b_prob in zip(b_vals, b_probs):
+            val = func(a_val, b_val)
+            chances[val] = chances.get(val, 0.0) + a_prob * b_prob
+    return dense_distribution(chances)
+
+
+def multiply_distributions(a: Distribution, b: Distribution) -> Distribution:
+    return pair_distributions(a, b, '*')
+
+
+def divide_distributions(a: Distribution, b: Distribution) -> Distribution:
+    return pair_distributions(a, b, '/')
+
+
+def _outcomes(dist: Distribution):
+    """The values a distribution can take and their chances, leaving out the impossible ones"""
+    values = []
+    probs = []
+    for val, prob in enumerate(dist.probs, dist.offset):
+        if prob > 0:
+            values.append(val)
+            probs.append(prob)
+    return values, probs
+
+
+_distribution_ops = {
+    'neg': negate_distribution,
+    '+': convolve_distributions,
+    '-': subtract_distributions,
+    '*': multiply_distributions,
+    '/': divide_distributions,
+}
+
+
+def equation_distribution(plan: RollPlan) -> Distribution:
+    return run_program(plan.program, [term_distribution(dice_plan) for dice_plan in plan.terms], _distribution_ops)
+
+
+def distribution_stats(values: List[int], probs: List[float]):
+    """
+    Mean, standard deviation and percentiles of a distribution given as ascending values and their chances.
+    """
+    mean = sum(val * prob for val, prob in zip(values, probs))
+    stdev = sqrt(max(sum((val - mean) ** 2 * prob for val, prob in zip(values, probs)), 0))
+
+    percentiles = {}
+    cumulative = 0.0
+    pending = list(_percentiles)
+    for val, prob in zip(values, probs):
+        cumulative += prob
+        while pending and cumulative >= pending[0] / 100 - 1e-9:
+            percentiles[pending.pop(0)] = val
+    for target in pending:
+        percentiles[target] = values[-1]
+
+    return mean, stdev, percentiles
+
+
+def prob_command(command_str: str) -> ProbResult:
+    plan = plan_cache.get(command_str)
+    check_roll_cost(plan.cost, check_output=False, check_outcomes=True)
+    dist = equation_distribution(plan)
+
+    # Normalize away the float drift of the FFTs and truncated explosions
+    total_chance = sum(dist.probs)
+    values = range(dist.offset, dist.offset + len(dist.probs))
+    probs = [prob / total_chance for prob in dist.probs]
+
+    mean, stdev, percentiles = distribution_stats(values, probs)
+
+    compare_chance = None
+    if plan.final_compare is not None and plan.final_compare_val is not None:
+        compare, _ = _threshold_compares[plan.final_compare]
+        compare_chance = sum(prob for val, prob in zip(values, probs) if compare(val, plan.final_compare_val))
+
+    return ProbResult(
+        plan=plan,
+        distribution=Distribution(dist.offset, tuple(probs)),
+        mean=mean,
+        stdev=stdev,
+        percentiles=percentiles,
+        compare_chance=compare_chance,
+    )
+
+
+# -------------------------------------------------------------
+#  Simulation Functions
+# -------------------------------------------------------------
+
+# histograms maps 'Sum' and each counter the equation uses (Successes, Failures, ...) to a Counter of outcomes
+SimBatch = namedtuple('SimBatch', ['trials', 'histograms', 'compare_hits', 'final_compare', 'final_compare_val'])
+
+SimResult = namedtuple(
+    'SimResult',
+    ['trials', 'requested', 'elapsed', 'histograms', 'compare_hits', 'final_compare', 'final_compare_val'],
+)
+
+_sim_default_trials = 10000
+_sim_max_trials = int(environ.get('SIM_MAX_TRIALS', 1000000))
+_sim_time_budget = float(environ.get('SIM_TIME_BUDGET', 5.0))
+
+# Dice drawn per batch, which bounds the memory of a batch and how long it holds the event loop
+_sim_batch_dice = 1000000
+
+_sim_counter_names = {
+    'successes': 'Successes',
+    'failures': 'Failures',
+    'boons': 'Boons',
+    'complications': 'Complications',
+}
+
+
+def _divide_arrays(a, b):
+    if not b.all():
+        raise UnknownOperationError('/', 'Some trials divided by zero, which has no result.')
+    return a // b
+
+
+_array_ops = dict(_scalar_ops, **{'/': _divide_arrays})
+
+
+def simulate_term(dice_plan: DicePlan, trials: int, rng=None):
+    """
+    Roll a term for every trial at once, as an array of face indices with a row per trial. Explosions draw each
+    exploding die's chain length like _explode_chains does, and once any die explodes the dice move into one flat
+    array alongside the trial each belongs to, so a long chain doesn't widen every row. Returns the term sum (zero when
+    it has none) and its counters.
+    """
+    tables = dice_plan.vector
+    if tables is None:
+        raise UnknownOperationError('/sim', f'{dice_plan.dice_str} can only be rolled one at a time.')
+
+    options = dice_plan.options
+    sides = dice_plan.dice.sides
+    chain = dice_plan.chain
+    generator = (rng or worker_rng()).generator
+
+    # Reroll any initial dice
+    rolls = generator.integers(0, sides, size=(trials, dice_plan.num_dice))
+    reroll_mask = tables.reroll[rolls]
+    rolls[reroll_mask] = generator.integers(0, sides, size=int(reroll_mask.sum()))
+
+    # Every exploding die adds a geometric run of go faces ending in a stop face
+    trial = None
+    if chain is not None:
+        if chain.chance >= 1:
+            raise RollLimitError(dice_plan.dice_str, 'Every face explodes, so it would never stop.')
+        chain_trial = np.nonzero(tables.explode[rolls])[0]
+        if chain_trial.size:
+            lengths = generator.geometric(1 - chain.chance, size=chain_trial.size)
+            rolled = dice_plan.num_dice + int(np.bincount(chain_trial, weights=lengths).max())
+            if rolled > _max_rolled_dice:
+                raise RollLimitError(f'{rolled} dice', f'Explosions went past the limit of {_max_rolled_dice}.')
+            total = int(lengths.sum())
+            last = np.zeros(total, dtype=bool)
+            last[np.cumsum(lengths) - 1] = True
+            new_rolls = np.empty(total, dtype=rolls.dtype)
+            new_rolls[~last] = generator.choice(chain.go_faces, size=total - chain_trial.size, p=chain.go_probs)
+            new_rolls[last] = generator.choice(chain.stop_faces, size=chain_trial.size, p=chain.stop_probs)
+            trial = np.concatenate((np.repeat(np.arange(trials), dice_plan.num_dice), np.repeat(chain_trial, lengths)))
+            rolls = np.concatenate((rolls.ravel(), new_rolls))
+
+    # Keep sorts each trial's dice by face index like the single roll does, then takes them from the kept end
+    if 'keep' in options:
+        keep_num = options['keep']
+        if trial is None:
+            rolls = np.sort(rolls, axis=1)
+            rolls = rolls[:, :keep_num] if keep_num >= 0 else rolls[:, keep_num:]
+        else:
+            order = np.lexsort((rolls, trial))
+            rolls = rolls[order]
+            trial = trial[order]
+            counts = np.bincount(trial, minlength=trials)
+            rank = np.arange(rolls.size) - (np.cumsum(counts) - counts)[trial]
+            kept = rank < keep_num if keep_num >= 0 else rank >= counts[trial] + keep_num
+            rolls = rolls[kept]
+            trial = trial[kept]
+
+    if trial is None:
+        rolled = np.full(trials, rolls.shape[1] > 0)
+
+        def per_trial(weights):
+            return weights.sum(axis=1)
+    else:
+        rolled = np.bincount(trial, minlength=trials) > 0
+
+        def per_trial(weights):
+            return np.bincount(trial, weights=weights, minlength=trials).astype(np.int64)
+
+    raw_sum = per_trial(tables.values[rolls])
+    # Same rules as DiceRoll._apply_limits, min wins over max
+    term_sum = raw_sum
+    if dice_plan.max:
+        term_sum = np.where(raw_sum > dice_plan.max, dice_plan.max, term_sum)
+    if dice_plan.min:
+        term_sum = np.where(raw_sum < dice_plan.min, dice_plan.min, term_sum)
+    term_sum = np.where(rolled & (per_trial(~tables.valued[rolls]) == 0), term_sum, 0)
+
+    counters = {counter_name: per_trial(weights[rolls]) for counter_name, weights in tables.weights.items()}
+    return term_sum, counters
+
+
+def simulate_batch(plan: RollPlan, trials: int) -> SimBatch:
+    """
+    Run up to trials trials of an equation as one batch, as many as fit in _sim_batch_dice dice.
+    """
+    if np is None:
+        raise UnknownOperationError('/sim', 'NumPy is not installed.')
+
+    # Sized by the dice a trial is expected to roll with its explosions, not just the dice it asks for
+    pool_size = max(int(plan.cost.expected_dice), 1)
+    batch = max(min(_sim_batch_dice // pool_size, trials), 1)
+
+    sums = []
+    counter_totals = {}
+    for dice_plan in plan.terms:
+        term_sum, counters = simulate_term(dice_plan, batch)
+        sums.append(term_sum)
+        for counter_name, counts in counters.items():
+            counter_totals[counter_name] = counter_totals.get(counter_name, 0) + counts
+
+    total = run_program(plan.program, sums, _array_ops)
+
+    histograms = {}
+    for name, outcomes in [('Sum', total)] + [
+        (_sim_counter_names[counter_name], counts) for counter_name, counts in counter_totals.items()
+    ]:
+        uniques, counts = np.unique(outcomes, return_counts=True)
+        histograms[name] = Counter(dict(zip(uniques.tolist(), counts.tolist())))
+
+    compare_hits = None
+    if plan.final_compare is not None and plan.final_compare_val is not None:
+        compare, _ = _threshold_compares[plan.final_compare]
+        compare_hits = int(compare(total, plan.final_compare_val).sum())
+
+    return SimBatch(
+        trials=batch,
+        histograms=histograms,
+        compare_hits=compare_hits,
+        final_compare=plan.final_compare,
+        final_compare_val=plan.final_compare_val,
+    )
+
+
+def merge_simulation(results: Optional[SimResult], batch: SimBatch, requested: int, elapsed: float) -> SimResult:
+    if results is None:
+        results = SimResult(
+            trials=0,
+            requested=requested,
+            elapsed=0.0,
+            histograms={},
+            compare_hits=batch.compare_hits,
+            final_compare=batch.final_compare,
+            final_compare_val=batch.final_compare_val,
+        )
+    elif batch.compare_hits is not None:
+        results = results._replace(compare_hits=results.compare_hits + batch.compare_hits)
+
+    for name, histogram in batch.histograms.items():
+        results.histograms.setdefault(name, Counter()).update(histogram)
+
+    return results._replace(trials=results.trials + batch.trials, elapsed=elapsed)
+
+
+def simulate(plan: RollPlan, trials: int, time_budget: Optional[float] = None):
+    """
+    Run trials of an equation in batches, yielding the running SimResult after each batch. Stops early, with fewer
+    trials than requested, once the time budget is used up.
+    """
+    time_budget = _sim_time_budget if time_budget is None else time_budget
+
+    results = None
+    start = time.monotonic()
+    while results is None or results.trials < trials:
+        batch = simulate_batch(plan, trials - (results.trials if results else 0))
+        results = merge_simulation(results, batch, trials, time.monotonic() - start)
+        yield results
+        if results.elapsed > time_budget:
+            break
+
+
+def parse_sim_command(command_str: str) -> Tuple[int, str]:
+    trials = _sim_default_trials
+    if sim_match := sim_trials_pattern.match(command_str):
+        trials = int(sim_match.group('trials'))
+        command_str = sim_match.group('expr')
+    return min(max(trials, 1), _sim_max_trials), command_str
+
+
+def sim_command(command_str: str, time_budget: Optional[float] = None):
+    trials, command_str = parse_sim_command(command_str)
+    plan = plan_cache.get(command_str)
+    # The limits are per trial, the batching and time budget take care of the rest
+    check_roll_cost(plan.cost, check_output=False)
+    return simulate(plan, trials, time_budget)
+
+
+def sim_batch_command(command_str: str, trials: int) -> SimBatch:
+    plan = plan_cache.get(command_str)
+    check_roll_cost(plan.cost, check_output=False)
+    return simulate_batch(plan, trials)
+
+
+# -------------------------------------------------------------
+#  Stage Timing
+# -------------------------------------------------------------
+# Stages can run in a worker, possibly in another process, so they're logged per job (thread local) and handed back
+# with the job's result by collect_stages. With timing off each stage costs a single check of _time_stages.
+
+_time_stages = False
+
+# Plain dice with these sides get their own label, the rest share 'dN' to keep the number of series down
+_labeled_sides = frozenset({2, 3, 4, 6, 8, 10, 12, 20, 100})
+
+# The stages logged by the job running on this thread, None outside of collect_stages
+_stage_local = threading.local()
+
+
+def dice_label(dice_plan: DicePlan) -> str:
+    dice = dice_plan.dice
+    if not dice.key.isdigit():
+        return dice.key
+    if dice.key == '1':
+        return 'const'
+    return f'd{dice.sides}' if dice.sides in _labeled_sides else 'dN'
+
+
+def expression_label(plan: RollPlan) -> str:
+    return '+'.join(sorted({dice_label(dice_plan) for dice_plan in plan.terms}))
+
+
+def record_stage(stage: str, dice: str, seconds: float):
+    log = getattr(_stage_local, 'log', None)
+    if log is not None:
+        log.append((stage, dice, seconds))
+
+
+def collect_stages(func, *args):
+    """
+    Run func(*args) in a worker and hand back (its result, the stages it logged)
+    """
+    _stage_local.log = []
+    try:
+        return func(*args), _stage_local.log
+    finally:
+        _stage_local.log = None
+
+
+# -------------------------------------------------------------
+#  Headless Interface
+# -------------------------------------------------------------
+# Rolls and odds as plain text or JSON, for the command line, a JSON request per line on stdin or a small local HTTP
+# server, so the engine can be run and load tested without the bot.
+
+# What a bad expression raises. These are answered as errors instead of ending the server.
+_request_errors = (
+    UnknownDiceTypeError,
+    UnknownOperationError,
+    MissingOperandError,
+    ExpressionError,
+    RollLimitError,
+)
+
+_serve_port = 8088
+
+
+def format_rolls_text(results: Equation) -> str:
+    """
+    Every die of an equation as plain text, for the command line and the attachment of a reply that couldn't show them
+    all
+    """
+    lines = [results.original_equation_str.strip(), '']
+    for op, roll in zip(results.ops, results.rolls):
+        lines.append(f'{op} {roll.roll_name}')
+        if (history := roll.format_history()) is not None:
+            lines.append(f'  Rolled  {history}')
+        lines.append(f'  Dice    {roll.format_faces()}')
+        if roll.sum is not None:
+            lines.append(f'  Sum     {roll.sum} {roll.limit_txt}'.rstrip())
+    tally = results.tally
+    lines.extend(['', f'Total {tally.sum}'])
+    if tally.final_compare_result is not None:
+        verdict = 'SUCCESS' if tally.final_compare_result else 'FAIL'
+        lines.append(f'{tally.sum} {results.final_compare} {results.final_compare_val} : {verdict}')
+    for counter_name in _counter_names:
+        if (result := getattr(tally, counter_name)) is not None:
+            lines.append(f'{counter_name.capitalize()} {result.total}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_probability_text(result: ProbResult) -> str:
+    plan = result.plan
+    lines = [plan.equation_str.strip(), '', f'Mean     {result.mean:.2f}', f'Std Dev  {result.stdev:.2f}', '']
+    lines.extend(f'{percentile:>3}%  {value}' for percentile, value in result.percentiles.items())
+    if result.compare_chance is not None:
+        lines.extend(['', f'TOTAL {plan.final_compare} {plan.final_compare_val} : {100 * result.compare_chance:.2f}%'])
+    return '\n'.join(lines) + '\n'
+
+
+def equation_json(equation: Equation) -> dict:
+    tally = equation.tally
+    reply = {
+        'expr': equation.original_equation_str.strip(),
+        'terms': [
+            {
+                'dice': roll.roll_name,
+                'sign': op,
+                'faces': {str(face): count for face, count in roll._face_counts(roll.rolls).items()},
+                'sum': roll.sum,
+            }
+            for op, roll in zip(equation.ops, equation.rolls)
+        ],
+        'total': tally.sum,
+    }
+    for counter_name in _counter_names:
+        if (result := getattr(tally, counter_name)) is not None:
+            reply[counter_name] = result.total
+    if tally.final_compare_result is not None:
+        reply['compare'] = bool(tally.final_compare_result)
+    return reply
+
+
+def probability_json(result: ProbResult) -> dict:
+    reply = {
+        'expr': result.plan.equation_str.strip(),
+        'mean': result.mean,
+        'stdev': result.stdev,
+        'percentiles': {str(percentile): value for percentile, value in result.percentiles.items()},
+        'offset': result.distribution.offset,
+        'probs': list(result.distribution.probs),
+    }
+    if result.compare_chance is not None:
+        reply['compare'] = result.compare_chance
+    return reply
+
+
+def _json_default(value):
+    # Numbers out of the array engines are numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dump_json(reply: dict) -> str:
+    return json.dumps(reply, default=_json_default)
+
+
+def answer_request(op: str, expr: str, engine: Optional[str] = None, rng=None) -> dict:
+    """
+    The JSON reply to a 'roll' of expr, which can be a batch like '6x 4d6k3; 1d20+5', or to a 'prob' of it. A bad
+    request is answered with {'error': ...}.
+    """
+    try:
+        if not isinstance(expr, str):
+            raise ExpressionError(str(expr), 'The expression must be a string.')
+        if op == 'roll':
+            return {'rolls': [equation_json(equation)
+                              for item in roll_batch(expr, engine, rng) for equation in item.equations]}
+        if op == 'prob':
+            return probability_json(prob_command(expr))
+        raise UnknownOperationError(str(op), 'Ask for roll or prob.')
+    except _request_errors as excp:
+        return {'error': str(excp)}
+
+
+class RollRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /roll?expr=... or /prob?expr=..., or POST {"expr": ...} to either
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.answer(url.path, parse_qs(url.query).get('expr', [''])[0])
+
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            expr = json.loads(body or b'{}').get('expr', '')
+        except (ValueError, AttributeError):
+            self.reply(400, {'error': 'The body must be a JSON object like {"expr": "1d20"}.'})
+            return
+        self.answer(urlsplit(self.path).path, expr)
+
+    def answer(self, path: str, expr):
+        op = path.strip('/')
+        if op not in ('roll', 'prob'):
+            self.reply(404, {'error': f'Nothing at {path}, try /roll or /prob.'})
+            return
+        reply = answer_request(op, expr)
+        self.reply(400 if 'error' in reply else 200, reply)
+
+    def reply(self, status: int, reply: dict):
+        body = dump_json(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # A line per request would drown out a load test
+        pass
+
+
+def serve_http(host: str = '127.0.0.1', port: int = _serve_port):
+    server = ThreadingHTTPServer((host, port), RollRequestHandler)
+    print(f'Answering rolls on http://{host}:{server.server_port}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_lines(lines, out):
+    """
+    Answer a JSON request per line, {"op": "roll" or "prob", "expr": ...}, with a JSON reply per line. A request's
+    "id", if it has one, is copied to its reply.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            reply = answer_request(request.get('op', 'roll'), request.get('expr', ''))
+            if 'id' in request:
+                reply['id'] = request['id']
+        except (ValueError, AttributeError):
+            reply = {'error': 'Each line must be a JSON object like {"op": "roll", "expr": "1d20"}.'}
+        out.write(dump_json(reply) + '\n')
+        out.flush()
+
+
+def main_(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dice', default=_dice_path, help='dice file to load')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    roll = commands.add_parser('roll', help='roll an expression, or a batch like "6x 4d6k3; 1d20+5"')
+    roll.add_argument('expr', nargs='+')
+    roll.add_argument('--seed', type=int)
+    roll.add_argument('--engine', choices=['python', 'numpy', 'counts', 'auto'], default=None)
+    roll.add_argument('--json', action='store_true')
+
+    prob = commands.add_parser('prob', help="odds of an expression's sum")
+    prob.add_argument('expr', nargs='+')
+    prob.add_argument('--json', action='store_true')
+
+    serve = commands.add_parser('serve', help='answer rolls over HTTP, or JSON lines on stdin')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=_serve_port)
+    serve.add_argument('--stdin', action='store_true', help='read requests from stdin instead')
+
+    args = parser.parse_args(argv)
+    try:
+        init_engine(args.dice)
+    except DiceFileError as excp:
+        parser.error(str(excp))
+
+    if args.command == 'serve':
+        if args.stdin:
+            serve_lines(sys.stdin, sys.stdout)
+        else:
+            serve_http(args.host, args.port)
+        return 0
+
+    expr = ' '.join(args.expr)
+    engine = getattr(args, 'engine', None)
+    rng = make_rng(seed=args.seed) if getattr(args, 'seed', None) is not None else None
+    if args.json:
+        reply = answer_request(args.command, expr, engine, rng)
+        print(dump_json(reply))
+        return 1 if 'error' in reply else 0
+
+    try:
+        if args.command == 'roll':
+            batch = roll_batch(expr, engine, rng)
+            print('\n'.join(format_rolls_text(equation) for item in batch for equation in item.equations), end='')
+        else:
+            print(format_probability_text(prob_command(expr)), end='')
+    except _request_errors as excp:
+        print(f'ERROR: {excp}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_())
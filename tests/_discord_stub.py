@@ -0,0 +1,66 @@
+"""
+Just enough of discord.py to import main.py and build embeds without the real library or a bot token. Only used by the
+tests and benchmarks, and only when discord isn't installed.
+"""
+import sys
+import types
+
+
+class Client:
+    user = None
+
+    def event(self, coro):
+        return coro
+
+    def run(self, *args, **kwargs):
+        raise RuntimeError('The discord stub can not connect')
+
+
+class Embed:
+    def __init__(self, **kwargs):
+        self._data = dict(kwargs)
+        self._fields = []
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        fields = data.pop('fields', [])
+        embed = cls(**data)
+        for field in fields:
+            embed.add_field(**field)
+        return embed
+
+    def add_field(self, *, name, value, inline=True):
+        self._fields.append({'name': str(name), 'value': str(value), 'inline': inline})
+        return self
+
+    def set_author(self, **kwargs):
+        self._data['author'] = kwargs
+        return self
+
+    @property
+    def fields(self):
+        return [types.SimpleNamespace(**field) for field in self._fields]
+
+    def to_dict(self):
+        data = dict(self._data)
+        data['fields'] = [dict(field) for field in self._fields]
+        return data
+
+
+class File:
+    def __init__(self, fp, filename=None):
+        self.fp = fp
+        self.filename = filename
+
+
+def install():
+    """Put the stub in sys.modules if the real discord package isn't importable"""
+    try:
+        import discord  # noqa: F401
+    except ImportError:
+        stub = types.ModuleType('discord')
+        stub.Client = Client
+        stub.Embed = Embed
+        stub.File = File
+        sys.modules['discord'] = stub
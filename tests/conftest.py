@@ -0,0 +1,47 @@
+"""
+Test setup: main.py and rollengine.py are imported from the repository root, with discord.py stubbed out when it isn't
+installed. Every test module starts with the dice from dice.json loaded.
+"""
+import json
+import os
+import sys
+
+import pytest
+
+import _discord_stub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DICE_PATH = os.path.join(ROOT, 'dice.json')
+
+sys.path.insert(0, ROOT)
+_discord_stub.install()
+
+import rollengine  # noqa: E402
+
+
+@pytest.fixture(scope='module', autouse=True)
+def dice_types():
+    rollengine.load_dice_types(DICE_PATH)
+
+
+@pytest.fixture
+def dice_file(tmp_path):
+    """
+    A copy of dice.json to edit, with the real one loaded again afterwards.
+    """
+    with open(DICE_PATH) as dice_json:
+        dice_infos = json.load(dice_json)
+    path = tmp_path / 'dice.json'
+
+    def write(infos):
+        path.write_text(json.dumps(infos))
+        # Make sure the watcher sees a new mtime, however coarse the file system's clock is
+        mtime = path.stat().st_mtime + write.saves
+        os.utime(path, (mtime, mtime))
+        write.saves += 1
+        return str(path)
+
+    write.saves = 1
+    write.infos = dice_infos
+    yield write
+    rollengine.load_dice_types(DICE_PATH)
@@ -0,0 +1,367 @@
+"""
+Tests for the bot around the engine: replies, workers and metrics. Run from the repository root, with the packages in
+tests/requirements.txt installed:
+
+    python -m pytest -q
+"""
+import asyncio
+import operator
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+import rollengine
+
+
+# -------------------------------------------------------------
+#  Dice Types
+# -------------------------------------------------------------
+
+def test_watch_dice_file_reloads_on_save(dice_file, monkeypatch):
+    rollengine.load_dice_types(dice_file(dice_file.infos))
+    monkeypatch.setattr(main, '_dice_reload_interval', 0.01)
+
+    async def scenario():
+        watcher = asyncio.ensure_future(main.watch_dice_file())
+        try:
+            # A broken save is skipped and the old dice stay in use
+            registry = rollengine._dice_registry
+            dice_file({'gb': {'sides': 6}})
+            await asyncio.sleep(0.1)
+            assert rollengine._dice_registry is registry
+
+            dice_file(dict(dice_file.infos, XY={'sides': 3}))
+            for _ in range(100):
+                if 'XY' in rollengine._dice_registry.types:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watcher.cancel()
+
+    asyncio.run(scenario())
+    assert rollengine.roll_command('2dXY', 'python').rolls[0].plan.dice.sides == 3
+
+
+# -------------------------------------------------------------
+#  Evaluation Workers
+# -------------------------------------------------------------
+
+@pytest.fixture
+def roll_executor(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(main, '_roll_executor', executor)
+    yield executor
+    executor.shutdown()
+
+
+def test_run_blocking_returns_the_result(roll_executor):
+    assert asyncio.run(main.run_blocking(operator.add, 2, 3)) == 5
+    assert asyncio.run(main.run_blocking(main.render_roll, '3d1')).embed['fields']
+
+
+def test_run_blocking_times_out_and_holds_the_slot(roll_executor, monkeypatch):
+    monkeypatch.setattr(main, '_roll_queue_depth', 1)
+    monkeypatch.setattr(main, '_roll_timeout', 0.05)
+    release = threading.Event()
+
+    async def scenario():
+        with pytest.raises(main.RollTimeoutError):
+            await main.run_blocking(release.wait)
+        # The timed out job is still running, so it keeps its slot until it finishes
+        with pytest.raises(main.RollQueueFullError):
+            await main.run_blocking(operator.add, 2, 3)
+        release.set()
+        while main._pending_jobs:
+            await asyncio.sleep(0.01)
+        return await main.run_blocking(operator.add, 2, 3)
+
+    assert asyncio.run(scenario()) == 5
+
+
+# -------------------------------------------------------------
+#  Replies
+# -------------------------------------------------------------
+
+class FixedRNG(rollengine.PythonRNG):
+    """Hands out the given face indices, in order, as the dice"""
+
+    def __init__(self, *rolls):
+        super().__init__(0)
+        self.rolls = list(rolls)
+
+    def integers(self, sides, count):
+        # Constants are dice with a single face
+        if sides == 1:
+            return [0] * count
+        rolls, self.rolls = self.rolls[:count], self.rolls[count:]
+        return rolls
+
+    def integer(self, sides):
+        return self.integers(sides, 1)[0]
+
+
+def fixed_roll(expr, *rolls):
+    return rollengine.roll_command(expr, 'python', FixedRNG(*rolls))
+
+
+def test_compact_reply():
+    response = main.format_response(fixed_roll('2d6 + 1d4 >= 5', 2, 3, 0)).to_dict()
+    assert response['fields'] == [
+        {'name': 'Dice', 'value': '```\n2d6\n1d4\nTOTAL\n8 >= 5\n```', 'inline': True},
+        {'name': 'Rolls', 'value': '```[ 3, 4 ]  =  7\n[ 1 ]  =  1\n8\nSUCCESS```', 'inline': True},
+    ]
+
+
+def test_full_reply():
+    fields = main.format_response_full(fixed_roll('2d6 + 1d4 >= 5', 2, 3, 0)).to_dict()['fields']
+    assert [(field['name'], field['value']) for field in fields if field['value'] != main._sep] == [
+        ('Dice', '```\n2d6\n1d4\n```\n'),
+        ('Rolls', '```\n[ 3, 4 ]\n[ 1 ]\n```\n'),
+        ('Dice', '```\n2d6\n1d4\n\nTotal\n8 >= 5\n```'),
+        ('Rolls', '```\n7 \n1 \n\n8\nSUCCESS```'),
+    ]
+
+
+def test_replies_work_out_products():
+    fields = main.format_response(fixed_roll('(1d6+2) * 3', 4)).to_dict()['fields']
+    assert fields[1]['value'] == '```[ 5 ]  =  5\n[ 2 ]  =  2\n[ 3 ]  =  3\n(5 + 2) * 3  =  21\n```'
+    fields = main.format_response_full(fixed_roll('2d6/1d3 + 1', 3, 4, 1)).to_dict()['fields']
+    assert fields[-1]['value'] == '```\n9 \n2 \n1 \n\n9 / 2 + 1  =  5\n```'
+
+
+def test_replies_count_named_faces():
+    fields = main.format_response(fixed_roll('3dGP', 1, 5, 11)).to_dict()['fields']
+    assert fields == [
+        {'name': 'Rolls', 'value': '```[ S, A, Tr ]\n```', 'inline': True},
+        {
+            'name': 'Roll Stats',
+            'value': '```\n3dGP     Success    1\n         Advantage  1\n         Triumph    1\n```',
+            'inline': False,
+        },
+        {'name': 'Results', 'value': '```\n2 Successes\n1 Boon\n```', 'inline': False},
+    ]
+
+
+def test_faces_without_names_print_as_themselves():
+    fields = main.format_response(fixed_roll('4dF', 0, 2, 4, 5)).to_dict()['fields']
+    assert fields[0]['value'] == '```[ +, 0, -, - ]  =  -1\n```'
+    assert fields[1]['value'] == '```\n4dF      +          1\n         -          2\n```'
+
+
+def test_counted_pools_reply_a_count_per_face():
+    assert len(main.render_roll('50000d6').embed['fields'][0]['value']) < 200
+
+
+def test_share_chars():
+    assert main.share_chars([10, 50, 100], 120) == [10, 50, 60]
+    assert main.share_chars([10, 80, 100], 120) == [10, 55, 55]
+    assert main.share_chars([10, 20], 100) == [10, 20]
+    assert main.share_chars([10, 20], -5) == [0, 0]
+
+
+def test_fit_field_drops_lines_it_cant_cut():
+    value = '```\n' + ''.join(f'line {idx}\n' for idx in range(200)) + '```'
+    assert main.fit_field(value[:100]) == value[:100]
+    fitted = main.fit_field(value, 100)
+    assert len(fitted) <= 100
+    assert fitted.startswith('```\nline 0\nline 1\n')
+    assert fitted.endswith(' more lines\n```')
+    kept = fitted.split('\n')[1:-2]
+    assert kept == [f'line {idx}' for idx in range(len(kept))]
+    assert fitted.split('\n')[-2] == f'+{201 - len(kept)} more lines'
+
+
+def test_fit_line_cuts_the_longest_dice_first():
+    line = '[ 1, 2, 3, 4, 5, 6, 7, 8, 9, 10 ] + [ 6, 6, +4 more ]  =  64'
+    assert main.fit_line(line, 100) == line
+    assert main.fit_line(line, 50) == '[ 1, 2, 3, +7 more ] + [ 6, 6, +4 more ]  =  64'
+    assert main.fit_line(line, 0) == '[ +10 more ] + [ +6 more ]  =  64'
+
+
+def test_fit_field_cuts_inside_the_lines():
+    value = '```\n' + ''.join(f'{idx}  [ {", ".join(["6"] * 100)} ]  =  {600 + idx}\n' for idx in range(10)) + '```'
+    fitted = main.fit_field(value, 400)
+    assert len(fitted) <= 400
+    lines = fitted.split('\n')[1:-1]
+    assert [line.split('  =  ')[1] for line in lines] == [str(600 + idx) for idx in range(10)]
+    assert all(line.startswith(f'{idx}  [ 6, 6,') and 'more ]' in line for idx, line in enumerate(lines))
+
+
+def test_fit_fields_fit_the_embed():
+    fields = [(f'Field {idx}', 'x' * 3000, True) for idx in range(4)] + [('Small', 'y' * 10, False)]
+    fitted = main.fit_fields(fields)
+    assert all(len(value) <= main._embed_field_chars for _, value, _ in fitted)
+    assert sum(len(name) + len(value) for name, value, _ in fitted) <= main._embed_total_chars
+    assert fitted[-1] == ('Small', 'y' * 10, False)
+    assert len(main.fit_fields(fields, 2000)[0][1]) < 500
+
+
+@pytest.mark.parametrize('full', [False, True])
+def test_big_rolls_fit_and_come_attached(full):
+    reply = main.render_roll('900d100 + 300d20 + 5', full)
+    fields = reply.embed['fields']
+    assert all(len(field['value']) <= main._embed_field_chars for field in fields)
+    assert sum(len(field['name']) + len(field['value']) for field in fields) <= main._embed_total_chars
+    # Every die is in the attachment
+    dice_lines = [line for line in reply.attachment.splitlines() if line.startswith('  Dice')]
+    assert [line.count(',') + 1 for line in dice_lines] == [900, 300, 1]
+
+    assert main.render_roll('3d6', full).attachment is None
+
+
+@pytest.mark.parametrize('command', ['; '.join(['300d6'] * 20), '; '.join(['100d6'] * 20)])
+def test_every_field_keeps_its_total(command, monkeypatch):
+    monkeypatch.setattr(rollengine._rng_local, 'rng', rollengine.make_rng(seed=5), raising=False)
+    totals = [item.equations[0].tally.sum for item in rollengine.roll_batch(command)]
+    monkeypatch.setattr(rollengine._rng_local, 'rng', rollengine.make_rng(seed=5), raising=False)
+    reply = main.render_roll(command)
+    fields = reply.embed['fields']
+    assert sum(len(field['name']) + len(field['value']) for field in fields) <= main._embed_total_chars
+    assert [field['value'].rsplit('  =  ', 1)[1] for field in fields] == [f'{total}\n```' for total in totals]
+    # Every roll still shows its dice, as a list or a count per face
+    assert all(field['value'][4] in '[{' and field['value'][6] != '+' for field in fields)
+    assert reply.attachment is not None
+
+
+def test_batch_rolls_share_their_field():
+    reply = main.render_roll('20x 300d20!20')
+    (field,) = reply.embed['fields']
+    assert len(field['value']) <= main._embed_field_chars
+    lines = field['value'].split('\n')[1:-1]
+    assert len(lines) == 20
+    # The dice as first rolled aren't shown, so every roll has room for some of its dice
+    assert all(re.match(r' ?\d+  \[ \d+, \d+, ', line) for line in lines)
+
+
+def test_equation_line():
+    rendered = main.render_equation(fixed_roll('2d6 + 1d4 >= 5', 2, 3, 0))
+    assert main.equation_line(rendered) == '[ 3, 4 ] + [ 1 ]  =  8 >= 5 : SUCCESS'
+    rendered = main.render_equation(fixed_roll('2d6r1 - 1d4', 0, 3, 4, 1))
+    assert main.equation_line(rendered) == '[ 5, 4 ] - [ 2 ]  =  7'
+    assert main.equation_line(rendered, full=True) == '[ 1, 4 ] -> [ 5, 4 ] - [ 2 ]  =  7'
+    rendered = main.render_equation(fixed_roll('3dGP', 1, 5, 11))
+    assert main.equation_line(rendered) == '[ S, A, Tr ]  =  2 Successes, 1 Boon'
+
+
+def test_batch_layout():
+    batch = rollengine.roll_batch('3x 2d6; 1d20+5', 'python', FixedRNG(0, 1, 2, 3, 4, 5, 19))
+    rendered = [[main.render_equation(equation) for equation in item.equations] for item in batch]
+    embed_dict, fields = main.batch_layout(batch, rendered)
+    assert fields == [
+        ('3x 2d6', '```\n1  [ 1, 2 ]  =  3\n2  [ 3, 4 ]  =  7\n3  [ 5, 6 ]  =  11\n```', False),
+        ('1d20+5', '```\n[ 20 ] + [ 5 ]  =  25\n```', False),
+    ]
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        self.sent.append(embed.to_dict() if embed is not None else content)
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.author = 'someone'
+        self.channel = FakeChannel()
+
+
+def answer(content):
+    """What the bot sends back for a message"""
+    message = FakeMessage(content)
+    asyncio.run(main.on_message(message))
+    return message.channel.sent
+
+
+def test_static_replies_follow_the_registry(dice_file):
+    replies = main.static_replies()
+    assert main.static_replies() is replies
+    assert answer('/h') == [replies.help.to_dict()]
+    assert answer('/dice') == [replies.dice_list]
+    assert answer('/dice  gp ') == [replies.dice_info['GP']]
+
+    rollengine.load_dice_types(dice_file(dict(dice_file.infos, XY={'sides': 3})))
+    assert main.static_replies() is not replies
+    assert 'XY' in answer('/dice')[0]
+
+
+def test_unknown_dice_names_are_an_error():
+    error = rollengine.UnknownDiceTypeError('NOPE', 'Use /dice to list the dice.')
+    assert answer('/dice nope') == ['```\nERROR:\n' + str(error) + '\n```']
+
+
+# -------------------------------------------------------------
+#  Metrics
+# -------------------------------------------------------------
+
+def test_stage_metrics_render_cumulative_buckets():
+    metrics = main.StageMetrics(buckets=(0.001, 0.01))
+    metrics.observe('roll', '/r', 'd6', 0.0005)
+    metrics.observe('roll', '/r', 'd6', 0.005)
+    metrics.observe('roll', '/r', 'd6', 5.0)
+    metrics.observe('parse', '/r', 'say "hi"', 0.002)
+    lines = metrics.render().splitlines()
+
+    assert lines[:2] == [
+        '# HELP rollbot_stage_seconds Time spent in each stage of answering a command',
+        '# TYPE rollbot_stage_seconds histogram',
+    ]
+    roll_labels = 'stage="roll",command="/r",dice="d6"'
+    assert f'rollbot_stage_seconds_bucket{{{roll_labels},le="0.001"}} 1' in lines
+    assert f'rollbot_stage_seconds_bucket{{{roll_labels},le="0.01"}} 2' in lines
+    assert f'rollbot_stage_seconds_bucket{{{roll_labels},le="+Inf"}} 3' in lines
+    assert f'rollbot_stage_seconds_sum{{{roll_labels}}} 5.0055' in lines
+    assert f'rollbot_stage_seconds_count{{{roll_labels}}} 3' in lines
+    # Label values are escaped, and the series come out sorted
+    assert lines[2] == 'rollbot_stage_seconds_bucket{stage="parse",command="/r",dice="say \\"hi\\"",le="0.001"} 0'
+
+
+def test_stages_are_logged_per_job(monkeypatch):
+    monkeypatch.setattr(main, '_metrics', main.StageMetrics())
+    monkeypatch.setattr(rollengine, '_time_stages', True)
+    response, stages = rollengine.collect_stages(main.render_roll, '2d6 + 1d20 + 3dGP + 1d7 + 2')
+    assert response.embed['fields']
+    labels = ['d6', 'd20', 'GP', 'dN', 'const']
+    assert [(stage, dice) for stage, dice, _ in stages] == (
+        [('parse', 'GP+const+d20+d6+dN')]
+        + [(stage, label) for label in labels for stage in ('resolve', 'roll')]
+        + [('format', 'GP+const+d20+d6+dN')]
+    )
+    # Nothing is logged outside of a job
+    rollengine.roll_command('1d6')
+    assert rollengine._stage_local.log is None
+
+
+def test_serve_metrics(monkeypatch):
+    metrics = main.StageMetrics()
+    metrics.observe('send', '/r', 'd20', 0.01)
+    monkeypatch.setattr(main, '_metrics', metrics)
+
+    async def fetch(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    async def scenario():
+        server = await asyncio.start_server(main.serve_metrics, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await fetch(port, '/metrics?x=1'), await fetch(port, '/')
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    found, missing = asyncio.run(scenario())
+    head, body = found.split('\r\n\r\n', 1)
+    assert head.startswith('HTTP/1.1 200 OK')
+    assert f'Content-Length: {len(body.encode())}' in head
+    assert body == metrics.render()
+    assert missing.startswith('HTTP/1.1 404 Not Found')
@@ -0,0 +1,807 @@
+"""
+Tests for the dice engine. Run from the repository root, with the packages in tests/requirements.txt installed:
+
+    python -m pytest -q
+"""
+import io
+import json
+import operator
+import random
+from fractions import Fraction
+from itertools import product
+
+import numpy as np
+import pytest
+
+import rollengine
+
+
+def seed_rolls(monkeypatch, seed):
+    """Give this thread a seeded RNG for the rest of the test"""
+    monkeypatch.setattr(rollengine._rng_local, 'rng', rollengine.make_rng(seed=seed), raising=False)
+
+
+# -------------------------------------------------------------
+#  Plan Cache
+# -------------------------------------------------------------
+
+def test_plan_cache_counts_hits_misses_and_evictions():
+    cache = rollengine.PlanCache(maxsize=2)
+    first = cache.get('1d6')
+    assert cache.get('1d6') is first
+    assert cache.get(' 1D6 ') is first
+    cache.get('2d6')
+    # 1d6 was used last, so 2d6 is the one to go
+    cache.get('1d6')
+    cache.get('3d6')
+    assert cache.info() == rollengine.CacheInfo(hits=3, misses=3, evictions=1, size=2, maxsize=2)
+    assert cache.get('1d6') is first
+    cache.get('2d6')
+    assert cache.info() == rollengine.CacheInfo(hits=4, misses=4, evictions=2, size=2, maxsize=2)
+
+
+@pytest.mark.parametrize('expr, same', [
+    ('4d6r1!6', '4d6!6r1'),
+    ('4d6k3r1', '4d6r1k3'),
+    ('4d6k3 + 2', '4d6k3+2'),
+    ('2dgp', '2dGP'),
+    ('10d10!10>=8cs10', '10d10>=8cs10!10'),
+])
+def test_normalize_expression_ignores_independent_differences(expr, same):
+    assert rollengine.normalize_expression(expr) == rollengine.normalize_expression(same)
+    assert rollengine.compile_roll(expr).terms[0].options == rollengine.compile_roll(same).terms[0].options
+
+
+@pytest.mark.parametrize('expr, other', [
+    ('4d6k3kl2', '4d6kl2k3'),
+    ('10d10>=8<=2', '10d10<=2>=8'),
+    ('4d6k3', '4d6k2'),
+])
+def test_normalize_expression_keeps_ordered_options(expr, other):
+    assert rollengine.normalize_expression(expr) != rollengine.normalize_expression(other)
+
+
+# -------------------------------------------------------------
+#  Expressions
+# -------------------------------------------------------------
+
+def total(expr):
+    # d1 always rolls a 1, so NdS with S=1 stands for the number N in a dice expression
+    return rollengine.roll_command(expr).tally.sum
+
+
+@pytest.mark.parametrize('expr, value', [
+    ('2+3*4', 14),
+    ('(2+3)*4', 20),
+    ('2*3+4', 10),
+    ('2-3-4', -5),
+    ('8/2/2', 2),
+    ('-2*3', -6),
+    ('--2', 2),
+    ('-(2+3)', -5),
+    ('7/2', 3),
+    ('-7/2', -4),
+    ('2*-3', -6),
+    ('((((1))))', 1),
+])
+def test_parser_folds_numbers(expr, value):
+    assert rollengine.parse_expression(expr) == rollengine.ExprNumber(value)
+
+
+@pytest.mark.parametrize('expr, value', [
+    ('2d1+3d1*4d1', 14),
+    ('(2d1+3d1)*4d1', 20),
+    ('10d1-3d1-2d1', 5),
+    ('-3d1+10', 7),
+    ('-(2d1+1)*2', -6),
+    ('7d1/2d1', 3),
+    ('-7d1/2d1', -4),
+    ('20d1/2/5d1', 2),
+    ('3d1 >= 2', 3),
+])
+def test_program_precedence(expr, value):
+    assert total(expr) == value
+
+
+@pytest.mark.parametrize('expr, error', [
+    ('1d6 2d6', rollengine.ExpressionError),
+    ('(1d6', rollengine.ExpressionError),
+    ('1d6)', rollengine.ExpressionError),
+    ('1d6+', rollengine.MissingOperandError),
+    ('*2', rollengine.MissingOperandError),
+    ('1d6*/2', rollengine.MissingOperandError),
+    ('()', rollengine.MissingOperandError),
+    ('(' * 20 + '1' + ')' * 20, rollengine.RollLimitError),
+    ('1d6/0', rollengine.UnknownOperationError),
+])
+def test_expression_errors(expr, error):
+    with pytest.raises(error):
+        total(expr)
+
+
+def test_program_text():
+    plan = rollengine.compile_roll('(1d6+2) * 3 - 2d4/2')
+    assert rollengine.program_text(plan.program, ['A', 'B', 'C', 'D', 'E']) == '(A + B) * C - D / E'
+
+
+@pytest.mark.parametrize('spaced, joined', [
+    ('4d6 k3', '4d6k3'),
+    ('1d6 min3', '1d6min3'),
+    ('4d6 r1 k3', '4d6r1k3'),
+    ('10d10 >=8 cs10', '10d10>=8cs10'),
+])
+def test_spaced_options_join_their_dice(spaced, joined):
+    spaced_plan = rollengine.compile_roll(spaced)
+    joined_plan = rollengine.compile_roll(joined)
+    assert [term.options for term in spaced_plan.terms] == [term.options for term in joined_plan.terms]
+    assert rollengine.normalize_expression(spaced) == rollengine.normalize_expression(joined)
+
+
+# -------------------------------------------------------------
+#  Options
+# -------------------------------------------------------------
+
+@pytest.mark.parametrize('options, tokens', [
+    ('', []),
+    ('k3', [('k', '3')]),
+    ('r1!6k3', [('r', '1'), ('!', '6'), ('k', '3')]),
+    ('kl2', [('kl', '2')]),
+    ('>=8cs10', [('>=', '8'), ('cs', '10')]),
+    ('~<=2', [('~<=', '2')]),
+    ('r1,2', [('r', '1,2')]),
+    ('cs"S"', [('cs', 'S')]),
+    ("!'SS','A'", [('!', 'SS,A')]),
+    ('min3max5', [('min', '3'), ('max', '5')]),
+    ('b18', [('b', '18')]),
+    ('k', [('k', '')]),
+])
+def test_tokenize_options(options, tokens):
+    assert rollengine.tokenize_options(options) == tokens
+
+
+@pytest.mark.parametrize('options', ['zzk3', 'k3q!6', 'k3zz', 'k3 r1', 'q'])
+def test_tokenize_options_rejects_gaps(options):
+    with pytest.raises(rollengine.UnknownOperationError):
+        rollengine.tokenize_options(options)
+
+
+@pytest.mark.parametrize('dice_str, error', [
+    ('4d6k', rollengine.MissingOperandError),
+    ('4d6k3zz', rollengine.UnknownOperationError),
+    ('1d6cs5cs"S"', rollengine.UnknownOperationError),
+])
+def test_option_errors(dice_str, error):
+    with pytest.raises(error):
+        rollengine.compile_dice(dice_str)
+
+
+def test_crit_names_then_number():
+    # A number after face names replaces them, so the order of crits matters
+    assert rollengine.compile_dice('1d6cs"S"cs5').options['crit'] == 5
+    assert rollengine.normalize_expression('1d6cs"S"cs5') != rollengine.normalize_expression('1d6cs5cs"S"')
+
+
+@pytest.mark.parametrize('expr, options', [
+    ('2dDDb18', {'b_threshold': 18}),
+    ('4d6k3k1', {'keep': -3}),
+    ('1dGPcs"SS","A"', {'crit': frozenset(['SS', 'A'])}),
+])
+def test_parse_options(expr, options):
+    plan = rollengine.compile_dice(expr)
+    assert {key: plan.options[key] for key in options} == options
+
+
+# -------------------------------------------------------------
+#  Random Numbers
+# -------------------------------------------------------------
+
+def test_python_rng_draws_what_random_would():
+    rng = rollengine.make_rng('python', seed=4)
+    random.seed(4)
+    assert rng.integers(6, 20) == [random.randint(0, 5) for _ in range(20)]
+
+
+@pytest.mark.parametrize('kind', ['python', 'numpy', 'buffered'])
+def test_rng_streams_repeat(kind):
+    first = rollengine.make_rng(kind, seed=9, stream=(0, 1))
+    again = rollengine.make_rng(kind, seed=9, stream=(0, 1))
+    other = rollengine.make_rng(kind, seed=9, stream=(0, 2))
+    draws = first.integers(1000, 50)
+    assert draws == again.integers(1000, 50)
+    assert draws != other.integers(1000, 50)
+    assert first.generator.integers(0, 1000, 10).tolist() == again.generator.integers(0, 1000, 10).tolist()
+
+
+@pytest.mark.parametrize('kind', ['python', 'numpy', 'buffered'])
+@pytest.mark.parametrize('count', [10, 1000])
+def test_rng_draws_are_fair(kind, count):
+    rng = rollengine.make_rng(kind, seed=count, stream=(1,))
+    # A few small blocks, so the buffered RNG refills part way through a draw
+    if kind == 'buffered':
+        rng = rollengine.BufferedRNG(rng.generator, block=37)
+
+    rolls = []
+    while len(rolls) < 60000:
+        rolls.extend(rng.integers(6, count))
+    assert set(rolls) == set(range(6))
+    assert np.bincount(rolls) / len(rolls) == pytest.approx([1 / 6] * 6, abs=0.01)
+
+    lengths = []
+    while len(lengths) < 20000:
+        lengths.extend(rng.chain_lengths(0.75, count))
+    assert min(lengths) >= 1
+    assert np.mean(lengths) == pytest.approx(4, rel=0.05)
+
+    picks = []
+    while len(picks) < 20000:
+        picks.extend(rng.choices(['a', 'b'], [0.2, 0.8], count))
+    assert picks.count('a') / len(picks) == pytest.approx(0.2, abs=0.02)
+
+
+def test_rng_seed_repeats_rolls(monkeypatch):
+    results = []
+    for _ in range(2):
+        seed_rolls(monkeypatch, 21)
+        results.append([rollengine.roll_command(expr).rolls[0].rolls for expr in ('10d6!6', '1000d6', '5000d10k3')])
+    assert str(results[0]) == str(results[1])
+
+
+# -------------------------------------------------------------
+#  Dice Types
+# -------------------------------------------------------------
+
+def test_dice_types_are_compiled_once():
+    _, dice_type, options_str, dice = rollengine.decode_dice_string('2dgpk1')
+    assert (dice_type, options_str) == ('GP', 'k1')
+    assert dice is rollengine.decode_dice_string('1dGP')[3]
+    assert dice.sides == len(dice.map) == 12
+    assert dice.values == (None,) * 12
+    assert dict(dice.presets)['threshold'] == frozenset(['S', 'SS', 'SA', 'Tr'])
+    assert rollengine.compile_dice('3dGP').dice is dice
+
+    # Plain dice and constants are interned the first time they're used
+    assert rollengine.decode_dice_string('2d6')[3] is rollengine.decode_dice_string('5d6')[3]
+    assert rollengine.decode_dice_string('7')[3].values == (7,)
+
+
+def test_dice_types_cant_change():
+    dice = rollengine.decode_dice_string('1d6')[3]
+    assert dice.values == (1, 2, 3, 4, 5, 6)
+    with pytest.raises(AttributeError):
+        dice.sides = 8
+    with pytest.raises(TypeError):
+        dice.map_values['1'] = 10
+    assert not hasattr(dice, '__dict__')
+
+
+@pytest.mark.parametrize('dice_str', ['1dXYZ', '1d0'])
+def test_unknown_dice_types(dice_str):
+    with pytest.raises(rollengine.UnknownDiceTypeError):
+        rollengine.compile_dice(dice_str)
+
+
+def test_changed_dice_types(dice_file):
+    old_types = rollengine.read_dice_registry().types
+    infos = dict(dice_file.infos)
+    infos['GB'] = dict(infos['GB'], map=['B', 'S', 'S', 'SA', 'AA', 'A'])
+    del infos['GS']
+    infos['GPX'] = {'sides': 4}
+    new_types = rollengine.read_dice_registry(dice_file(infos)).types
+
+    # GP is unchanged, but 1dGPX would now be read as GPX
+    assert rollengine.changed_dice_types(old_types, new_types) == {'GB', 'GS', 'GP'}
+    assert rollengine.changed_dice_types(old_types, old_types) == set()
+
+
+def test_reloads_drop_only_the_changed_plans(dice_file):
+    rollengine.plan_cache.clear()
+    changed = rollengine.plan_cache.get('1dGB + 2d6')
+    kept = rollengine.plan_cache.get('1dGS')
+
+    infos = dict(dice_file.infos, GB=dict(dice_file.infos['GB'], map=['S'] * 6))
+    assert rollengine.install_dice_registry(rollengine.read_dice_registry(dice_file(infos))) == {'GB'}
+    assert rollengine.plan_cache.get('1dGS') is kept
+    assert rollengine.plan_cache.get('1dGB + 2d6') is not changed
+    # The old plan still rolls the dice it was compiled with
+    assert changed.terms[0].dice.map[0] == 'B'
+    assert rollengine.roll_command('3dGB', 'python').rolls[0].faces == ['S', 'S', 'S']
+
+
+@pytest.mark.parametrize('infos', [
+    {'gb': {'sides': 6}},
+    {'XY': {'names': {}}},
+    {'XY': {'sides': 6, 'success_op': '=>'}},
+    ['XY'],
+])
+def test_bad_dice_files_are_refused(dice_file, infos):
+    registry = rollengine._dice_registry
+    with pytest.raises(rollengine.DiceFileError):
+        rollengine.load_dice_types(dice_file(infos))
+    assert rollengine._dice_registry is registry
+
+
+# -------------------------------------------------------------
+#  Engines
+# -------------------------------------------------------------
+
+@pytest.mark.parametrize('num_dice, engine, roll_class', [
+    (10, None, rollengine.DiceRoll),
+    (rollengine._vector_min_dice, None, rollengine.VectorDiceRoll),
+    (10, 'numpy', rollengine.VectorDiceRoll),
+    (rollengine._vector_min_dice, 'python', rollengine.DiceRoll),
+    (rollengine._count_min_dice, None, rollengine.HistogramDiceRoll),
+    (10, 'counts', rollengine.HistogramDiceRoll),
+])
+def test_select_roll_class(num_dice, engine, roll_class):
+    plan = rollengine.compile_dice(f'{num_dice}d6')
+    assert rollengine.select_roll_class(plan, engine) is roll_class
+
+
+@pytest.mark.parametrize('expr', ['300d10', '300d10>=8', '300d10k100', '300d10kl100', '300d10min1700', '300d10max1500'])
+def test_vector_engine_counts_its_own_dice(expr):
+    roll = rollengine.roll_command(expr, 'numpy').rolls[0]
+    assert isinstance(roll, rollengine.VectorDiceRoll)
+    values = roll.values
+    options = roll.plan.options
+
+    if 'keep' in options:
+        # The kept dice are the lowest or highest of the ones rolled
+        initial = sorted(roll.plan.vector.values[roll.roll_history].tolist())
+        assert sorted(values) == (initial[:options['keep']] if options['keep'] > 0 else initial[options['keep']:])
+    if 'threshold' in options:
+        assert roll.successes == sum(val >= 8 for val in values)
+
+    expected = sum(values)
+    if roll.plan.min and expected < roll.plan.min:
+        expected = roll.plan.min
+    if roll.plan.max and expected > roll.plan.max:
+        expected = roll.plan.max
+    assert roll.sum == expected
+
+
+@pytest.mark.parametrize('engine, as_rolls', [('python', list), ('numpy', np.array)])
+def test_derived_values_follow_the_dice(engine, as_rolls):
+    roll = rollengine.roll_command('4d6min10max20', engine).rolls[0]
+    roll.rolls = as_rolls([0, 0, 1, 0])
+    assert roll.faces == ['1', '1', '2', '1']
+    assert (roll.sum, roll.limit_flag, roll.limit_txt) == (10, True, '(min)')
+    roll.rolls = as_rolls([5, 5, 5, 5])
+    assert (roll.sum, roll.limit_flag, roll.limit_txt) == (20, True, '(max)')
+    roll.rolls = as_rolls([2, 2, 2, 2])
+    assert (roll.sum, roll.limit_flag) == (12, False)
+
+    # Changing a die in place drops what was worked out from the old dice too
+    roll.reroll(0)
+    assert roll.values == [int(roll.map[idx]) for idx in roll.rolls]
+    assert roll.sum == sum(roll.values)
+
+
+def test_tally_adds_up_the_rolls():
+    equation = rollengine.roll_command('10d10>=8cs10 + 5d6min10 - 3d10>=9 >= 10')
+    rolls = equation.rolls
+    tally = equation.tally
+    assert tally.sum == rolls[0].sum + rolls[1].sum - rolls[2].sum
+    assert tally.successes == rollengine.RollResult(
+        total=rolls[0].successes + rolls[2].successes,
+        map=[(0, rolls[0].successes), (2, rolls[2].successes)],
+    )
+    assert tally.failures is None
+    assert tally.limit_flag == rolls[1].limit_flag
+    assert tally.final_compare_result == (tally.sum >= 10)
+
+    # A new list of rolls takes a new tally
+    rolls = rollengine.roll_command('10d10>=8cs10 + 5d6min10 - 3d10>=9 >= 10').rolls
+    equation.rolls = rolls
+    assert equation.tally.sum == rolls[0].sum + rolls[1].sum - rolls[2].sum
+    assert equation.tally.successes.map == [(0, rolls[0].successes), (2, rolls[2].successes)]
+
+
+@pytest.mark.parametrize('expr, weights', [
+    ('1d10>=8cs10', {'successes': (0, 0, 0, 0, 0, 0, 0, 1, 1, 2)}),
+    ('1d10>=8cs10~<=2cf1', {'successes': (0, 0, 0, 0, 0, 0, 0, 1, 1, 2), 'failures': (2, 1, 0, 0, 0, 0, 0, 0, 0, 0)}),
+    ('1d6<3', {'successes': (1, 1, 0, 0, 0, 0)}),
+    ('1dGP', {'successes': (0, 1, 1, 2, 2, 0, 0, 1, 1, 0, 0, 1), 'boons': (0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 0)}),
+])
+def test_face_weight_tables(expr, weights):
+    plan = rollengine.compile_dice(expr)
+    assert plan.weights == weights
+    roll = rollengine.roll_command(expr, 'python').rolls[0]
+    for counter_name, table in weights.items():
+        assert getattr(roll, counter_name) == sum(table[idx] for idx in roll.rolls)
+
+
+def test_face_weights_need_values():
+    with pytest.raises(rollengine.UnknownDiceValueError):
+        rollengine.roll_command('5dGP>=1')
+    with pytest.raises(rollengine.UnknownOperationError):
+        rollengine.compile_dice('1d6>=5cs"S"')
+
+
+def test_explode_chain():
+    chain = rollengine.compile_dice('1d6!5!6r6').chain
+    # The 6 is rerolled once, so every face gets a sixth of its chance back
+    assert chain.chance == pytest.approx((1 / 6 + 1 / 36 + 1 / 36))
+    assert (chain.go_faces, chain.stop_faces) == ((4, 5), (0, 1, 2, 3))
+    assert sum(chain.go_probs) == sum(chain.stop_probs) == pytest.approx(1)
+    assert rollengine.compile_dice('1d6').chain is None
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_explode_modes_agree(engine, monkeypatch):
+    seed_rolls(monkeypatch, 5)
+    expected = rollengine.prob_command('10d6!5,6r1').mean
+
+    means = []
+    for mode in ('rounds', 'geometric'):
+        monkeypatch.setattr(rollengine, '_explode_mode', mode)
+        rolls = [rollengine.roll_command('10d6!5,6r1', engine).rolls[0] for _ in range(2000)]
+        means.append(sum(roll.sum for roll in rolls) / len(rolls))
+        # Every exploded die is followed by its chain, so the last die rolled never explodes
+        assert all(roll.faces[-1] not in ('5', '6') for roll in rolls if len(roll.faces) > 10)
+    assert means == [pytest.approx(expected, rel=0.02)] * 2
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_explode_modes_log_the_same_history(engine, monkeypatch):
+    seed_rolls(monkeypatch, 9)
+    rerolled = {}
+    for mode in ('rounds', 'geometric'):
+        monkeypatch.setattr(rollengine, '_explode_mode', mode)
+        added = from_ones = 0
+        for _ in range(2000):
+            roll = rollengine.roll_command('10d6!5,6r1', engine).rolls[0]
+            exploded = set()
+            for entry in roll.history.changes if roll.history else ():
+                idx = np.atleast_1d(entry.idx).tolist()
+                if entry.reason == 'explode':
+                    exploded.update(idx)
+                    added += len(idx)
+                elif idx[0] >= 10:
+                    # A die explosions added is rerolled after it's logged, and only if it came up a 1
+                    assert exploded.issuperset(idx)
+                    assert set(np.atleast_1d(entry.old).tolist()) == {0}
+                    from_ones += len(idx)
+        rerolled[mode] = from_ones / added
+    # A sixth of the dice explosions add come up as a 1
+    assert rerolled['geometric'] == pytest.approx(rerolled['rounds'], rel=0.1)
+    assert rerolled['rounds'] == pytest.approx(1 / 6, rel=0.1)
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+@pytest.mark.parametrize('mode', ['rounds', 'geometric'])
+def test_history_replays_the_roll(engine, mode, monkeypatch):
+    monkeypatch.setattr(rollengine, '_explode_mode', mode)
+    seed_rolls(monkeypatch, 7)
+    for _ in range(50):
+        roll = rollengine.roll_command('8d6r1!5,6k3', engine).rolls[0]
+        history = roll.history
+        assert list(history.replay(0)) == list(history.initial)
+        assert list(history.replay()) == list(roll.rolls)
+        # The keep is the last step, the step before it has every die to keep from
+        assert sorted(history.replay(len(history) - 1))[-3:] == sorted(roll.rolls)
+
+
+@pytest.mark.parametrize('num_dice, keep_num, sides', [
+    (4, 3, 6),
+    (50, -20, 1000),
+    (100, 10, 100),
+    (1000, -500, 6),
+    (1000, 5, 100000),
+    (200, 20, 6),
+])
+def test_select_kept_matches_a_sort(num_dice, keep_num, sides):
+    rng = random.Random(num_dice)
+    rolls = [rng.randrange(sides) for _ in range(num_dice)]
+    # A stable sort keeps the earliest of equal dice at the cut
+    order = sorted(range(num_dice), key=rolls.__getitem__, reverse=keep_num < 0)
+    expected = sorted(order[:abs(keep_num)])
+
+    assert rollengine.select_kept(rolls, keep_num, sides) == expected
+    assert np.flatnonzero(rollengine.select_kept_array(np.array(rolls), keep_num, sides)).tolist() == expected
+
+
+def test_select_kept_ties():
+    rolls = [2, 0, 2, 1, 2, 0]
+    assert rollengine.select_kept(rolls, 3, 3) == [1, 3, 5]
+    assert rollengine.select_kept(rolls, -2, 3) == [0, 2]
+    assert rollengine.select_kept(rolls, 0, 3) == []
+    assert rollengine.select_kept(rolls, 10, 3) == list(range(6))
+    assert np.flatnonzero(rollengine.select_kept_array(np.array(rolls), -2, 3)).tolist() == [0, 2]
+
+
+@pytest.mark.parametrize('with_numpy', [True, False])
+@pytest.mark.parametrize('expr', ['5000d6', '3000d6r1!6k100', '3000d10>=8cs10', '2500dGP', '2000d6kl10min9000'])
+def test_counted_pools_agree_with_the_list_engine(expr, with_numpy, monkeypatch):
+    if not with_numpy:
+        monkeypatch.setattr(rollengine, 'np', None)
+    # Only counted when asked for, so the same pool can be rolled as a list
+    monkeypatch.setattr(rollengine, '_count_min_dice', 0)
+    seed_rolls(monkeypatch, 11)
+
+    roll = rollengine.roll_command(expr, 'counts').rolls[0]
+    assert isinstance(roll, rollengine.HistogramDiceRoll)
+    assert len(roll.rolls) == roll.sides
+    # The counts rebuilt as a list of dice give the same results as rolling them as a list
+    listed = rollengine.roll_command(expr, 'python').rolls[0]
+    listed.rolls = [idx for idx, count in enumerate(roll.rolls) for _ in range(count)]
+    for name in ('values', 'sum', 'limit_flag'):
+        assert getattr(roll, name) == getattr(listed, name), name
+    for counter_name, table in roll.plan.weights.items():
+        assert getattr(roll, counter_name) == sum(table[idx] * count for idx, count in enumerate(roll.rolls))
+    if 'k' in expr:
+        assert sum(roll.rolls) == abs(roll.plan.options['keep'])
+
+
+def test_counted_pools_print_a_count_per_face():
+    cost = rollengine.compile_roll('50000d100').cost
+    assert cost.output_chars < 100 * 12
+
+
+# -------------------------------------------------------------
+#  Roll Limits
+# -------------------------------------------------------------
+
+def test_estimate_cost():
+    cost = rollengine.compile_roll('10d6!6 + 4d6k3').cost
+    assert (cost.dice, cost.expected_dice) == (14, pytest.approx(16))
+    assert cost.keep_ops == pytest.approx(8)
+    assert rollengine.compile_roll('2d6 + 1d2!1!2').cost.endless == '1d2!1!2'
+    # A die that never explodes spreads the sum over its range once
+    assert rollengine.compile_roll('3d6 + 2').cost.outcomes == 1 + 3 * 5
+
+
+@pytest.mark.parametrize('expr', [
+    '100001d6',
+    '150000d6!5,6',
+    '1d1!1',
+])
+def test_roll_limits(expr):
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.roll_command(expr)
+
+
+def test_roll_limits_before_compiling():
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.compile_dice('1d100001')
+
+
+def test_output_limit_is_only_for_replies(monkeypatch):
+    monkeypatch.setattr(rollengine, '_max_output_chars', 1000)
+    monkeypatch.setattr(rollengine, '_max_prob_outcomes', 1000)
+    cost = rollengine.compile_roll('500d100').cost
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.check_roll_cost(cost)
+    rollengine.check_roll_cost(cost, check_output=False)
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.check_roll_cost(cost, check_output=False, check_outcomes=True)
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_unlucky_explosions_stop(engine, monkeypatch):
+    monkeypatch.setattr(rollengine, '_max_rolled_dice', 10)
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.roll_command('10d6!2,3,4,5,6', engine)
+
+
+# -------------------------------------------------------------
+#  Probabilities
+# -------------------------------------------------------------
+
+def brute_die(sides, reroll=(), explode=(), depth=40):
+    # Value -> chance of one die: a reroll face is rolled again once, an exploding face adds another die. Chains are
+    # followed depth dice deep, a round at a time.
+    face_chance = {
+        face: Fraction(face not in reroll, sides) + Fraction(len(reroll), sides * sides) for face in range(1, sides + 1)
+    }
+    chances = {}
+    going = {0: Fraction(1)}
+    for _ in range(depth):
+        still_going = {}
+        for base, chance in going.items():
+            for face, prob in face_chance.items():
+                target = still_going if face in explode else chances
+                target[base + face] = target.get(base + face, 0) + chance * prob
+        going = still_going
+    return chances
+
+
+def brute_pool(num_dice, sides, reroll=(), explode=(), min_val=None, max_val=None):
+    die = brute_die(sides, reroll, explode)
+    chances = {}
+    for combo in product(die.items(), repeat=num_dice):
+        val = sum(face for face, _ in combo)
+        if min_val and val < min_val:
+            val = min_val
+        elif max_val and val > max_val:
+            val = max_val
+        prob = Fraction(1)
+        for _, chance in combo:
+            prob *= chance
+        chances[val] = chances.get(val, 0) + prob
+    return chances
+
+
+def brute_combine(a, b, func):
+    chances = {}
+    for (a_val, a_prob), (b_val, b_prob) in product(a.items(), b.items()):
+        val = func(a_val, b_val)
+        chances[val] = chances.get(val, 0) + a_prob * b_prob
+    return chances
+
+
+def assert_distribution(result, expected):
+    # Explosion chains are only followed until they're less likely than _explode_epsilon, so allow for that much
+    dist = result.distribution
+    got = {dist.offset + idx: prob for idx, prob in enumerate(dist.probs) if prob > 1e-9}
+    assert set(got) <= set(expected)
+    for val, prob in expected.items():
+        assert got.get(val, 0.0) == pytest.approx(float(prob), abs=1e-9)
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('2d6', brute_pool(2, 6)),
+    ('3d4', brute_pool(3, 4)),
+    ('1d6r1', brute_pool(1, 6, reroll=(1,))),
+    ('2d6r1,2', brute_pool(2, 6, reroll=(1, 2))),
+    ('2d4!4', brute_pool(2, 4, explode=(4,))),
+    ('1d6!5,6r1', brute_pool(1, 6, reroll=(1,), explode=(5, 6))),
+    ('3d6min8', brute_pool(3, 6, min_val=8)),
+    ('3d6max12', brute_pool(3, 6, max_val=12)),
+    ('3d4+1', brute_combine(brute_pool(3, 4), {1: 1}, operator.add)),
+    ('2d6-1d4', brute_combine(brute_pool(2, 6), brute_pool(1, 4), operator.sub)),
+    ('-1d6+10', brute_combine(brute_pool(1, 6), {10: 1}, lambda a, b: b - a)),
+    ('1d6*1d4', brute_combine(brute_pool(1, 6), brute_pool(1, 4), operator.mul)),
+    ('2d6/1d3', brute_combine(brute_pool(2, 6), brute_pool(1, 3), operator.floordiv)),
+    ('(1d4+1)*2', brute_combine(brute_pool(1, 4), {1: 1}, lambda a, b: (a + b) * 2)),
+])
+def test_prob_matches_enumeration(expr, expected):
+    assert_distribution(rollengine.prob_command(expr), expected)
+
+
+def test_prob_compare_chance():
+    expected = brute_pool(3, 6)
+    result = rollengine.prob_command('3d6 >= 12')
+    assert result.compare_chance == pytest.approx(float(sum(p for val, p in expected.items() if val >= 12)))
+
+
+def test_prob_follows_likely_explosions():
+    # Every die but a 1 explodes, so a die rolls 20 times on average
+    result = rollengine.prob_command('1d20!' + ','.join(map(str, range(2, 21))))
+    assert result.mean == pytest.approx(210)
+
+
+@pytest.mark.parametrize('expr, error', [
+    ('1d6!1,2,3,4,5,6', rollengine.RollLimitError),
+    ('100000d100000', rollengine.RollLimitError),
+    ('4d6k3', rollengine.UnknownOperationError),
+])
+def test_prob_limits(expr, error):
+    with pytest.raises(error):
+        rollengine.prob_command(expr)
+
+
+# -------------------------------------------------------------
+#  Simulation
+# -------------------------------------------------------------
+
+# Explosion chains of 1d100!2,...,100 run past 100 dice in a third of the trials
+@pytest.mark.parametrize('expr', [
+    '1d20!' + ','.join(map(str, range(2, 21))),
+    '1d100!' + ','.join(map(str, range(2, 101))),
+    '3d6!6r1',
+    '4d6!6k3',
+], ids=lambda expr: expr[:16])
+def test_sim_mean_matches_prob(expr, monkeypatch):
+    seed_rolls(monkeypatch, 3)
+    plan = rollengine.compile_roll(expr)
+    trials = 200000
+    sums, _ = rollengine.simulate_term(plan.terms[0], trials)
+    if 'keep' in plan.terms[0].options:
+        # No exact distribution to hold it to, but the same dice rolled one at a time should agree
+        singles = [rollengine.roll_command(expr, 'python').sum for _ in range(20000)]
+        expected, stdev = np.mean(singles), np.std(singles) * (1 / 20000 + 1 / trials) ** 0.5
+    else:
+        result = rollengine.prob_command(expr)
+        expected, stdev = result.mean, result.stdev / trials ** 0.5
+    assert abs(sums.mean() - expected) < 5 * stdev
+
+
+def test_sim_follows_the_program(monkeypatch):
+    seed_rolls(monkeypatch, 4)
+    expr = '(1d6+2) * 1d4 - 2d6/1d3'
+    batch = rollengine.sim_batch_command(expr, 200000)
+    result = rollengine.prob_command(expr)
+    sums = batch.histograms['Sum']
+    mean = sum(val * count for val, count in sums.items()) / batch.trials
+    assert abs(mean - result.mean) < 5 * result.stdev / batch.trials ** 0.5
+
+
+def test_sim_command_runs_every_trial():
+    *_, result = rollengine.sim_command('5000 10d10>=8 >= 50', time_budget=60)
+    assert result.trials == result.requested == 5000
+    assert sum(result.histograms['Sum'].values()) == sum(result.histograms['Successes'].values()) == 5000
+    assert set(result.histograms['Successes']) <= set(range(11))
+    assert 0 < result.compare_hits < 5000
+
+
+# -------------------------------------------------------------
+#  Batches
+# -------------------------------------------------------------
+
+@pytest.mark.parametrize('command, items', [
+    ('1d20+5', [('1d20+5', 1)]),
+    ('6x 4d6k3', [('4d6k3', 6)]),
+    (' 2X1d20 ; 1d6;; 3x 2d6 >= 7 ', [('1d20', 2), ('1d6', 1), ('2d6 >= 7', 3)]),
+    ('0x 1d6', [('0x 1d6', 1)]),
+])
+def test_split_batch(command, items):
+    assert rollengine.split_batch(command) == items
+
+
+@pytest.mark.parametrize('command', ['21x 1d6', '10x 1d6; 11x 1d20', '20x 10000d6', '2x 1d6; 1d1!1'])
+def test_batch_limits(command):
+    with pytest.raises(rollengine.RollLimitError):
+        rollengine.roll_batch(command)
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy', 'counts'])
+def test_repeats_share_their_first_draw(engine, monkeypatch):
+    seed_rolls(monkeypatch, 13)
+    roll_class = rollengine.select_roll_class(rollengine.compile_dice('3d6'), engine)
+    draw_initial = roll_class.draw_initial
+    draws = []
+
+    def counted_draw(dice_plan, rng, repeats):
+        draws.append(repeats)
+        return draw_initial(dice_plan, rng, repeats)
+
+    monkeypatch.setattr(roll_class, 'draw_initial', counted_draw)
+    (item,) = rollengine.roll_batch('5x 3d6>=5', engine)
+    assert draws == [5]
+    assert len({str(equation.rolls[0].values) for equation in item.equations}) > 1
+    for equation in item.equations:
+        values = equation.rolls[0].values
+        assert len(values) == 3
+        assert equation.tally.successes.total == sum(val >= 5 for val in values)
+
+
+
+# -------------------------------------------------------------
+#  Command Line
+# -------------------------------------------------------------
+
+def test_serve_lines_answers_each_request():
+    out = io.StringIO()
+    rollengine.serve_lines([
+        '{"op": "roll", "expr": "2x 3d1 + 2", "id": 7}',
+        '',
+        '{"op": "prob", "expr": "1d2"}',
+        '{"op": "roll", "expr": "1d6/0"}',
+        'not json',
+    ], out)
+    rolled, prob, failed, garbled = map(json.loads, out.getvalue().splitlines())
+    assert [roll['total'] for roll in rolled['rolls']] == [5, 5]
+    assert rolled['id'] == 7
+    assert 'error' not in prob
+    assert 'error' in failed and 'error' in garbled
+
+
+def test_cli_rolls_and_prints_json(capsys):
+    assert rollengine.main_(['roll', '--json', '--seed', '1', '3d1', '+', '2']) == 0
+    assert json.loads(capsys.readouterr().out)['rolls'][0]['total'] == 5
+    assert rollengine.main_(['roll', '1d6/0']) == 1
+    assert capsys.readouterr().err.startswith('ERROR:')
+
+
+def test_cli_refuses_bad_dice_files(tmp_path, capsys):
+    with pytest.raises(SystemExit) as excp:
+        rollengine.main_(['--dice', str(tmp_path / 'missing.json'), 'roll', '1d6'])
+    assert excp.value.code == 2
+    assert 'missing.json' in capsys.readouterr().err
+
+
+def test_engine_config_follows_the_engine(monkeypatch):
+    monkeypatch.setattr(rollengine, '_debug', True)
+    config = rollengine.engine_config()
+    assert config.debug is True
+    assert config.dice_path == rollengine._dice_path